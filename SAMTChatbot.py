@@ -110,7 +110,7 @@ with gr.Blocks(theme=small_and_beautiful_theme) as demo:
             with gr.Column(elem_id="chatbot-area"):
                 with gr.Row(elem_id="chatbot-header"):
                     model_select_dropdown = gr.Dropdown(
-                        label=i18n("选择模型"), choices=MODELS, multiselect=False, value=MODELS[DEFAULT_MODEL],
+                        label=i18n("选择模型"), choices=MODELS, multiselect=False, value=DEFAULT_MODEL_NAME,
                         interactive=True,
                         show_label=False, container=False, elem_id="model-select-dropdown", filterable=False
                     )
@@ -132,8 +132,13 @@ with gr.Blocks(theme=small_and_beautiful_theme) as demo:
                         show_label=False,
                         avatar_images=[config.user_avatar, config.bot_avatar],
                         show_share_button=False,
-                        placeholder=setPlaceholder(model_name=MODELS[DEFAULT_MODEL]),
+                        placeholder=setPlaceholder(model_name=DEFAULT_MODEL_NAME),
                     )
+                # delta_streaming 模式下承载新增文本，由 stream-delta.js 追加到正在生成的消息中
+                stream_delta = gr.HTML("", elem_id="stream-delta", elem_classes="hideK")
+                choice_selector = gr.Radio(
+                    label=i18n("保留回答"), choices=[], visible=False, elem_id="choice-selector"
+                )
                 with gr.Row(elem_id="chatbot-footer"):
                     with gr.Column(elem_id="chatbot-input-box"):
                         with gr.Row(elem_id="chatbot-input-row"):
@@ -193,7 +198,7 @@ with gr.Blocks(theme=small_and_beautiful_theme) as demo:
                         with gr.Accordion(label=i18n("模型"), open=not HIDE_MY_KEY, visible=False):
                             modelDescription = gr.Markdown(
                                 elem_id="gr-model-description",
-                                value=i18n(MODEL_METADATA[MODELS[DEFAULT_MODEL]]["description"]),
+                                value=i18n(MODEL_METADATA.peek(DEFAULT_MODEL_NAME)["description"]),
                                 visible=False,
                             )
                             keyTxt = gr.Textbox(
@@ -383,7 +388,7 @@ with gr.Blocks(theme=small_and_beautiful_theme) as demo:
                             label=i18n("API域名"), value=FACTORYS_API, interactive=True
                         )
                         model_select_dropdown = gr.Dropdown(
-                            label=i18n("选择模型"), choices=MODELS, multiselect=False, value=MODELS[DEFAULT_MODEL],
+                            label=i18n("选择模型"), choices=MODELS, multiselect=False, value=DEFAULT_MODEL_NAME,
                             interactive=True
                         )
 
@@ -500,12 +505,12 @@ with gr.Blocks(theme=small_and_beautiful_theme) as demo:
             user_info, user_name = gr.Markdown(
                 value=f"", visible=False), ""
         current_model = get_model(
-            model_name=MODELS[DEFAULT_MODEL], access_key=my_api_key, user_name=user_name)[0]
+            model_name=DEFAULT_MODEL_NAME, access_key=my_api_key, user_name=user_name)[0]
         if not hide_history_when_not_logged_in or user_name:
             loaded_stuff = current_model.auto_load()
         else:
             current_model.new_auto_history_filename()
-            loaded_stuff = [gr.update(), gr.update(), gr.Chatbot(label=MODELS[DEFAULT_MODEL]),
+            loaded_stuff = [gr.update(), gr.update(), gr.Chatbot(label=DEFAULT_MODEL_NAME),
                             current_model.single_turn, current_model.temperature, current_model.top_p,
                             current_model.n_choices, current_model.stop_sequence, current_model.token_upper_limit,
                             current_model.max_generation_token, current_model.presence_penalty,
@@ -522,8 +527,20 @@ with gr.Blocks(theme=small_and_beautiful_theme) as demo:
         max_context_length_slider, max_generation_slider, presence_penalty_slider, frequency_penalty_slider,
         logit_bias_txt, user_identifier_txt, use_streaming_checkbox, downloadHistoryJSONBtn, downloadHistoryMarkdownBtn,
         historySelectList], api_name="load")
+    # 后台刷新到新的 Ollama 模型列表后推送到模型下拉框
+    model_list_version = gr.State(model_registry.version)
+    if model_refresh_interval > 0:
+        demo.load(refresh_model_choices, [model_list_version], [model_select_dropdown, model_list_version],
+                  every=model_refresh_interval, show_progress=False)
+    if delta_streaming:
+        predict_fn = predict_delta_async if async_streaming else predict_delta
+        predict_outputs = [chatbot, status_display, stream_delta]
+    else:
+        predict_fn = predict_async if async_streaming else predict
+        predict_outputs = [chatbot, status_display]
+
     chatgpt_predict_args = dict(
-        fn=predict,
+        fn=predict_fn,
         inputs=[
             current_model,
             user_question,
@@ -532,7 +549,7 @@ with gr.Blocks(theme=small_and_beautiful_theme) as demo:
             index_files,
             language_select_dropdown,
         ],
-        outputs=[chatbot, status_display],
+        outputs=predict_outputs,
         show_progress=True,
         concurrency_limit=CONCURRENT_COUNT
     )
@@ -575,6 +592,10 @@ with gr.Blocks(theme=small_and_beautiful_theme) as demo:
         fn=get_history_list, inputs=[user_name], outputs=[historySelectList]
     )
 
+    choice_selector_args = dict(
+        fn=get_choice_selector, inputs=[current_model], outputs=[choice_selector], show_progress=False
+    )
+
     auto_name_chat_history_args = dict(
         fn=auto_name_chat_history,
         inputs=[current_model, name_chat_method, user_question, single_turn_checkbox],
@@ -582,18 +603,28 @@ with gr.Blocks(theme=small_and_beautiful_theme) as demo:
         show_progress=False,
     )
 
+    # 模型生成的标题在后台完成，完成后更新对话列表
+    chat_title_args = dict(
+        fn=wait_for_chat_title,
+        inputs=[current_model],
+        outputs=[historySelectList],
+        show_progress=False,
+    )
+
     # Chatbot
     cancelBtn.click(interrupt, [current_model], [])
     # 绑定提交信息
 
     user_input.submit(**transfer_input_args).then(**
                                                   chatgpt_predict_args).then(**end_outputing_args).then(
-        **auto_name_chat_history_args)
+        **choice_selector_args).then(**auto_name_chat_history_args).then(
+        **chat_title_args)
     user_input.submit(**get_usage_args)
 
     submitBtn.click(**transfer_input_args).then(**chatgpt_predict_args,
                                                 api_name="predict").then(**end_outputing_args).then(
-        **auto_name_chat_history_args)
+        **choice_selector_args).then(**auto_name_chat_history_args).then(
+        **chat_title_args)
     submitBtn.click(**get_usage_args)
 
     index_files.upload(handle_file_upload, [current_model, index_files, chatbot, language_select_dropdown], [
@@ -613,7 +644,7 @@ with gr.Blocks(theme=small_and_beautiful_theme) as demo:
     )
 
     retryBtn.click(**start_outputing_args).then(
-        retry,
+        retry_delta if delta_streaming else retry,
         [
             current_model,
             chatbot,
@@ -621,10 +652,16 @@ with gr.Blocks(theme=small_and_beautiful_theme) as demo:
             index_files,
             language_select_dropdown,
         ],
-        [chatbot, status_display],
+        predict_outputs,
         show_progress=True,
-    ).then(**end_outputing_args)
+    ).then(**end_outputing_args).then(**choice_selector_args)
     retryBtn.click(**get_usage_args)
+    choice_selector.input(
+        keep_choice,
+        [current_model, choice_selector, chatbot],
+        [chatbot, choice_selector, status_display],
+        show_progress=False,
+    )
 
     delFirstBtn.click(
         delete_first_conversation,
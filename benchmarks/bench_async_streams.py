@@ -0,0 +1,160 @@
+# -*- coding:utf-8 -*-
+"""
+同步与异步流式路径的并发对比
+
+在子进程中启动一个模拟 Ollama /v1/chat/completions 的 SSE 服务，分别用
+- 同步路径：每个流占用一个线程，http_pool.get_session + iter_stream_deltas
+- 异步路径：同一个事件循环，http_pool.get_async_client + aiter_stream_deltas
+同时读取 50、100、200 个流，输出线程数峰值、首个 token 时间和完整耗时的分位数。
+
+用法：python benchmarks/bench_async_streams.py [--tokens 50] [--interval 0.02]
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import socket
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from modules.models import http_pool  # noqa: E402
+from modules.models.stream_decoder import aiter_stream_deltas, iter_stream_deltas  # noqa: E402
+
+CONCURRENCY = (50, 100, 200)
+
+
+def serve(port, tokens, interval):
+    """单线程 asyncio 实现的 SSE 服务，服务端本身不随并发数增加线程"""
+    chunk = b"data: " + json.dumps({"choices": [{"delta": {"content": "token "}}]}).encode() + b"\n\n"
+    done = b"data: " + json.dumps({"choices": [{"delta": {}, "finish_reason": "stop"}]}).encode() + b"\n\ndata: [DONE]\n\n"
+
+    async def handle(reader, writer):
+        try:
+            while True:
+                head = await reader.readuntil(b"\r\n\r\n")
+                length = 0
+                for line in head.split(b"\r\n"):
+                    if line.lower().startswith(b"content-length:"):
+                        length = int(line.split(b":", 1)[1])
+                await reader.readexactly(length)
+                writer.write(
+                    b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nTransfer-Encoding: chunked\r\n\r\n"
+                )
+                for index in range(tokens + 1):
+                    data = chunk if index < tokens else done
+                    writer.write(b"%x\r\n%s\r\n" % (len(data), data))
+                    await writer.drain()
+                    await asyncio.sleep(interval)
+                writer.write(b"0\r\n\r\n")
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            writer.close()
+
+    async def main():
+        server = await asyncio.start_server(handle, "127.0.0.1", port, backlog=1024)
+        await server.serve_forever()
+
+    asyncio.run(main())
+
+
+class ThreadSampler:
+    """后台记录进程内线程数的峰值"""
+
+    def __init__(self):
+        self.peak = threading.active_count()
+        self.running = True
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while self.running:
+            self.peak = max(self.peak, threading.active_count())
+            time.sleep(0.005)
+
+    def stop(self):
+        self.running = False
+        self.thread.join()
+        return self.peak
+
+
+def _percentile(samples, q):
+    ordered = sorted(samples)
+    return ordered[min(int(len(ordered) * q), len(ordered) - 1)]
+
+
+def run_sync(url, streams):
+    def one():
+        start = time.monotonic()
+        first = None
+        response = http_pool.get_session(url).post(url, json={"stream": True}, stream=True, timeout=60)
+        for delta in iter_stream_deltas(response):
+            if first is None and delta.content:
+                first = time.monotonic() - start
+        response.close()
+        return first, time.monotonic() - start
+
+    with ThreadPoolExecutor(max_workers=streams) as executor:
+        return list(executor.map(lambda _: one(), range(streams)))
+
+
+async def run_async(url, streams):
+    client = http_pool.get_async_client(url)
+
+    async def one():
+        start = time.monotonic()
+        first = None
+        async with client.stream("POST", url, json={"stream": True}, timeout=60) as response:
+            async for delta in aiter_stream_deltas(response):
+                if first is None and delta.content:
+                    first = time.monotonic() - start
+        return first, time.monotonic() - start
+
+    return await asyncio.gather(*(one() for _ in range(streams)))
+
+
+def report(name, streams, results, threads, elapsed):
+    ttft = [first for first, _ in results]
+    total = [seconds for _, seconds in results]
+    print(
+        f"{name:5} {streams:4} 个流  线程峰值 {threads:4}  "
+        f"TTFT p50 {_percentile(ttft, 0.5) * 1000:7.1f} ms  p99 {_percentile(ttft, 0.99) * 1000:7.1f} ms  "
+        f"完整 p50 {_percentile(total, 0.5):6.2f} s  p99 {_percentile(total, 0.99):6.2f} s  墙钟 {elapsed:6.2f} s"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tokens", type=int, default=50)
+    parser.add_argument("--interval", type=float, default=0.02)
+    args = parser.parse_args()
+
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    server = multiprocessing.Process(target=serve, args=(port, args.tokens, args.interval), daemon=True)
+    server.start()
+    time.sleep(0.5)
+    url = f"http://127.0.0.1:{port}/v1/chat/completions"
+    http_pool.configure(pool_size=max(CONCURRENCY))
+    try:
+        for streams in CONCURRENCY:
+            sampler = ThreadSampler()
+            start = time.monotonic()
+            results = run_sync(url, streams)
+            report("sync", streams, results, sampler.stop(), time.monotonic() - start)
+
+            sampler = ThreadSampler()
+            start = time.monotonic()
+            results = asyncio.run(run_async(url, streams))
+            report("async", streams, results, sampler.stop(), time.monotonic() - start)
+    finally:
+        server.terminate()
+
+
+if __name__ == "__main__":
+    main()
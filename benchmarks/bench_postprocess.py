@@ -0,0 +1,75 @@
+# -*- coding:utf-8 -*-
+"""
+流式输出时 Chatbot.postprocess 的耗时：200 轮历史对话，逐 token 生成第 201 轮的回答
+
+对比每次都重新渲染全部消息（baseline）与缓存历史消息渲染结果（当前实现）每次推送的耗时。
+需要安装 requirements.txt 中的依赖（gradio 等）。
+
+用法：python benchmarks/bench_postprocess.py [--turns 200] [--tokens 400]
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from modules import overwrites  # noqa: E402
+
+USER_MESSAGE = "请解释一下下面这段代码的作用，并给出时间复杂度：\n\n```python\ndef f(n):\n    return sum(i * i for i in range(n))\n```"
+BOT_MESSAGE = (
+    "这段代码计算 $\\sum_{i=0}^{n-1} i^2$。\n\n"
+    "## 分析\n\n"
+    "1. `range(n)` 产生 **n** 个整数；\n"
+    "2. 生成器表达式逐个求平方；\n"
+    "3. `sum` 累加。\n\n"
+    "```python\n# 等价的闭式解\ndef g(n):\n    return (n - 1) * n * (2 * n - 1) // 6\n```\n\n"
+    "| 实现 | 时间复杂度 |\n| --- | --- |\n| f | O(n) |\n| g | O(1) |\n\n"
+    "因此 $f(n) = \\frac{(n-1)n(2n-1)}{6}$，时间复杂度为 $O(n)$。"
+)
+TOKEN = "流式输出的内容 `code` **加粗** "
+
+
+class Renderer:
+    """模拟 gr.Chatbot：postprocess 通过 self._postprocess_chat_messages 渲染每条消息"""
+
+    def __init__(self, cached):
+        self.cached = cached
+
+    def _postprocess_chat_messages(self, chat_message, role, cache=False):
+        return overwrites.postprocess_chat_messages(self, chat_message, role, cache and self.cached)
+
+
+def stream(renderer, turns, tokens):
+    history = [[f"{USER_MESSAGE}\n\n第 {turn} 轮", f"{BOT_MESSAGE}\n\n第 {turn} 轮"] for turn in range(turns)]
+    chatbot = history + [[USER_MESSAGE, ""]]
+    overwrites.convert_message_cached.cache_clear()
+    durations = []
+    for _ in range(tokens):
+        chatbot[-1] = [chatbot[-1][0], chatbot[-1][1] + TOKEN]
+        start = time.perf_counter()
+        overwrites.postprocess(renderer, chatbot)
+        durations.append(time.perf_counter() - start)
+    return durations
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--turns", type=int, default=200)
+    parser.add_argument("--tokens", type=int, default=400)
+    args = parser.parse_args()
+
+    print(f"{args.turns} 轮历史对话，流式输出 {args.tokens} 个 token")
+    totals = {}
+    for name, cached in (("baseline", False), ("cached", True)):
+        durations = sorted(stream(Renderer(cached), args.turns, args.tokens))
+        totals[name] = sum(durations)
+        print(
+            f"{name:8} 每次推送 p50 {durations[len(durations) // 2] * 1000:8.2f} ms  "
+            f"p99 {durations[int(len(durations) * 0.99)] * 1000:8.2f} ms  合计 {totals[name]:7.2f} s"
+        )
+    print(f"加速 {totals['baseline'] / totals['cached']:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+# -*- coding:utf-8 -*-
+"""
+长思考过程的流式拼接：20k 个思考 token + 2k 个正文 token
+
+baseline 按原来的 get_answer_stream_iter，每个 chunk 都用 f-string 重新拼出 <details> 包装的完整字符串；
+StreamAnswer 只追加分段，界面推送的是 StreamFrame。分别统计（都不开启 FrameThrottle，每个 chunk 推送一次）：
+- 每个 chunk 推送一帧，像 delta_streaming 模式一样只取出新增的思考过程和正文，结束时 render 一次
+- 每个 chunk 都 render 完整字符串（非 delta 模式交给 Gradio 渲染时的情况，与 baseline 同样是二次的）
+
+用法：python benchmarks/bench_stream_answer.py [--reasoning 20000] [--content 2000]
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from modules.models.stream_answer import StreamAnswer  # noqa: E402
+
+TOKEN = "思考"
+
+
+def baseline(reasoning_tokens, content_tokens):
+    reasoning_text = ""
+    partial_text = ""
+    start = time.time()
+    total = 0
+    for index in range(reasoning_tokens + content_tokens):
+        if index < reasoning_tokens:
+            reasoning_text += TOKEN
+            elapsed = int(time.time() - start)
+            text = f'<details open>\n<summary>Thinking ({elapsed}s)</summary>\n{reasoning_text}</details>\n\n' + partial_text
+        else:
+            partial_text += TOKEN
+            elapsed = int(time.time() - start)
+            text = f'<details>\n<summary>Thought for {elapsed} s</summary>\n{reasoning_text}</details>\n\n' + partial_text
+        total += len(text)
+    return total
+
+
+def stream_frames(reasoning_tokens, content_tokens):
+    answer = StreamAnswer()
+    sent_reasoning = sent_content = 0
+    total = 0
+    for index in range(reasoning_tokens + content_tokens):
+        if index < reasoning_tokens:
+            answer.add_reasoning(TOKEN)
+        else:
+            answer.add_content(TOKEN)
+        frame = answer.frame()
+        total += len(frame.reasoning_since(sent_reasoning)) + len(frame.content_since(sent_content))
+        sent_reasoning, sent_content = frame.reasoning_length, frame.content_length
+    str(answer)
+    return total
+
+
+def stream_renders(reasoning_tokens, content_tokens):
+    answer = StreamAnswer()
+    total = 0
+    for index in range(reasoning_tokens + content_tokens):
+        if index < reasoning_tokens:
+            answer.add_reasoning(TOKEN)
+        else:
+            answer.add_content(TOKEN)
+        total += len(str(answer))
+    return total
+
+
+def measure(fn, *args):
+    start = time.process_time()
+    result = fn(*args)
+    return time.process_time() - start, result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--reasoning", type=int, default=20000)
+    parser.add_argument("--content", type=int, default=2000)
+    args = parser.parse_args()
+
+    tokens = args.reasoning + args.content
+    print(f"{args.reasoning} 个思考 token + {args.content} 个正文 token")
+    base, _ = measure(baseline, args.reasoning, args.content)
+    print(f"baseline                     CPU {base * 1000:9.1f} ms  每个 token {base / tokens * 1e6:7.2f} µs")
+    for label, fn in (("每个 chunk 推送一帧", stream_frames), ("每个 chunk 都 render", stream_renders)):
+        seconds, _ = measure(fn, args.reasoning, args.content)
+        print(
+            f"StreamAnswer {label:16} CPU {seconds * 1000:9.1f} ms  每个 token {seconds / tokens * 1e6:7.2f} µs  "
+            f"加速 {base / seconds:.1f}x"
+        )
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+# -*- coding:utf-8 -*-
+"""
+回放 Ollama 流式响应，对比旧的 _decode_chat_response 与 StreamDecoder 每个 token 的 CPU 时间
+
+默认回放按 Ollama /v1/chat/completions 格式生成的响应，每个 token 一个网络分片；
+--file 可以回放抓取的原始响应体（例如 curl -N ... > stream.txt），按 --chunk 字节切分。
+
+用法：python benchmarks/bench_stream_decoder.py [--tokens 20000] [--rounds 5] [--file stream.txt]
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from modules.models.stream_decoder import iter_stream_deltas  # noqa: E402
+
+
+def record_stream(tokens, reasoning_tokens):
+    """按 Ollama 的 OpenAI 兼容接口生成一次流式响应，返回网络分片列表"""
+    chunks = []
+    for index in range(tokens):
+        delta = {"role": "assistant"}
+        if index < reasoning_tokens:
+            delta["content"] = ""
+            delta["reasoning"] = "想"
+        else:
+            delta["content"] = " token"
+        chunk = {
+            "id": "chatcmpl-123",
+            "object": "chat.completion.chunk",
+            "created": 1730000000,
+            "model": "deepseek-r1:14b",
+            "system_fingerprint": "fp_ollama",
+            "choices": [{"index": 0, "delta": delta, "finish_reason": None}],
+        }
+        chunks.append(b"data: " + json.dumps(chunk, ensure_ascii=False).encode("utf-8") + b"\n\n")
+    chunks.append(
+        b"data: "
+        + json.dumps({"choices": [{"index": 0, "delta": {"role": "assistant", "content": ""}, "finish_reason": "stop"}]}).encode()
+        + b"\n\ndata: [DONE]\n\n"
+    )
+    return chunks
+
+
+class ReplayResponse:
+    """只实现解码器用到的 iter_content / iter_lines"""
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.encoding = None
+
+    def iter_content(self, chunk_size=1, decode_unicode=False):
+        return iter(self.chunks)
+
+    iter_lines = requests.Response.iter_lines
+
+
+def baseline_decode(response):
+    """baseline 中的 OllamaVisionClient._decode_chat_response，去掉了打印"""
+    error_msg = ""
+    for chunk in response.iter_lines():
+        if chunk:
+            chunk = chunk.decode()
+            if chunk == ": keep-alive":
+                continue
+            chunk_length = len(chunk)
+            try:
+                chunk = json.loads(chunk[6:])
+            except:  # noqa: E722
+                error_msg += chunk
+                continue
+            try:
+                if chunk_length > 6 and "delta" in chunk["choices"][0]:
+                    if "finish_details" in chunk["choices"][0]:
+                        finish_reason = chunk["choices"][0]["finish_details"]
+                    elif "finish_reason" in chunk["choices"][0]:
+                        finish_reason = chunk["choices"][0]["finish_reason"]
+                    else:
+                        finish_reason = chunk["finish_details"]
+                    if finish_reason == "stop":
+                        break
+                    try:
+                        if "reasoning_content" in chunk["choices"][0]["delta"]:
+                            reasoning_content = chunk["choices"][0]["delta"]["reasoning_content"]
+                        else:
+                            reasoning_content = None
+                        yield chunk["choices"][0]["delta"]["content"], reasoning_content
+                    except Exception:
+                        continue
+            except:  # noqa: E722
+                continue
+    if error_msg and not error_msg == "data: [DONE]":
+        raise Exception(error_msg)
+
+
+def decoder_decode(response):
+    for delta in iter_stream_deltas(response):
+        yield delta.content, delta.reasoning
+
+
+def measure(decode, chunks, rounds):
+    best = None
+    for _ in range(rounds):
+        start = time.process_time()
+        count = sum(1 for _ in decode(ReplayResponse(chunks)))
+        elapsed = time.process_time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, count
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tokens", type=int, default=20000)
+    parser.add_argument("--reasoning", type=int, default=5000, help="前多少个 token 是思考过程")
+    parser.add_argument("--rounds", type=int, default=5)
+    parser.add_argument("--file", help="回放抓取的原始响应体")
+    parser.add_argument("--chunk", type=int, default=1400, help="回放文件时每个网络分片的字节数")
+    args = parser.parse_args()
+
+    if args.file:
+        with open(args.file, "rb") as f:
+            data = f.read()
+        chunks = [data[start:start + args.chunk] for start in range(0, len(data), args.chunk)]
+    else:
+        chunks = record_stream(args.tokens, args.reasoning)
+    size = sum(len(chunk) for chunk in chunks)
+    print(f"回放 {len(chunks)} 个分片，共 {size / 1024:.0f} KiB，取 {args.rounds} 轮中最快的一轮")
+    results = {}
+    for name, decode in (("baseline", baseline_decode), ("StreamDecoder", decoder_decode)):
+        seconds, count = measure(decode, chunks, args.rounds)
+        results[name] = seconds
+        print(f"{name:14} {count:6} 个 delta  CPU {seconds * 1000:8.1f} ms  每个 delta {seconds / max(count, 1) * 1e6:6.2f} µs")
+    print(f"加速 {results['baseline'] / results['StreamDecoder']:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
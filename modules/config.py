@@ -9,7 +9,18 @@ from collections import defaultdict
 
 from . import shared
 from . import presets
-from .models.MyOllama import OllamaClient
+from . import tokenizer
+from .history_store import history_writer
+from .models import http_pool
+from .models.host_pool import host_pool
+from .models.scheduler import scheduler
+from .models.response_cache import response_cache
+from .models import warmup
+from .models import frame_throttle
+from .models import context_manager
+from .models.model_registry import model_registry, ModelMetadata
+from .models.latency import latency_tracker
+from .models.hedging import hedger
 from .presets import i18n
 
 
@@ -36,6 +47,9 @@ __all__ = [
     "chat_name_method_index",
     "HIDE_MY_KEY",
     "hfspaceflag",
+    "async_streaming",
+    "model_refresh_interval",
+    "delta_streaming",
 ]
 
 # 添加一个统一的config文件，避免文件过多造成的疑惑（优先级最低）
@@ -108,16 +122,27 @@ if "extra_model_metadata" in config:
     logging.info(i18n("已添加 {extra_model_quantity} 个额外的模型元数据").format(extra_model_quantity=len(config["extra_model_metadata"])))
 
 _model_metadata = {}
-for k, v in presets.MODEL_METADATA.items():
+# 只合并已经生成的条目，其余 Ollama 模型仍然在访问时生成
+for k, v in dict.items(presets.MODEL_METADATA):
     temp_dict = presets.DEFAULT_METADATA.copy()
     temp_dict.update(v)
     _model_metadata[k] = temp_dict
-presets.MODEL_METADATA = _model_metadata
+presets.MODEL_METADATA = ModelMetadata(
+    model_registry.describe, presets.DEFAULT_METADATA, _model_metadata, known=lambda: presets.MODELS,
+    resolver=model_registry,
+)
 
 if "available_models" in config:
     presets.MODELS = config["available_models"]
     logging.info(i18n("已设置可用模型：{available_models}").format(available_models=config["available_models"]))
 
+# 后台刷新会原地修改 MODELS，默认模型和命名模型的下标按启动时的列表解析为名称，之后只使用名称
+_startup_models = list(presets.MODELS)
+presets.DEFAULT_MODEL_NAME = _startup_models[presets.DEFAULT_MODEL] if _startup_models else None
+
+# 选择模型时在后台预热；启动时预热默认模型
+warmup.configure(enabled=config.get("model_warmup", True))
+
 # 模型配置
 if "extra_models" in  config:
     presets.MODELS.extend(config["extra_models"])
@@ -125,6 +150,12 @@ if "extra_models" in  config:
 
 HIDE_MY_KEY = config.get("hide_my_key", False)
 
+# 使用异步流式生成，生成期间不占用 Gradio 的工作线程
+async_streaming = config.get("async_streaming", False)
+
+# 流式输出时只向浏览器发送新增的文本，由前端追加到正在生成的消息中，每轮结束时再同步一次完整的对话
+delta_streaming = config.get("delta_streaming", False)
+
 google_genai_api_key = os.environ.get(
     "GOOGLE_PALM_API_KEY", "")
 google_genai_api_key = os.environ.get(
@@ -177,6 +208,91 @@ os.environ["ERNIE_SECRETKEY"] = ernie_secret_key
 
 ollama_host = config.get("ollama_host", "")
 os.environ["OLLAMA_HOST"] = ollama_host
+# 使用 Ollama 原生 /api/chat 接口，token 数与生成速度取服务端统计
+ollama_native_api = config.get("ollama_native_api", False)
+
+# Ollama 连接池：每个 host 共享 keep-alive 连接
+http_pool.configure(
+    pool_size=config.get("http_pool_size", presets.CONCURRENT_COUNT),
+    keep_alive=config.get("http_keep_alive", True),
+    max_retries=config.get("http_max_retries", 2),
+    backoff_factor=config.get("http_retry_backoff", 0.3),
+)
+
+# 没有足够的延迟统计时使用的超时时间；统计足够后按每台主机、每个模型的分位数自动调整
+latency_tracker.configure(
+    connect=config.get("connect_timeout", 10),
+    first_token=config.get("first_token_timeout", 200),
+    idle=config.get("idle_timeout", presets.TIMEOUT_STREAMING),
+)
+
+# 首个 token 超过主机的 p95 TTFT 仍未到达时，向另一台主机发送相同的请求；模型元数据中的 "hedge" 可以单独开关
+hedger.configure(
+    enabled=config.get("hedged_requests", False),
+    percentile=config.get("hedge_percentile", 0.95),
+    budget=config.get("hedge_budget", 0.1),
+)
+
+# 按模型选择分词器计算 token 数："tokenizers" 按模型名称前缀指定 HuggingFace 仓库名或 "tiktoken:<编码名>"，
+# 模型元数据中的 "tokenizer" 优先；本地没有缓存的 tokenizer.json 时默认不下载，近似计数
+tokenizer.configure(
+    overrides=config.get("tokenizers", {}),
+    allow_download=config.get("tokenizer_download", False),
+    cache_size=config.get("token_count_cache_size", 4096),
+)
+
+# 超出 token 预算的早期对话不再发送；开启 "context_summary" 后，还没有摘要的对话超过 "context_recent_tokens" 时，
+# 在后台用 "context_summary_model"（默认为当前模型）把较早的轮次并入摘要，摘要保存在对话记录中
+context_manager.configure(
+    enabled=config.get("context_summary", False),
+    model=config.get("context_summary_model", ""),
+    recent_tokens=config.get("context_recent_tokens", 4096),
+)
+
+# 多个 Ollama 主机：按负载和已加载的模型分配请求，失败时自动切换
+if "ollama_hosts" in config:
+    host_pool.set_hosts(config["ollama_hosts"])
+host_pool.start_health_checks(config.get("ollama_health_check_interval", 15))
+
+# 生成请求的排队：每个主机 / 模型同时进行的生成数上限、用户之间的排队策略，以及后台任务的并发数
+scheduler.configure(
+    max_per_host=config.get("max_inflight_per_host", 4),
+    max_per_model=config.get("max_inflight_per_model", 0),
+    policy=config.get("queue_policy", "fair"),
+    max_background=config.get("max_background_inflight", 1),
+    max_choices_per_host=config.get("max_choices_per_host", 2),
+)
+
+# 后台定期刷新 Ollama 模型列表；没有在 config.json 中固定可用模型时，MODELS 随之更新
+if "available_models" not in config:
+    model_registry.bind(presets.MODELS)
+model_refresh_interval = config.get("model_refresh_interval", 300)
+model_registry.start(model_refresh_interval)
+
+if presets.DEFAULT_MODEL_NAME and config.get("warmup_on_start", True):
+    warmup.warm_up_in_background(
+        presets.DEFAULT_MODEL_NAME, presets.MODEL_METADATA.peek(presets.DEFAULT_MODEL_NAME)["keep_alive"]
+    )
+
+# 流式输出时合并相邻的 chunk 再推送给界面：按帧间隔或累计字符数推送，结束或中断时立即推送
+frame_throttle.configure(
+    frame_interval=config.get("stream_frame_interval", 0.05),
+    flush_chars=config.get("stream_flush_chars", 200),
+)
+
+# temperature 为 0 时复用相同请求的回答
+response_cache.configure(
+    enabled=config.get("response_cache", False),
+    max_entries=config.get("response_cache_size", 256),
+    ttl=config.get("response_cache_ttl", 7 * 24 * 3600),
+)
+
+# 自动保存在后台合并写入：最后一次修改后 "history_save_delay" 秒写入，连续修改时最多推迟 "history_max_save_delay" 秒；
+# "history_save_delay" 为 0 时同步写入
+history_writer.configure(
+    save_delay=config.get("history_save_delay", 1.0),
+    max_save_delay=config.get("history_max_save_delay", 5.0),
+)
 
 groq_api_key = config.get("groq_api_key", "")
 os.environ["GROQ_API_KEY"] = groq_api_key
@@ -336,13 +452,16 @@ autobrowser = config.get("autobrowser", True)
 rename_model = config.get("rename_model", None)
 try:
     if rename_model is not None:
-        if rename_model in presets.MODELS:
-            presets.RENAME_MODEL = presets.MODELS.index(rename_model)
+        if rename_model in _startup_models:
+            presets.RENAME_MODEL = _startup_models.index(rename_model)
         else:
-            presets.RENAME_MODEL = presets.MODELS.index(next((k for k, v in presets.MODEL_METADATA.items() if v.get("model_name") == rename_model), None))
-        logging.info("默认命名模型设置：" + str(presets.MODELS[presets.RENAME_MODEL]))
+            presets.RENAME_MODEL = _startup_models.index(next((k for k, v in presets.MODEL_METADATA.items() if v.get("model_name") == rename_model), None))
+        logging.info("默认命名模型设置：" + str(_startup_models[presets.RENAME_MODEL]))
 except ValueError:
-    logging.error("你填写的默认命名模型" + rename_model + "不存在！请从下面的列表中挑一个填写：" + str(presets.MODELS))
+    logging.error("你填写的默认命名模型" + rename_model + "不存在！请从下面的列表中挑一个填写：" + str(_startup_models))
+presets.RENAME_MODEL_NAME = (
+    _startup_models[presets.RENAME_MODEL] if _startup_models and presets.RENAME_MODEL is not None else None
+)
 
 # avatar
 bot_avatar = config.get("bot_avatar", "default")
@@ -0,0 +1,395 @@
+# -*- coding:utf-8 -*-
+"""
+对话记录的日志式存储
+
+history/<user>/<name>.json 仍然是原来格式的完整快照，旧版的记录文件可以直接读取。
+每轮对话结束后不再重写整个 JSON，而是向 <name>.jsonl 追加一行记录：
+    {"snapshot": 快照编号, "keep": 保留前几条消息, "append": [新增的消息], "meta": {变化了的设置}}
+读取时在快照上依次重放属于它的记录。记录条数超过 COMPACT_RECORDS，或者日志比快照还大时，
+重新写一次快照并删除日志；快照换了编号，写快照后、删除日志前中断也不会重复重放旧的记录。
+chatbot 字段和 .md 文件只在需要时（下载、导出）根据 history 生成。
+
+自动保存由后台的 HistoryWriter 执行：同一个文件在 SAVE_DELAY 秒内的多次保存（拖动滑块、连续修改设置、
+刚结束的一轮对话）合并为一次写入，连续修改时最多推迟 MAX_SAVE_DELAY 秒。读取、导出、删除记录文件，
+切换对话和进程退出之前先写入待保存的内容。
+"""
+import atexit
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import deque
+
+COMPACT_RECORDS = 50  # 日志中的记录超过这个数目时合并成快照
+SAVE_DELAY = 1.0  # 最后一次保存请求之后等待的秒数，0 表示同步写入
+MAX_SAVE_DELAY = 5.0  # 连续的保存请求最多推迟写入的秒数
+MAX_SAMPLES = 200  # 写入耗时统计保留的最近样本数
+JOURNAL_SUFFIX = "l"  # <name>.json -> <name>.jsonl
+
+
+def journal_path(path):
+    return path + JOURNAL_SUFFIX
+
+
+def markdown_path(path):
+    return path[:-5] + ".md"
+
+
+def history_to_chatbot(history):
+    chatbot = []
+    i = 0
+    while i < len(history):
+        if history[i]["role"] == "image":
+            # Handle image
+            chatbot.append(((history[i]["content"], None), None))
+            i += 1
+        elif i + 1 < len(history) and history[i + 1]["role"] != "image":
+            # Handle user-assistant pair
+            chatbot.append((history[i]["content"], history[i + 1]["content"]))
+            i += 2
+        else:
+            # Handle unpaired message (could be at the end or before an image)
+            chatbot.append((history[i]["content"], None))
+            i += 1
+    return chatbot
+
+
+def render_markdown(data):
+    lines = [f"system: \n- {data['system']} \n"]
+    for message in data["history"]:
+        lines.append(f"\n{message['role']}: \n- {message['content']} \n")
+    return "".join(lines)
+
+
+def _copy(value):
+    # 消息和设置中的列表、字典可能被原地修改（例如补写 token 数），保存一份副本用于比较
+    return json.loads(json.dumps(value, ensure_ascii=False))
+
+
+def _write_atomic(path, text):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+
+class _Persisted:
+    """某个记录文件已经写入磁盘的状态，用来计算下一条日志记录"""
+
+    def __init__(self, snapshot_id, history, meta, snapshot_size):
+        self.snapshot_id = snapshot_id
+        self.history = _copy(history)  # 已写入的消息的副本，按值比较
+        self.meta = _copy(meta)
+        self.snapshot_size = snapshot_size
+        self.records = 0
+        self.journal_size = 0
+
+
+class HistoryStore:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.persisted = {}  # 记录文件路径 -> _Persisted
+
+    def write(self, path, history, meta):
+        """写入完整的快照并删除日志"""
+        path = os.path.abspath(path)
+        data = {"system": meta.get("system"), "history": history, "chatbot": history_to_chatbot(history)}
+        data.update((key, value) for key, value in meta.items() if key != "system")
+        data["snapshot"] = uuid.uuid4().hex
+        text = json.dumps(data, ensure_ascii=False, indent=4)
+        with self.lock:
+            _write_atomic(path, text)
+            try:
+                os.remove(journal_path(path))
+            except FileNotFoundError:
+                pass
+            self.persisted[path] = _Persisted(data["snapshot"], history, meta, len(text))
+
+    def append(self, path, history, meta):
+        """追加一条日志记录，只包含与上次写入相比变化的部分；没有写入过的文件写完整的快照"""
+        path = os.path.abspath(path)
+        with self.lock:
+            persisted = self.persisted.get(path)
+        if persisted is None or persisted.snapshot_id is None or not os.path.exists(path):
+            # 第一次保存，或者旧版的记录文件：写一次带编号的快照，之后追加日志
+            self.write(path, history, meta)
+            return
+        keep = 0
+        limit = min(len(history), len(persisted.history))
+        while keep < limit and history[keep] == persisted.history[keep]:
+            keep += 1
+        changed = {key: value for key, value in meta.items() if persisted.meta.get(key, object()) != value}
+        if keep == len(history) == len(persisted.history) and not changed:
+            return
+        if keep == 0 and persisted.history:
+            # 开头的消息被删除，整个记录都要重写
+            self.write(path, history, meta)
+            return
+        record = {"snapshot": persisted.snapshot_id, "keep": keep, "append": history[keep:]}
+        if changed:
+            record["meta"] = changed
+        line = json.dumps(record, ensure_ascii=False) + "\n"
+        with self.lock:
+            with open(journal_path(path), "a", encoding="utf-8") as f:
+                f.write(line)
+            persisted.history = persisted.history[:keep] + _copy(history[keep:])
+            persisted.meta.update(_copy(changed))
+            persisted.records += 1
+            persisted.journal_size += len(line)
+            compact = persisted.records > COMPACT_RECORDS or persisted.journal_size > persisted.snapshot_size
+        if compact:
+            self.write(path, history, meta)
+
+    def load(self, path):
+        """读取快照并重放日志，返回与原来的 JSON 格式相同的 dict"""
+        path = os.path.abspath(path)
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        snapshot_id = data.get("snapshot")
+        records = 0
+        journal_size = 0
+        if snapshot_id is not None:
+            try:
+                with open(journal_path(path), "r", encoding="utf-8") as f:
+                    lines = f.readlines()
+            except FileNotFoundError:
+                lines = []
+            for line in lines:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # 写到一半中断的最后一行
+                    logging.warning(f"跳过对话记录 {path} 中无法解析的日志")
+                    continue
+                if record.get("snapshot") != snapshot_id:
+                    continue
+                data["history"] = data["history"][:record["keep"]] + record["append"]
+                data.update(record.get("meta", {}))
+                records += 1
+                journal_size += len(line)
+            if records:
+                data["chatbot"] = history_to_chatbot(data["history"])
+        meta = {key: value for key, value in data.items() if key not in ("history", "chatbot", "snapshot")}
+        with self.lock:
+            persisted = _Persisted(snapshot_id, data["history"], meta, os.path.getsize(path))
+            persisted.records = records
+            persisted.journal_size = journal_size
+            self.persisted[path] = persisted
+        return data
+
+    def materialize(self, path, markdown=False):
+        """把日志合并进 JSON 快照（供下载等直接读取文件的场合），需要时同时生成 .md 文件"""
+        path = os.path.abspath(path)
+        with self.lock:
+            persisted = self.persisted.get(path)
+        if persisted is None:
+            self.load(path)
+            with self.lock:
+                persisted = self.persisted[path]
+        if persisted.records:
+            self.write(path, persisted.history, persisted.meta)
+        if markdown:
+            data = {"system": persisted.meta.get("system"), "history": persisted.history}
+            _write_atomic(markdown_path(path), render_markdown(data))
+
+    def delete(self, path):
+        """删除快照、日志和 .md 文件，返回快照是否存在"""
+        path = os.path.abspath(path)
+        with self.lock:
+            self.persisted.pop(path, None)
+        existed = os.path.exists(path)
+        for file_path in (path, journal_path(path), markdown_path(path)):
+            try:
+                os.remove(file_path)
+            except FileNotFoundError:
+                pass
+        return existed
+
+    def forget(self, path):
+        """文件被外部改写（例如上传覆盖）后调用，下次保存时重新写完整的快照"""
+        path = os.path.abspath(path)
+        with self.lock:
+            self.persisted.pop(path, None)
+
+    @staticmethod
+    def modified_time(path):
+        """快照和日志中较新的修改时间，用于按时间排列对话记录"""
+        times = [os.path.getctime(path)]
+        if os.path.exists(journal_path(path)):
+            times.append(os.path.getctime(journal_path(path)))
+        return max(times)
+
+
+def _percentile(samples, q):
+    ordered = sorted(samples)
+    return ordered[min(int(len(ordered) * q), len(ordered) - 1)] if ordered else None
+
+
+class _PendingSave:
+    def __init__(self, history, meta, now):
+        self.history = history
+        self.meta = meta
+        self.requested = now  # 第一次请求的时间，用于 MAX_SAVE_DELAY 和排队时间的统计
+        self.deadline = now + SAVE_DELAY
+        self.requests = 1
+
+    def update(self, history, meta, now):
+        self.history = history
+        self.meta = meta
+        self.deadline = min(now + SAVE_DELAY, self.requested + MAX_SAVE_DELAY)
+        self.requests += 1
+
+
+class HistoryWriter:
+    """后台合并写入对话记录的日志；所有写入都在 io_lock 内取出并执行，同一个文件的写入不会乱序"""
+
+    def __init__(self, store):
+        self.store = store
+        self.condition = threading.Condition()
+        self.io_lock = threading.Lock()
+        self.pending = {}  # 记录文件路径 -> _PendingSave
+        self.thread = None
+        self.closed = False
+        self.requests = 0
+        self.writes = 0
+        self.coalesced = 0  # 被之后的请求覆盖、没有单独写入的请求数
+        self.failures = 0
+        self.max_queue_depth = 0
+        self.write_seconds = deque(maxlen=MAX_SAMPLES)
+        self.queued_seconds = deque(maxlen=MAX_SAMPLES)
+
+    def configure(self, save_delay=None, max_save_delay=None):
+        global SAVE_DELAY, MAX_SAVE_DELAY
+        if save_delay is not None:
+            SAVE_DELAY = float(save_delay)
+        if max_save_delay is not None:
+            MAX_SAVE_DELAY = float(max_save_delay)
+
+    def submit(self, path, history, meta):
+        """请求保存 path；history 和 meta 是调用时的状态，之后同一个文件的请求会替换它们"""
+        path = os.path.abspath(path)
+        history = list(history)
+        if SAVE_DELAY <= 0 or self.closed:
+            with self.io_lock:
+                with self.condition:
+                    self.requests += 1
+                    # 还没有写入的请求被这次的状态覆盖
+                    self.pending.pop(path, None)
+                self._write(path, _PendingSave(history, meta, time.monotonic()))
+            return
+        now = time.monotonic()
+        with self.condition:
+            self.requests += 1
+            pending = self.pending.get(path)
+            if pending is None:
+                self.pending[path] = _PendingSave(history, meta, now)
+                self.max_queue_depth = max(self.max_queue_depth, len(self.pending))
+            else:
+                pending.update(history, meta, now)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name="history-writer", daemon=True)
+                self.thread.start()
+                atexit.register(self.close)
+            self.condition.notify()
+
+    def write(self, path, history, meta):
+        """同步写入完整的快照，丢弃 path 还没有写入的自动保存"""
+        path = os.path.abspath(path)
+        with self.io_lock:
+            with self.condition:
+                self.pending.pop(path, None)
+            self.store.write(path, history, meta)
+
+    def flush(self, path=None):
+        """立即写入待保存的内容；path 为记录文件时只写入该文件，为目录时写入目录下的文件，None 时全部写入"""
+        if path is not None:
+            path = os.path.abspath(path)
+        with self.io_lock:
+            with self.condition:
+                paths = [
+                    pending_path
+                    for pending_path in self.pending
+                    if path is None or pending_path == path or os.path.dirname(pending_path) == path
+                ]
+                saves = [(pending_path, self.pending.pop(pending_path)) for pending_path in paths]
+            for pending_path, pending in saves:
+                self._write(pending_path, pending)
+
+    def discard(self, path):
+        """记录文件将被删除时调用，丢弃还没有写入的自动保存"""
+        path = os.path.abspath(path)
+        with self.io_lock:
+            with self.condition:
+                self.pending.pop(path, None)
+
+    def close(self):
+        """进程退出时调用，写入所有待保存的内容"""
+        self.closed = True
+        with self.condition:
+            self.condition.notify()
+        self.flush()
+        logging.debug(f"对话记录写入统计：{self.stats()}")
+
+    def _write(self, path, pending):
+        start = time.monotonic()
+        try:
+            self.store.append(path, pending.history, pending.meta)
+        except Exception as e:
+            with self.condition:
+                self.failures += 1
+            logging.error(f"保存对话记录 {path} 失败：{e}")
+            return
+        end = time.monotonic()
+        with self.condition:
+            self.writes += 1
+            self.coalesced += pending.requests - 1
+            self.write_seconds.append(end - start)
+            self.queued_seconds.append(start - pending.requested)
+        if end - start > 0.5:
+            logging.debug(f"保存对话记录 {path} 耗时 {end - start:.2f} 秒，合并了 {pending.requests} 次保存")
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while not self.closed:
+                    now = time.monotonic()
+                    due = [path for path, pending in self.pending.items() if pending.deadline <= now]
+                    if due:
+                        break
+                    if self.pending:
+                        self.condition.wait(min(pending.deadline for pending in self.pending.values()) - now)
+                    else:
+                        self.condition.wait()
+                if self.closed:
+                    return
+            for path in due:
+                with self.io_lock:
+                    with self.condition:
+                        pending = self.pending.get(path)
+                        if pending is None or pending.deadline > time.monotonic():
+                            # 已经被 flush 写入，或者又收到了新的保存请求
+                            continue
+                        del self.pending[path]
+                    self._write(path, pending)
+
+    def stats(self):
+        with self.condition:
+            write_seconds = list(self.write_seconds)
+            queued_seconds = list(self.queued_seconds)
+            return {
+                "requests": self.requests,
+                "writes": self.writes,
+                "coalesced": self.coalesced,
+                "failures": self.failures,
+                "queue_depth": len(self.pending),
+                "max_queue_depth": self.max_queue_depth,
+                "p50_write_seconds": _percentile(write_seconds, 0.5),
+                "p99_write_seconds": _percentile(write_seconds, 0.99),
+                "p99_queued_seconds": _percentile(queued_seconds, 0.99),
+            }
+
+
+history_store = HistoryStore()
+history_writer = HistoryWriter(history_store)
@@ -5,25 +5,51 @@ import requests  # 用于发送HTTP请求
 import json  # 用于JSON数据解析和序列化
 from typing import List, Tuple, Generator, Dict, Any, Optional  # 类型提示支持
 
+from .http_pool import get_session  # 进程级共享连接池
+from .host_pool import host_pool, OllamaHost  # 多主机调度
+
 
 class OllamaClient:
     """Ollama API客户端封装"""
 
-    def __init__(self, base_url):
+    def __init__(self, base_url=None):
         """
         初始化Ollama客户端
 
+        base_url 为空时使用 host_pool 中的全部主机，请求失败会自动切换到下一台
         """
         self.base_url = base_url  # 存储API基础URL
-        self.models_endpoint = f"{base_url}/api/tags"  # 模型列表API端点
-        self.chat_endpoint = f"{base_url}/api/chat"  # 聊天API端点
+        self.models_endpoint = "/api/tags"  # 模型列表API端点
+        self.chat_endpoint = "/api/chat"  # 聊天API端点
+
+    def _hosts(self, model=None) -> List[OllamaHost]:
+        """按优先级排列的候选主机"""
+        if self.base_url:
+            return [OllamaHost(self.base_url)]
+        return host_pool.candidates(model)
+
+    def _request(self, method: str, path: str, model: Optional[str] = None, **kwargs):
+        """依次尝试候选主机，返回第一个成功的响应和对应主机"""
+        error = None
+        for host in self._hosts(model):
+            url = host.url(path)
+            try:
+                # 复用同一 host 的 keep-alive 连接
+                response = get_session(url).request(method, url, **kwargs)
+                response.raise_for_status()  # 检查HTTP错误
+            except requests.exceptions.RequestException as e:
+                host_pool.mark_failure(host)
+                error = e
+                continue
+            host_pool.mark_success(host)
+            return response, host
+        raise error or requests.exceptions.ConnectionError("没有可用的 Ollama 主机")
 
     def get_local_models(self) -> List[str]:
         """获取本地可用模型列表"""
         try:
             # 发送GET请求获取模型列表
-            response = requests.get(self.models_endpoint)
-            response.raise_for_status()  # 检查HTTP错误
+            response, _ = self._request("GET", self.models_endpoint)
             data = response.json()  # 解析JSON响应
             # 从响应中提取模型名称列表
             return [model['name'] for model in data.get('models', [])]
@@ -93,23 +119,26 @@ class OllamaClient:
     def _stream_response(self, payload: Dict[str, Any]) -> Generator[str, None, None]:
         """处理流式响应"""
         # 发送流式POST请求
-        with requests.post(self.chat_endpoint, json=payload, stream=True) as response:
-            response.raise_for_status()  # 检查HTTP错误
-            partial_message = ""  # 存储部分消息
-            # 逐行读取流式响应
-            for line in response.iter_lines():
-                if line:
-                    # 解析JSON响应块
-                    chunk = json.loads(line.decode('utf-8'))
-                    if "message" in chunk and "content" in chunk["message"]:
-                        content = chunk["message"]["content"]  # 获取内容
-                        partial_message += content  # 追加到部分消息
-                        yield partial_message  # 生成当前完整消息
+        response, host = self._request("POST", self.chat_endpoint, model=payload["model"], json=payload, stream=True)
+        host_pool.begin(host)  # 流读完之前都算作进行中的请求
+        try:
+            with response:
+                partial_message = ""  # 存储部分消息
+                # 逐行读取流式响应
+                for line in response.iter_lines():
+                    if line:
+                        # 解析JSON响应块
+                        chunk = json.loads(line.decode('utf-8'))
+                        if "message" in chunk and "content" in chunk["message"]:
+                            content = chunk["message"]["content"]  # 获取内容
+                            partial_message += content  # 追加到部分消息
+                            yield partial_message  # 生成当前完整消息
+        finally:
+            host_pool.end(host)
 
     def _full_response(self, payload: Dict[str, Any]) -> str:
         """处理非流式响应"""
-        response = requests.post(self.chat_endpoint, json=payload)  # 发送普通请求
-        response.raise_for_status()  # 检查HTTP错误
+        response, _ = self._request("POST", self.chat_endpoint, model=payload["model"], json=payload)  # 发送普通请求
         # 返回完整响应消息内容
         return response.json()["message"]["content"]
 
@@ -0,0 +1,114 @@
+from __future__ import annotations
+from .OllamaVision import OllamaVisionClient
+from .stream_decoder import NDJSON, iter_stream_deltas, aiter_stream_deltas
+import json
+from ..utils import *
+
+
+class OllamaChatClient(OllamaVisionClient):
+    """使用 Ollama 原生 /api/chat 接口，token 数和耗时直接取服务端统计"""
+    chat_path = "/api/chat"
+
+    def get_answer_at_once(self):
+        response = self._get_response()
+        response = json.loads(response.text)
+        content = response["message"]["content"]
+        self.last_usage = {key: value for key, value in response.items() if key.endswith(("_count", "_duration"))}
+        total_token_count = response.get("prompt_eval_count", 0) + response.get("eval_count", 0)
+        return content, total_token_count
+
+    def count_token(self, user_input):
+        # 真实的 prompt token 数在回答结束后由 prompt_eval_count 给出，这里不再调用 tiktoken
+        return 0
+
+    def _get_native_history(self, messages):
+        history = []
+        image_buffer = []
+        for message in messages:
+            if message["role"] == "user":
+                content = message["content"]
+                if type(content) == list:
+                    content = content[0]["text"]
+                user_message = construct_user(content)
+                if image_buffer:
+                    user_message["images"] = [self.get_base64_image(image) for image in image_buffer]
+                    image_buffer = []
+                history.append(user_message)
+            elif message["role"] == "assistant":
+                history.append(message)
+            elif message["role"] == "image":
+                image_buffer.append(message["content"])
+        return history
+
+    def _build_chat_request(self, stream=False):
+        system_prompt, messages = self._packed_context()
+        history = self._get_native_history(messages)
+
+        logging.debug(colorama.Fore.YELLOW +
+                      f"{history}" + colorama.Fore.RESET)
+        headers = {
+            "Content-Type": "application/json",
+        }
+
+        if system_prompt is not None:
+            history = [construct_system(system_prompt), *history]
+
+        options = {
+            "temperature": self.temperature,
+            "top_p": self.top_p,
+        }
+        if self.max_generation_token:
+            options["num_predict"] = self.max_generation_token
+        if self.presence_penalty:
+            options["presence_penalty"] = self.presence_penalty
+        if self.frequency_penalty:
+            options["frequency_penalty"] = self.frequency_penalty
+        if self.stop_sequence:
+            options["stop"] = self.stop_sequence
+
+        payload = {
+            "model": self.model_name,
+            "messages": history,
+            "options": options,
+            "stream": stream,
+        }
+        if self.keep_alive is not None:
+            payload["keep_alive"] = self.keep_alive
+
+        if stream:
+            timeout = TIMEOUT_STREAMING
+        else:
+            timeout = TIMEOUT_ALL
+
+        return headers, payload, timeout
+
+    def _decode_chat_response(self, response):
+        return iter_stream_deltas(response, NDJSON)
+
+    def _decode_chat_response_async(self, response):
+        return aiter_stream_deltas(response, NDJSON)
+
+    def _single_query_payload(self, history, temperature=1.0, model=None):
+        return {
+            "model": model or RENAME_MODEL_NAME or self.model_name,
+            "messages": history,
+            "options": {"temperature": temperature},
+            "stream": False,
+        }
+
+    def _single_query_at_once(self, history, temperature=1.0, model=None):
+        payload = self._single_query_payload(history, temperature, model)
+
+        with retrieve_proxy():
+            response = self._post_to_hosts(
+                self.chat_path,
+                model=payload["model"],
+                json=payload,
+                timeout=TIMEOUT_ALL,
+            )
+
+        return response
+
+    def _parse_single_query(self, response):
+        response = json.loads(response.text)
+        return response["message"]["content"]
@@ -1,14 +1,64 @@
 from __future__ import annotations
 from .base_model import BaseLLMModel
+from .context_manager import format_transcript
+from .hedging import hedger
+from .host_pool import host_pool
+from .scheduler import POLL_INTERVAL, scheduler
+from .http_pool import get_session, get_async_client
+from .latency import latency_tracker, stream_watchdog
+from .response_cache import REPLAY_CHUNK_SIZE, response_cache
+from .stream_answer import StreamAnswer
+from .stream_decoder import iter_stream_deltas, aiter_stream_deltas
+import asyncio
+import itertools
 import json
+import queue
 import time
 import traceback
+from threading import Thread
 from math import ceil
 from ..config import sensitive_id, usage_limit
 from ..utils import *
 
 
+class _StreamState:
+    """一次流式生成的中间状态"""
+
+    def __init__(self, host, start_time):
+        self.host = host
+        self.start_time = start_time
+        self.timeouts = None
+        self.watch = None
+        self.last_token_time = None
+        self.answer = StreamAnswer()
+
+    @property
+    def timed_out(self):
+        return self.watch is not None and self.watch.timed_out
+
+
+class _HedgeLeg:
+    """对冲请求中发往一台主机的一路请求"""
+
+    def __init__(self, host):
+        self.host = host
+        self.start_time = time.monotonic()
+        self.response = None
+        self.cancelled = False
+        self.finished = False  # 已经失败或胜出，主机的占用已经处理
+        self.ticket = None  # 对冲的一路在调度器中的名额，原请求使用生成本身的 ticket
+
+
+async def _aprepend(received, deltas):
+    for delta in received:
+        yield delta
+    async for delta in deltas:
+        yield delta
+
+
 class OllamaVisionClient(BaseLLMModel):
+    chat_path = "/v1/chat/completions"
+
     def __init__(
             self,
             model_name,
@@ -27,38 +77,402 @@ class OllamaVisionClient(BaseLLMModel):
                 self.api_host)
         else:
             self.api_host, self.chat_completion_url, self.images_completion_url, self.openai_api_base, self.balance_api_url, self.usage_api_url = shared.state.api_host, shared.state.chat_completion_url, shared.state.images_completion_url, shared.state.openai_api_base, shared.state.balance_api_url, shared.state.usage_api_url
+        self._stream_host = None  # 正在流式生成的主机，流结束时释放
+        self._stream_ticket = None  # 对冲请求胜出时它在调度器中的名额，与 _stream_host 一起释放
         self._refresh_header()
 
     # TODO 获取回答
     def get_answer_stream_iter(self):
-        response = self._get_response(stream=True)
-
-        if response is not None:
-            iter = self._decode_chat_response(response)
-            partial_text = ""
-            reasoning_text = ""
-            reasoning_start_time = None
-
-            for content_delta, reasoning_delta in iter:
-                if content_delta:
-                    partial_text += content_delta
-
-                if reasoning_delta:
-                    if reasoning_start_time is None:
-                        reasoning_start_time = time.time()
-                        elapsed_seconds = 0
-                    reasoning_text += reasoning_delta
-                if reasoning_text:
-                    if reasoning_delta:
-                        elapsed_seconds = int(time.time() - reasoning_start_time)
-                        reasoning_preview = reasoning_text[-20:].replace("\n", "")
-                        yield f'<details open>\n<summary>Thinking ({elapsed_seconds}s)</summary>\n{reasoning_text}</details>\n\n' + partial_text
-                    else:
-                        yield f'<details>\n<summary>Thought for {elapsed_seconds} s</summary>\n{reasoning_text}</details>\n\n' + partial_text
-                else:
-                    yield partial_text
-        else:
-            yield STANDARD_ERROR_MSG + GENERAL_ERROR_MSG
+        cache_key = self._response_cache_key()
+        cached = response_cache.get(cache_key)
+        if cached is not None:
+            yield from self._replay_cached_answer(cached)
+            return
+
+        excluded = []  # 超时的主机，重试时跳过
+        while True:
+            response, deltas, start_time = self._open_stream(excluded)
+            if response is None:
+                if not self.interrupted:
+                    yield STANDARD_ERROR_MSG + GENERAL_ERROR_MSG
+                return
+
+            state = self._begin_stream(response, start_time)
+            try:
+                for delta in deltas:
+                    answer = self._consume_delta(state, delta)
+                    if answer is not None:
+                        yield answer
+                if not self.interrupted and not state.timed_out:
+                    self._store_cached_answer(cache_key, state.answer)
+            except Exception:
+                # 用户中断或等待超时时响应被关闭，读取报错属于正常结束
+                if not self.interrupted and not state.timed_out:
+                    self._release_stream_host(ok=False)
+                    raise
+            finally:
+                self._end_stream(state)
+                response.close()
+            if not self._retry_after_timeout(state, excluded):
+                return
+
+    async def get_answer_stream_iter_async(self):
+        cache_key = self._response_cache_key()
+        cached = response_cache.get(cache_key)
+        if cached is not None:
+            for partial_text in self._replay_cached_answer(cached):
+                yield partial_text
+            return
+
+        excluded = []
+        while True:
+            response, deltas, start_time = await self._open_stream_async(excluded)
+            if response is None:
+                if not self.interrupted:
+                    yield STANDARD_ERROR_MSG + GENERAL_ERROR_MSG
+                return
+
+            state = self._begin_stream(response, start_time, is_async=True)
+            try:
+                async for delta in deltas:
+                    answer = self._consume_delta(state, delta)
+                    if answer is not None:
+                        yield answer
+                if not self.interrupted and not state.timed_out:
+                    self._store_cached_answer(cache_key, state.answer)
+            except Exception:
+                if not self.interrupted and not state.timed_out:
+                    self._release_stream_host(ok=False)
+                    raise
+            finally:
+                self._end_stream(state)
+                await response.aclose()
+            if not self._retry_after_timeout(state, excluded):
+                return
+
+    def _hedge_delay(self, candidates):
+        """需要对冲时返回等待的秒数，否则返回 None"""
+        if len(candidates) < 2 or not hedger.enabled_for(self.hedge):
+            return None
+        return hedger.delay(candidates[0].base_url, self.model_name)
+
+    def _open_stream(self, exclude):
+        """发送流式请求，返回 (response, deltas, start_time)，没有可用的主机时 response 为 None"""
+        start_time = time.monotonic()
+        candidates = self._candidate_hosts(self.model_name, exclude)
+        delay = self._hedge_delay(candidates)
+        if delay is not None:
+            return self._hedged_stream(candidates[:2], delay)
+        response = self._get_response(stream=True, exclude=exclude)
+        if response is None:
+            return None, None, start_time
+        return response, self._decode_chat_response(response), start_time
+
+    async def _open_stream_async(self, exclude):
+        start_time = time.monotonic()
+        candidates = self._candidate_hosts(self.model_name, exclude)
+        delay = self._hedge_delay(candidates)
+        if delay is not None:
+            return await self._hedged_stream_async(candidates[:2], delay)
+        response = await self._get_response_async(stream=True, exclude=exclude)
+        if response is None:
+            return None, None, start_time
+        return response, self._decode_chat_response_async(response), start_time
+
+    def _hedged_stream(self, hosts, delay):
+        """先向 hosts[0] 发送请求，delay 秒后仍没有输出时再向 hosts[1] 发送，先产出 token 的一方胜出"""
+        headers, payload, timeout = self._build_chat_request(stream=True)
+        entry = hedger.begin()
+        results = queue.Queue()
+        legs = []
+
+        def start(host, ticket=None):
+            leg = _HedgeLeg(host)
+            leg.ticket = ticket
+            host_pool.begin(host)
+            legs.append(leg)
+            Thread(
+                target=self._run_hedge_leg, args=(leg, headers, payload, timeout, results), daemon=True
+            ).start()
+
+        winner = winner_deltas = None
+        hedged = False
+        with retrieve_proxy():
+            start(hosts[0])
+            deadline = legs[0].start_time + delay
+            running = 1
+            while running and not self.interrupted:
+                wait = self._hedge_wait(legs, deadline)
+                try:
+                    leg, deltas, error = results.get(timeout=wait)
+                except queue.Empty:
+                    ticket = self._admit_hedge(legs, deadline, hosts[1], entry)
+                    if ticket is not None:
+                        logging.info(f"{hosts[0].base_url} 超过 {delay:.1f} 秒没有输出，向 {hosts[1].base_url} 发送对冲请求")
+                        hedged = True
+                        start(hosts[1], ticket)
+                        running += 1
+                    continue
+                running -= 1
+                leg.finished = True
+                if error is None:
+                    winner, winner_deltas = leg, deltas
+                    break
+                logging.warning(f"请求 Ollama 主机 {leg.host.base_url} 失败：{error}")
+                host_pool.end(leg.host, ok=False)
+                self._release_hedge_ticket(leg)
+                if len(legs) == 1:
+                    # 原请求失败时直接换另一台主机，不占用对冲预算
+                    start(hosts[1])
+                    running += 1
+        for leg in legs:
+            if leg is not winner:
+                self._cancel_hedge_leg(leg)
+                if leg.response is not None:
+                    leg.response.close()
+        return self._finish_hedge(legs, winner, winner_deltas, hedged)
+
+    async def _hedged_stream_async(self, hosts, delay):
+        headers, payload, timeout = self._build_chat_request(stream=True)
+        entry = hedger.begin()
+        legs = {}
+
+        def start(host, ticket=None):
+            leg = _HedgeLeg(host)
+            leg.ticket = ticket
+            host_pool.begin(host)
+            task = asyncio.create_task(self._run_hedge_leg_async(leg, headers, payload, timeout))
+            # 被放弃的一路出错时不需要取回异常
+            task.add_done_callback(lambda task: task.cancelled() or task.exception())
+            legs[task] = leg
+            return task
+
+        winner = winner_deltas = None
+        hedged = False
+        running = {start(hosts[0])}
+        deadline = time.monotonic() + delay
+        while running and winner is None and not self.interrupted:
+            wait = self._hedge_wait(legs, deadline)
+            done, running = await asyncio.wait(running, timeout=wait, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                ticket = self._admit_hedge(legs, deadline, hosts[1], entry)
+                if ticket is not None:
+                    logging.info(f"{hosts[0].base_url} 超过 {delay:.1f} 秒没有输出，向 {hosts[1].base_url} 发送对冲请求")
+                    hedged = True
+                    running.add(start(hosts[1], ticket))
+                continue
+            for task in done:
+                leg = legs[task]
+                if task.exception() is not None:
+                    logging.warning(f"请求 Ollama 主机 {leg.host.base_url} 失败：{task.exception()}")
+                    leg.finished = True
+                    host_pool.end(leg.host, ok=False)
+                    self._release_hedge_ticket(leg)
+                    if len(legs) == 1:
+                        running.add(start(hosts[1]))
+                elif winner is None:
+                    # 两路同时产出 token 时，另一路同样作废
+                    winner, winner_deltas = leg, task.result()
+                    leg.finished = True
+        for task, leg in legs.items():
+            if leg is not winner:
+                task.cancel()
+                self._cancel_hedge_leg(leg)
+                if task.done() and leg.response is not None:
+                    await leg.response.aclose()
+        return self._finish_hedge(list(legs.values()), winner, winner_deltas, hedged)
+
+    @staticmethod
+    def _hedge_wait(legs, deadline):
+        # 到达对冲时间点之前醒来一次；之后（包括预算不足暂不对冲时）按 POLL_INTERVAL 检查
+        remaining = deadline - time.monotonic()
+        if len(legs) == 1 and remaining > 0:
+            return min(POLL_INTERVAL, remaining)
+        return POLL_INTERVAL
+
+    def _run_hedge_leg(self, leg, headers, payload, timeout, results):
+        """在线程中发送请求并读到首个 token，结果放入 results"""
+        url = leg.host.url(self.chat_path)
+        try:
+            leg.response = get_session(url).post(
+                url, headers=headers, json=payload, stream=True,
+                timeout=self._request_timeout(leg.host, self.model_name, True, timeout),
+            )
+            if leg.cancelled:
+                leg.response.close()
+                return
+            deltas = self._decode_chat_response(leg.response)
+            latency_tracker.record(leg.host.base_url, self.model_name, "connect", time.monotonic() - leg.start_time)
+            if leg.response.status_code >= 400:
+                raise Exception(f"HTTP {leg.response.status_code}")
+            received = []
+            for delta in deltas:
+                received.append(delta)
+                if delta.content or delta.reasoning:
+                    break
+        except Exception as e:
+            if leg.response is not None:
+                leg.response.close()
+            results.put((leg, None, e))
+            return
+        results.put((leg, itertools.chain(received, deltas), None))
+
+    async def _run_hedge_leg_async(self, leg, headers, payload, timeout):
+        url = leg.host.url(self.chat_path)
+        client = get_async_client(url)
+        connect_timeout, read_timeout = self._request_timeout(leg.host, self.model_name, True, timeout)
+        request = client.build_request(
+            "POST", url, headers=headers, json=payload,
+            timeout=(connect_timeout, read_timeout, read_timeout, connect_timeout),
+        )
+        leg.response = await client.send(request, stream=True)
+        try:
+            deltas = self._decode_chat_response_async(leg.response)
+            latency_tracker.record(leg.host.base_url, self.model_name, "connect", time.monotonic() - leg.start_time)
+            if leg.response.status_code >= 400:
+                raise Exception(f"HTTP {leg.response.status_code}")
+            received = []
+            async for delta in deltas:
+                received.append(delta)
+                if delta.content or delta.reasoning:
+                    break
+        except BaseException:
+            # 出错或被取消（对冲失败的一方）时关闭连接
+            await leg.response.aclose()
+            raise
+        return _aprepend(received, deltas)
+
+    def _admit_hedge(self, legs, deadline, host, entry):
+        """到达对冲时间点时为对冲的一路申请调度器名额，不等待；主机已满或超出对冲预算时返回 None"""
+        if len(legs) != 1 or time.monotonic() < deadline:
+            return None
+        group = self._ticket.group if self._ticket is not None else None
+        ticket = scheduler.try_admit(self.user_name, self.model_name, host.base_url, group=group)
+        if ticket is None:
+            return None
+        if not hedger.try_hedge(entry):
+            scheduler.release(ticket)
+            return None
+        return ticket
+
+    @staticmethod
+    def _release_hedge_ticket(leg):
+        ticket, leg.ticket = leg.ticket, None
+        if ticket is not None:
+            scheduler.release(ticket)
+
+    @classmethod
+    def _cancel_hedge_leg(cls, leg):
+        """作废没有胜出的一路请求，结束主机占用并释放调度器名额（取消不算主机故障）；连接由调用方关闭"""
+        leg.cancelled = True
+        if not leg.finished:
+            leg.finished = True
+            host_pool.end(leg.host, ok=True)
+        cls._release_hedge_ticket(leg)
+
+    def _finish_hedge(self, legs, winner, deltas, hedged):
+        start_time = legs[0].start_time
+        if winner is None:
+            return None, None, start_time
+        self._hold_host(winner.host, True, model=self.model_name)
+        # 对冲的一路胜出时，它的名额保留到流结束
+        self._stream_ticket, winner.ticket = winner.ticket, None
+        self.chat_completion_url = winner.host.url(self.chat_path)
+        ttft = time.monotonic() - start_time
+        hedge_won = hedged and winner is not legs[0]
+        hedger.record(ttft, legs[0].host.base_url, self.model_name, primary_wait=ttft if hedge_won else None)
+        if hedged:
+            logging.info(f"对冲请求由 {winner.host.base_url} 胜出：{hedger.stats()}")
+        # 首个 token 的时间从胜出的一路开始计算，避免对冲请求的 TTFT 统计偏大
+        return winner.response, deltas, winner.start_time
+
+    def _begin_stream(self, response, start_time, is_async=False):
+        """登记流式响应，并按该主机上该模型的历史延迟开始超时监控"""
+        self._set_active_stream(response, is_async)
+        state = _StreamState(self._stream_host, start_time)
+        if state.host is not None:
+            state.timeouts = latency_tracker.timeouts(state.host.base_url, self.model_name)
+            remaining = max(state.timeouts.first_token - (time.monotonic() - start_time), 1)
+            loop = asyncio.get_running_loop() if is_async else None
+            state.watch = stream_watchdog.watch(response, remaining, loop)
+        return state
+
+    def _end_stream(self, state):
+        if state.watch is not None:
+            stream_watchdog.unwatch(state.watch)
+        self._clear_active_stream()
+        self._release_stream_host(ok=not state.timed_out)
+
+    def _consume_delta(self, state, delta):
+        """把一个 StreamDelta 追加到 state.answer 并返回它；没有新内容时返回 None"""
+        if delta.usage:
+            self.last_usage = delta.usage
+        if not (delta.content or delta.reasoning):
+            return None
+
+        now = time.monotonic()
+        if state.watch is not None:
+            if state.last_token_time is None:
+                latency_tracker.record(state.host.base_url, self.model_name, "ttft", now - state.start_time)
+            else:
+                latency_tracker.record(state.host.base_url, self.model_name, "gap", now - state.last_token_time)
+            state.watch.touch(state.timeouts.idle)
+        state.last_token_time = now
+
+        if delta.content:
+            state.answer.add_content(delta.content)
+        if delta.reasoning:
+            state.answer.add_reasoning(delta.reasoning)
+        return state.answer
+
+    def _retry_after_timeout(self, state, excluded):
+        """等待输出超时后，如果还有其他主机可用则重新生成"""
+        if not state.timed_out or self.interrupted:
+            return False
+        excluded.append(state.host)
+        if not host_pool.candidates(self.model_name, exclude=excluded):
+            logging.warning(f"{state.host.base_url} 上的模型 {self.model_name} 输出超时，没有其他主机可以重试")
+            return False
+        logging.warning(f"{state.host.base_url} 上的模型 {self.model_name} 输出超时，换一台主机重新生成")
+        return True
+
+    def _response_cache_key(self):
+        """只缓存 temperature 为 0 的确定性请求"""
+        if not response_cache.enabled or self.temperature != 0:
+            return None
+        system_prompt, messages = self._packed_context()
+        if system_prompt is not None:
+            messages = [construct_system(system_prompt), *messages]
+        params = {
+            "api": self.chat_path,
+            "top_p": self.top_p,
+            "stop": self.stop_sequence,
+            "max_tokens": self.max_generation_token,
+            "presence_penalty": self.presence_penalty,
+            "frequency_penalty": self.frequency_penalty,
+            "logit_bias": self.logit_bias,
+        }
+        return response_cache.make_key(self.model_name, messages, params)
+
+    def _store_cached_answer(self, cache_key, answer):
+        if cache_key is None or not answer.content:
+            return
+        response_cache.put(cache_key, {
+            "content": answer.content,
+            "reasoning": answer.reasoning,
+            "elapsed": answer.elapsed_seconds,
+            "usage": self.last_usage,
+        })
+
+    def _replay_cached_answer(self, cached):
+        """按流式输出的节奏重放缓存的回答，界面表现与真实生成一致"""
+        logging.info(f"命中回答缓存：{response_cache.stats()}")
+        self.last_usage = cached.get("usage")
+        content = cached["content"]
+        answer = StreamAnswer(cached.get("reasoning", ""), cached.get("elapsed", 0))
+        for start in range(0, len(content), REPLAY_CHUNK_SIZE):
+            answer.add_content(content[start:start + REPLAY_CHUNK_SIZE])
+            yield answer
 
     def get_answer_at_once(self):
         response = self._get_response()
@@ -68,13 +482,10 @@ class OllamaVisionClient(BaseLLMModel):
         return content, total_token_count
 
     def count_token(self, user_input):
-        input_token_count = count_token(construct_user(user_input))
+        messages = [construct_user(user_input)]
         if self.system_prompt is not None and len(self.all_token_counts) == 0:
-            system_prompt_token_count = count_token(
-                construct_system(self.system_prompt)
-            )
-            return input_token_count + system_prompt_token_count
-        return input_token_count
+            messages.append(construct_system(self.system_prompt))
+        return sum(count_token_batch(messages, self.model_name, self.tokenizer))
 
     def count_image_tokens(self, width: int, height: int):
         h = ceil(height / 512)
@@ -120,15 +531,14 @@ class OllamaVisionClient(BaseLLMModel):
             status_text = STANDARD_ERROR_MSG + READ_TIMEOUT_MSG + ERROR_RETRIEVE_MSG
             return status_text
         except Exception as e:
-            import traceback
             traceback.print_exc()
             logging.error(i18n("获取API使用情况失败:") + str(e))
             return STANDARD_ERROR_MSG + ERROR_RETRIEVE_MSG
 
-    def _get_gpt4v_style_history(self):
+    def _get_gpt4v_style_history(self, messages):
         history = []
         image_buffer = []
-        for message in self.history:
+        for message in messages:
             if message["role"] == "user":
                 content = []
                 if image_buffer:
@@ -153,11 +563,10 @@ class OllamaVisionClient(BaseLLMModel):
                 image_buffer.append(message["content"])
         return history
 
-    @shared.state.switching_api_key  # 在不开启多账号模式的时候，这个装饰器不会起作用
-    def _get_response(self, stream=False):
+    def _build_chat_request(self, stream=False):
         openai_api_key = self.api_key
-        system_prompt = self.system_prompt
-        history = self._get_gpt4v_style_history()
+        system_prompt, messages = self._packed_context()
+        history = self._get_gpt4v_style_history(messages)
 
         logging.debug(colorama.Fore.YELLOW +
                       f"{history}" + colorama.Fore.RESET)
@@ -190,30 +599,124 @@ class OllamaVisionClient(BaseLLMModel):
             payload["logit_bias"] = self.encoded_logit_bias()
         if self.user_identifier:
             payload["user"] = self.user_identifier
+        if self.keep_alive is not None:
+            # Ollama 的 /v1 接口同样接受 keep_alive，不发送时每次请求都会回到服务端默认的 5 分钟
+            payload["keep_alive"] = self.keep_alive
 
         if stream:
             timeout = TIMEOUT_STREAMING
         else:
             timeout = TIMEOUT_ALL
 
-        #  TODO 暂时写死
+        return headers, payload, timeout
 
-        # self.chat_completion_url = "http://172.32.19.13:11434/v1/chat/completions"
-        self.chat_completion_url = CHAT_COMPLETION_URL
+    @shared.state.switching_api_key  # 在不开启多账号模式的时候，这个装饰器不会起作用
+    def _get_response(self, stream=False, exclude=()):
+        headers, payload, timeout = self._build_chat_request(stream)
 
         with retrieve_proxy():
+            return self._post_to_hosts(
+                self.chat_path,
+                model=self.model_name,
+                stream=stream,
+                exclude=exclude,
+                headers=headers,
+                json=payload,
+                timeout=timeout,
+            )
+
+    async def _get_response_async(self, stream=False, exclude=()):
+        headers, payload, timeout = self._build_chat_request(stream)
+
+        candidates = self._candidate_hosts(self.model_name, exclude)
+        for index, host in enumerate(candidates):
+            url = host.url(self.chat_path)
+            client = get_async_client(url)
+            connect_timeout, read_timeout = self._request_timeout(host, self.model_name, stream, timeout)
+            host_pool.begin(host)
+            request_start = time.monotonic()
             try:
-                response = requests.post(
-                    self.chat_completion_url,
-                    headers=headers,
-                    json=payload,
-                    stream=stream,
-                    timeout=timeout,
+                request = client.build_request(
+                    "POST", url, headers=headers, json=payload,
+                    timeout=(connect_timeout, read_timeout, read_timeout, connect_timeout),
                 )
-            except:
-                traceback.print_exc()
-                return None
-        return response
+                response = await client.send(request, stream=stream)
+            except Exception as e:
+                logging.warning(f"请求 Ollama 主机 {host.base_url} 失败：{e}")
+                host_pool.end(host, ok=False)
+                continue
+            if self._should_failover(response.status_code) and index < len(candidates) - 1:
+                logging.warning(f"Ollama 主机 {host.base_url} 返回 {response.status_code}，尝试下一台主机")
+                await response.aclose()
+                host_pool.end(host, ok=response.status_code < 500)
+                continue
+            latency_tracker.record(host.base_url, self.model_name, "connect", time.monotonic() - request_start)
+            self._hold_host(host, stream, ok=response.status_code < 500, model=self.model_name)
+            self.chat_completion_url = url
+            return response
+        return None
+
+    def _post_to_hosts(self, path, model=None, stream=False, exclude=(), timeout=TIMEOUT_ALL, **kwargs):
+        """按 host_pool 给出的顺序发送请求，连接失败、超时或主机出错时自动换下一台"""
+        candidates = self._candidate_hosts(model, exclude)
+        for index, host in enumerate(candidates):
+            url = host.url(path)
+            host_pool.begin(host)
+            request_start = time.monotonic()
+            try:
+                response = get_session(url).post(
+                    url, stream=stream, timeout=self._request_timeout(host, model, stream, timeout), **kwargs
+                )
+            except requests.exceptions.RequestException as e:
+                logging.warning(f"请求 Ollama 主机 {host.base_url} 失败：{e}")
+                host_pool.end(host, ok=False)
+                continue
+            if self._should_failover(response.status_code) and index < len(candidates) - 1:
+                logging.warning(f"Ollama 主机 {host.base_url} 返回 {response.status_code}，尝试下一台主机")
+                response.close()
+                host_pool.end(host, ok=response.status_code < 500)
+                continue
+            latency_tracker.record(host.base_url, model, "connect", time.monotonic() - request_start)
+            self._hold_host(host, stream, ok=response.status_code < 500, model=model)
+            self.chat_completion_url = url
+            return response
+        return None
+
+    @staticmethod
+    def _request_timeout(host, model, stream, timeout):
+        """(连接超时, 读取超时)：流式请求的读取超时即首个 token 的超时，之后由 stream_watchdog 监控"""
+        timeouts = latency_tracker.timeouts(host.base_url, model)
+        return timeouts.connect, timeouts.first_token if stream else timeout
+
+    def _candidate_hosts(self, model, exclude=()):
+        candidates = host_pool.candidates(model, exclude)
+        if self._ticket is not None and self._ticket.host is not None:
+            # 调度器放行时已经分配了主机，优先使用它
+            candidates.sort(key=lambda host: host.base_url != self._ticket.host)
+        return candidates
+
+    @staticmethod
+    def _should_failover(status_code):
+        # 404：该主机上没有这个模型
+        return status_code == 404 or status_code >= 500
+
+    def _hold_host(self, host, stream, ok=True, model=None):
+        if ok and model is not None:
+            host_pool.mark_loaded(host, model)
+        if stream and ok:
+            # 流式请求在读完之前都算作进行中
+            self._release_stream_host()
+            self._stream_host = host
+        else:
+            host_pool.end(host, ok)
+
+    def _release_stream_host(self, ok=True):
+        host, self._stream_host = self._stream_host, None
+        if host is not None:
+            host_pool.end(host, ok)
+        ticket, self._stream_ticket = self._stream_ticket, None
+        if ticket is not None:
+            scheduler.release(ticket)
 
     def _refresh_header(self):
         self.headers = {
@@ -223,7 +726,7 @@ class OllamaVisionClient(BaseLLMModel):
 
     def _get_billing_data(self, billing_url):
         with retrieve_proxy():
-            response = requests.get(
+            response = get_session(billing_url).get(
                 billing_url,
                 headers=self.headers,
                 timeout=TIMEOUT_ALL,
@@ -238,92 +741,98 @@ class OllamaVisionClient(BaseLLMModel):
             )
 
     def _decode_chat_response(self, response):
-        error_msg = ""
-        for chunk in response.iter_lines():
-            if chunk:
-                chunk = chunk.decode()
-                if chunk == ": keep-alive":
-                    continue
-                chunk_length = len(chunk)
-                try:
-                    chunk = json.loads(chunk[6:])
-                except:
-                    print(i18n("JSON解析错误,收到的内容: ") + f"{chunk}")
-                    error_msg += chunk
-                    continue
-                try:
-                    if chunk_length > 6 and "delta" in chunk["choices"][0]:
-                        if "finish_details" in chunk["choices"][0]:
-                            finish_reason = chunk["choices"][0]["finish_details"]
-                        elif "finish_reason" in chunk["choices"][0]:
-                            finish_reason = chunk["choices"][0]["finish_reason"]
-                        else:
-                            finish_reason = chunk["finish_details"]
-                        if finish_reason == "stop":
-                            break
-                        try:
-                            if "reasoning_content" in chunk["choices"][0]["delta"]:
-                                reasoning_content = chunk["choices"][0]["delta"]["reasoning_content"]
-                            else:
-                                reasoning_content = None
-                            yield chunk["choices"][0]["delta"]["content"], reasoning_content
-                        except Exception as e:
-                            # logging.error(f"Error: {e}")
-                            continue
-                except:
-                    traceback.print_exc()
-                    print(f"ERROR: {chunk}")
-                    continue
-        if error_msg and not error_msg == "data: [DONE]":
-            raise Exception(error_msg)
+        # 读到流的末尾（data: [DONE]），连接才能回到连接池复用
+        return iter_stream_deltas(response)
+
+    def _decode_chat_response_async(self, response):
+        return aiter_stream_deltas(response)
 
     def set_key(self, new_access_key):
         ret = super().set_key(new_access_key)
         self._refresh_header()
         return ret
 
-    def _single_query_at_once(self, history, temperature=1.0):
+    def _rename_with_generated_title(self, history, history_file_path):
+        title_model = RENAME_MODEL_NAME or self.model_name
+        cache_key = None
+        if response_cache.enabled:
+            # 缓存键取自实际发送的请求体，采样参数与请求一致
+            payload = self._single_query_payload(history, temperature=0.0, model=title_model)
+            params = {key: value for key, value in payload.items() if key not in ("model", "messages")}
+            cache_key = response_cache.make_key(payload["model"], payload["messages"], {"api": self.chat_path, **params})
+        cached = response_cache.get(cache_key)
+        if cached is not None:
+            content = cached["content"]
+        else:
+            try:
+                response = self._single_query_at_once(history, temperature=0.0, model=title_model)
+                content = self._parse_single_query(response)
+            except Exception as e:
+                logging.info(f"自动命名失败。{e}")
+                return
+            response_cache.put(cache_key, {"content": content})
+        if self.history_file_path != history_file_path:
+            # 生成标题期间用户已经切换或手动重命名了对话
+            return
+        return self.rename_chat_history(replace_special_symbols(content) + ".json")
+
+    def _single_query_payload(self, history, temperature=1.0, model=None):
+        return {
+            "model": model or RENAME_MODEL_NAME or self.model_name,
+            "messages": history,
+            "temperature": temperature,
+        }
+
+    def _single_query_at_once(self, history, temperature=1.0, model=None):
         timeout = TIMEOUT_ALL
         headers = {
             "Content-Type": "application/json",
             "Authorization": f"Bearer {self.api_key}",
-            "temperature": f"{temperature}",
-        }
-        payload = {
-            "model": RENAME_MODEL if RENAME_MODEL is not None else self.model_name,
-            "messages": history,
         }
+        payload = self._single_query_payload(history, temperature, model)
 
         with retrieve_proxy():
-            response = requests.post(
-                self.chat_completion_url,
+            response = self._post_to_hosts(
+                self.chat_path,
+                model=payload["model"],
                 headers=headers,
                 json=payload,
-                stream=False,
                 timeout=timeout,
             )
 
         return response
 
+    def _parse_single_query(self, response):
+        response = json.loads(response.text)
+        return response["choices"][0]["message"]["content"]
+
+    def _summarize_context(self, summary, messages):
+        history = [
+            construct_system(CONTEXT_SUMMARY_SYSTEM_PROMPT),
+            construct_user(CONTEXT_SUMMARY_PROMPT.format(summary=summary or "(none)", transcript=format_transcript(messages))),
+        ]
+        response = self._single_query_at_once(history, temperature=0.0, model=self._summary_model())
+        return self._parse_single_query(response).strip()
+
     def auto_name_chat_history(self, name_chat_method, user_question, single_turn_checkbox):
         if len(self.history) == 2 and not single_turn_checkbox and not hide_history_when_not_logged_in:
             user_question = self.history[0]["content"]
             if name_chat_method == i18n("模型自动总结（消耗tokens）"):
                 ai_answer = self.history[1]["content"]
-                try:
-                    history = [
-                        {"role": "system", "content": SUMMARY_CHAT_SYSTEM_PROMPT},
-                        {"role": "user",
-                         "content": f"Please write a title based on the following conversation:\n---\nUser: {user_question}\nAssistant: {ai_answer}"}
-                    ]
-                    response = self._single_query_at_once(history, temperature=0.0)
-                    response = json.loads(response.text)
-                    content = response["choices"][0]["message"]["content"]
-                    filename = replace_special_symbols(content) + ".json"
-                except Exception as e:
-                    logging.info(f"自动命名失败。{e}")
-                    filename = replace_special_symbols(user_question)[:16] + ".json"
-                return self.rename_chat_history(filename)
+                history = [
+                    {"role": "system", "content": SUMMARY_CHAT_SYSTEM_PROMPT},
+                    {"role": "user",
+                     "content": f"Please write a title based on the following conversation:\n---\nUser: {user_question}\nAssistant: {ai_answer}"}
+                ]
+                # 先用第一条提问命名，模型生成的标题在后台低优先级通道里完成后再替换，
+                # 之后的 wait_for_chat_title 事件把新的名称推送到对话列表
+                filename = replace_special_symbols(user_question)[:16] + ".json"
+                update = self.rename_chat_history(filename)
+                title_model = RENAME_MODEL_NAME or self.model_name
+                self.pending_title = scheduler.submit_background(
+                    self.user_name, title_model, self._rename_with_generated_title, history, self.history_file_path
+                )
+                return update
             elif name_chat_method == i18n("第一条提问"):
                 filename = replace_special_symbols(user_question)[:16] + ".json"
                 return self.rename_chat_history(filename)
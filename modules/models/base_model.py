@@ -1,8 +1,11 @@
 from __future__ import annotations
 
+import asyncio
 import base64
+import copy
 import json
 import logging
+import queue
 import time
 import traceback
 from collections import deque
@@ -24,7 +27,15 @@ from langchain.schema import (AgentAction, AgentFinish, AIMessage, HumanMessage,
 from langchain_core.outputs import ChatGenerationChunk, GenerationChunk
 
 from ..index_func import *
+from ..tokenizer import get_tokenizer
 from ..utils import *
+from .frame_throttle import FLUSH, FrameThrottle, aiter_with_flush
+from .http_pool import close_response
+from .scheduler import POLL_INTERVAL, scheduler
+from .stream_answer import stream_frame
+from .token_ledger import TokenLedger
+from . import context_manager
+from .context_manager import ContextManager, split_turns
 
 GRADIO_CACHE = get_upload_folder()
 
@@ -147,15 +158,29 @@ class BaseLLMModel:
         self.description = config["description"]
         self.placeholder = config["placeholder"]
         self.token_upper_limit = config["token_limit"]
+        # 上下文长度还在后台获取时先使用默认值，获取到之后在下一次组装上下文时更新
+        self._token_limit_pending = not MODEL_METADATA.resolved(model_name)
         self.system_prompt = config["system"]
         self.api_key = config["api_key"]
         self.api_host = config["api_host"]
         self.stream = config["stream"]
+        self.keep_alive = config["keep_alive"]
+        self.hedge = config["hedge"]
+        self.tokenizer = config["tokenizer"]
 
         self.interrupted = False
+        self._active_stream = None  # (正在读取的流式响应, 所属事件循环)，中断时关闭
+        self.wasted_token_count = 0  # 被中断的回答累计消耗的 token 数
+        self._ticket = None  # 当前生成在调度器中的排队凭据
+        self._choice_clients = None  # 并发生成多个回答时的各个副本
+        self.pending_choices = None  # 等待用户选择的多个回答 [(回答, 用量统计, 附加内容)]
+        self.pending_title = None  # 后台生成标题并重命名对话的 Future
         self.need_api_key = self.api_key is not None
         self.history = []
-        self.all_token_counts = []
+        self.all_token_counts = TokenLedger()  # 发送给模型的各轮对话的 token 数
+        self.context = ContextManager()
+        self.last_usage = None  # 服务端返回的本轮用量统计（如 Ollama 的 eval_count）
+        self.last_ttft = None  # 本轮流式输出的首个 token 时间
         self.history_file_path = get_first_history_name(user)
         self.user_name = user
         self.chatbot = []
@@ -196,6 +221,21 @@ class BaseLLMModel:
         response, _ = self.get_answer_at_once()
         yield response
 
+    async def get_answer_stream_iter_async(self):
+        """Async version of get_answer_stream_iter.
+        Models without a native async client fall back to running the sync iterator in a worker thread.
+        """
+        stream_iter = self.get_answer_stream_iter()
+        sentinel = object()
+        try:
+            while True:
+                partial_text = await asyncio.to_thread(next, stream_iter, sentinel)
+                if partial_text is sentinel:
+                    break
+                yield partial_text
+        finally:
+            stream_iter.close()
+
     def get_answer_at_once(self):
         """predict at once, need to be implemented
         conversations are stored in self.history, with the most recent question, in OpenAI format
@@ -208,7 +248,7 @@ class BaseLLMModel:
         count = 0
         for response in response_iter:
             count += 1
-        return response, sum(self.all_token_counts) + count
+        return response, self.all_token_counts.total + count
 
     def billing_info(self):
         """get billing infomation, inplement if needed"""
@@ -234,26 +274,334 @@ class BaseLLMModel:
         self.all_token_counts.append(user_token_count)
         logging.debug(f"输入token计数: {user_token_count}")
 
-        stream_iter = self.get_answer_stream_iter()
-
         if display_append:
             display_append = (
                 '\n\n<hr class="append-display no-in-raw" />' + display_append
             )
+        if self.n_choices > 1:
+            yield from self._stream_choices(chatbot, user_token_count, display_append)
+            return
+
+        self.last_usage = None
+        stream_iter = self.get_answer_stream_iter()
+
         partial_text = ""
         token_increment = 1
-        for partial_text in stream_iter:
-            if type(partial_text) == tuple:
-                partial_text, token_increment = partial_text
+        throttle = FrameThrottle(chatbot)
+        try:
+            for partial_text in stream_iter:
+                if type(partial_text) == tuple:
+                    partial_text, token_increment = partial_text
+                self.all_token_counts[-1] += token_increment
+                # 合并相邻的 chunk，按帧间隔推送给界面；partial_text 可能是 StreamAnswer，
+                # 推送的是只记录长度的 StreamFrame，交给 Gradio 渲染时才拼接成字符串
+                if throttle.ready(partial_text) or self.interrupted:
+                    chatbot[-1] = (chatbot[-1][0], stream_frame(partial_text, display_append))
+                    status_text = self.token_message()
+                    yield get_return_value()
+                    throttle.pushed(chatbot)
+                if self.interrupted:
+                    break
+        finally:
+            # 关闭生成器，使模型关闭上游的 HTTP 流；chatbot 中不保留 StreamFrame
+            stream_iter.close()
+            chatbot[-1] = (chatbot[-1][0], str(chatbot[-1][1]))
+        partial_text = str(partial_text)
+        if throttle.pending:
             chatbot[-1] = (chatbot[-1][0], partial_text + display_append)
-            self.all_token_counts[-1] += token_increment
             status_text = self.token_message()
             yield get_return_value()
-            if self.interrupted:
-                self.recover()
-                break
+            throttle.pushed(chatbot)
+        throttle.finish()
+        self.last_ttft = throttle.ttft
+        if self.interrupted:
+            self._record_interrupted_stream(user_token_count)
+            self.recover()
+        self._apply_server_usage()
         self.history.append(construct_assistant(partial_text))
 
+    async def stream_next_chatbot_async(self, inputs, chatbot, fake_input=None, display_append=""):
+        status_text = i18n("开始实时传输回答……")
+        if fake_input:
+            chatbot.append((fake_input, ""))
+        else:
+            chatbot.append((inputs, ""))
+
+        user_token_count = self.count_token(inputs)
+        self.all_token_counts.append(user_token_count)
+        logging.debug(f"输入token计数: {user_token_count}")
+
+        if display_append:
+            display_append = (
+                '\n\n<hr class="append-display no-in-raw" />' + display_append
+            )
+        if self.n_choices > 1:
+            async for chatbot, status_text in self._stream_choices_async(chatbot, user_token_count, display_append):
+                yield chatbot, status_text
+            return
+
+        partial_text = ""
+        token_increment = 1
+        self.last_usage = None
+        stream_iter = self.get_answer_stream_iter_async()
+        throttle = FrameThrottle(chatbot)
+        chunks = aiter_with_flush(stream_iter, throttle)
+        try:
+            async for chunk in chunks:
+                if chunk is FLUSH:
+                    # 模型暂停输出时，缓冲的内容到了帧间隔也推送
+                    throttle.timer_flush(partial_text)
+                    chatbot[-1] = (chatbot[-1][0], stream_frame(partial_text, display_append))
+                    yield chatbot, self.token_message()
+                    throttle.pushed(chatbot)
+                    continue
+                partial_text = chunk
+                if type(partial_text) == tuple:
+                    partial_text, token_increment = partial_text
+                self.all_token_counts[-1] += token_increment
+                if throttle.ready(partial_text) or self.interrupted:
+                    chatbot[-1] = (chatbot[-1][0], stream_frame(partial_text, display_append))
+                    yield chatbot, self.token_message()
+                    throttle.pushed(chatbot)
+                if self.interrupted:
+                    break
+        finally:
+            await chunks.aclose()
+            await stream_iter.aclose()
+            chatbot[-1] = (chatbot[-1][0], str(chatbot[-1][1]))
+        partial_text = str(partial_text)
+        if throttle.pending:
+            chatbot[-1] = (chatbot[-1][0], partial_text + display_append)
+            yield chatbot, self.token_message()
+            throttle.pushed(chatbot)
+        throttle.finish()
+        self.last_ttft = throttle.ttft
+        if self.interrupted:
+            self._record_interrupted_stream(user_token_count)
+            self.recover()
+        self._apply_server_usage()
+        self.history.append(construct_assistant(partial_text))
+
+    def _fork_choices(self):
+        """为每个候选回答创建一个副本，各自持有独立的连接和用量统计"""
+        clients = []
+        for _ in range(self.n_choices):
+            client = copy.copy(self)
+            client.history = list(self.history)
+            client.n_choices = 1
+            client.interrupted = False
+            client.last_usage = None
+            client._active_stream = None
+            client._choice_clients = None
+            clients.append(client)
+        self._choice_clients = clients
+        return clients
+
+    def _choice_ticket(self, index):
+        # 第一个候选回答使用本轮的排队凭据，其余的各自排队，同一轮在每台主机上的并发数受限
+        if index == 0 or self._ticket is None:
+            return None
+        return scheduler.submit(self.user_name, self.model_name, group=self._ticket)
+
+    def _iter_choices(self, clients):
+        """在线程中并发生成各个候选回答，按到达顺序产出 (序号, 当前回答)"""
+        results = queue.Queue()
+
+        def run(index, client):
+            ticket = self._choice_ticket(index)
+            try:
+                if ticket is not None:
+                    while not ticket.wait(POLL_INTERVAL):
+                        if client.interrupted:
+                            return
+                    client._ticket = ticket
+                for partial_text in client.get_answer_stream_iter():
+                    results.put((index, partial_text))
+            except Exception as e:
+                traceback.print_exc()
+                results.put((index, STANDARD_ERROR_MSG + beautify_err_msg(str(e))))
+            finally:
+                if ticket is not None:
+                    scheduler.cancel(ticket)
+                results.put((index, None))
+
+        for index, client in enumerate(clients):
+            Thread(target=run, args=(index, client), daemon=True).start()
+        finished = 0
+        while finished < len(clients):
+            index, partial_text = results.get()
+            if partial_text is None:
+                finished += 1
+            else:
+                yield index, partial_text
+
+    async def _aiter_choices(self, clients):
+        results = asyncio.Queue()
+
+        async def run(index, client):
+            ticket = self._choice_ticket(index)
+            try:
+                if ticket is not None:
+                    while not ticket.admitted.is_set():
+                        if client.interrupted:
+                            return
+                        await asyncio.sleep(POLL_INTERVAL)
+                    client._ticket = ticket
+                async for partial_text in client.get_answer_stream_iter_async():
+                    await results.put((index, partial_text))
+            except Exception as e:
+                traceback.print_exc()
+                await results.put((index, STANDARD_ERROR_MSG + beautify_err_msg(str(e))))
+            finally:
+                if ticket is not None:
+                    scheduler.cancel(ticket)
+                await results.put((index, None))
+
+        tasks = [asyncio.create_task(run(index, client)) for index, client in enumerate(clients)]
+        try:
+            finished = 0
+            while finished < len(clients):
+                index, partial_text = await results.get()
+                if partial_text is None:
+                    finished += 1
+                else:
+                    yield index, partial_text
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    @staticmethod
+    def _render_choices(choices):
+        return "\n\n<hr />\n\n".join(
+            f"**{i18n('回答')} {index + 1}**\n\n{text}" for index, text in enumerate(choices)
+        )
+
+    def _stream_choices(self, chatbot, user_token_count, display_append):
+        """同时生成 n_choices 个回答并交错显示，由用户选择保留哪一个"""
+        choices = [""] * self.n_choices
+        clients = self._fork_choices()
+        choice_iter = self._iter_choices(clients)
+        throttle = FrameThrottle(chatbot)
+        try:
+            for index, partial_text in choice_iter:
+                choices[index] = partial_text
+                self.all_token_counts[-1] += 1
+                if throttle.ready(sum(len(choice) for choice in choices)) or self.interrupted:
+                    chatbot[-1] = (chatbot[-1][0], self._render_choices(choices) + display_append)
+                    yield chatbot, self.token_message()
+                    throttle.pushed(chatbot)
+                if self.interrupted:
+                    break
+        finally:
+            choice_iter.close()
+        throttle.finish()
+        self.last_ttft = throttle.ttft
+        chatbot[-1] = (chatbot[-1][0], self._render_choices(choices) + display_append)
+        yield chatbot, self._finish_choices(choices, clients, user_token_count, display_append)
+
+    async def _stream_choices_async(self, chatbot, user_token_count, display_append):
+        choices = [""] * self.n_choices
+        clients = self._fork_choices()
+        choice_iter = self._aiter_choices(clients)
+        throttle = FrameThrottle(chatbot)
+        try:
+            async for index, partial_text in choice_iter:
+                choices[index] = partial_text
+                self.all_token_counts[-1] += 1
+                if throttle.ready(sum(len(choice) for choice in choices)) or self.interrupted:
+                    chatbot[-1] = (chatbot[-1][0], self._render_choices(choices) + display_append)
+                    yield chatbot, self.token_message()
+                    throttle.pushed(chatbot)
+                if self.interrupted:
+                    break
+        finally:
+            await choice_iter.aclose()
+        throttle.finish()
+        self.last_ttft = throttle.ttft
+        chatbot[-1] = (chatbot[-1][0], self._render_choices(choices) + display_append)
+        yield chatbot, self._finish_choices(choices, clients, user_token_count, display_append)
+
+    def _finish_choices(self, choices, clients, user_token_count, display_append):
+        if self.interrupted:
+            for client in clients:
+                client.interrupt()
+            self._record_interrupted_stream(user_token_count)
+            self.recover()
+        self._choice_clients = None
+        # 选择之前不写入 history，token 计数也只保留输入部分
+        self.all_token_counts[-1] = user_token_count
+        self.pending_choices = [
+            (str(text), client.last_usage, display_append) for text, client in zip(choices, clients)
+        ]
+        return i18n("请选择要保留的回答")
+
+    def keep_choice(self, choice, chatbot):
+        """保留用户选择的回答，只有它会写入 history"""
+        if not self.pending_choices or not choice:
+            return chatbot, gr.update(visible=False, value=None), gr.update()
+        text, usage, display_append = self.pending_choices[int(choice) - 1]
+        self.pending_choices = None
+        self.all_token_counts[-1] += self.count_token(text)
+        self.last_usage = usage
+        self._apply_server_usage()
+        self.history.append(construct_assistant(text))
+        self._record_turn_usage()
+        if chatbot:
+            chatbot[-1] = (chatbot[-1][0], text + display_append)
+        self._compact_context()
+        self.chatbot = chatbot
+        self.auto_save(chatbot)
+        return chatbot, gr.update(visible=False, value=None), self.token_message()
+
+    def get_choice_selector(self):
+        if not self.pending_choices:
+            return gr.update(visible=False, value=None)
+        return gr.update(
+            visible=True, value=None, choices=[str(index + 1) for index in range(len(self.pending_choices))]
+        )
+
+    def _record_interrupted_stream(self, user_token_count):
+        usage = self.last_usage or {}
+        wasted_tokens = usage.get("eval_count", self.all_token_counts[-1] - user_token_count)
+        self.wasted_token_count += wasted_tokens
+        logging.info(f"用户中断了回答，本轮已生成 {wasted_tokens} 个 token，累计 {self.wasted_token_count} 个")
+
+    def _set_active_stream(self, response, is_async=False):
+        """登记正在读取的流式响应，interrupt() 时直接关闭它，Ollama 随即停止生成"""
+        loop = asyncio.get_running_loop() if is_async else None
+        self._active_stream = (response, loop)
+        if self.interrupted:
+            # 建立连接期间已经点了停止
+            self._cancel_active_stream()
+
+    def _clear_active_stream(self):
+        self._active_stream = None
+
+    def _cancel_active_stream(self):
+        active_stream, self._active_stream = self._active_stream, None
+        if active_stream is None:
+            return
+        # interrupt 通常在 Gradio 的工作线程里调用，httpx 响应会被送回所属的事件循环关闭
+        close_response(*active_stream)
+
+    def _apply_server_usage(self):
+        """用服务端统计的 token 数修正本轮计数，使 all_token_counts 之和等于当前上下文长度"""
+        usage = self.last_usage
+        if not usage or not self.all_token_counts:
+            return
+        if "eval_count" in usage:
+            completion_tokens = usage["eval_count"]
+            context_tokens = usage.get("prompt_eval_count", 0) + completion_tokens
+        elif "total_tokens" in usage:
+            completion_tokens = usage.get("completion_tokens", 0)
+            context_tokens = usage["total_tokens"]
+        else:
+            return
+        # 没有发送的早期对话不计入服务端统计的上下文长度
+        previous_tokens = self.all_token_counts.previous_total - self.context.unsent_tokens
+        # Ollama 命中 KV 缓存时 prompt_eval_count 只包含新计算的部分
+        self.all_token_counts[-1] = max(context_tokens - previous_tokens, completion_tokens)
+
     def next_chatbot_at_once(self, inputs, chatbot, fake_input=None, display_append=""):
         if fake_input:
             chatbot.append((fake_input, ""))
@@ -264,15 +612,16 @@ class BaseLLMModel:
         else:
             user_token_count = self.count_token(inputs)
         self.all_token_counts.append(user_token_count)
+        self.last_usage = None
         ai_reply, total_token_count = self.get_answer_at_once()
         self.history.append(construct_assistant(ai_reply))
         if fake_input is not None:
             self.history[-2] = construct_user(fake_input)
         chatbot[-1] = (chatbot[-1][0], ai_reply + display_append)
         if fake_input is not None:
-            self.all_token_counts[-1] += count_token(construct_assistant(ai_reply))
+            self.all_token_counts[-1] += count_token(construct_assistant(ai_reply), self.model_name, self.tokenizer)
         else:
-            self.all_token_counts[-1] = total_token_count - sum(self.all_token_counts)
+            self.all_token_counts[-1] = total_token_count - self.all_token_counts.total
         status_text = self.token_message()
         return chatbot, status_text
 
@@ -310,35 +659,41 @@ class BaseLLMModel:
     def summarize_index(self, files, chatbot, language):
         status = gr.Markdown()
         if files:
-            index = construct_index(self.api_key, file_src=files)
+            # 总结使用 langchain 的 ChatOpenAI，不占用 Ollama 主机，因此不经过 scheduler
+            yield chatbot, i18n("生成内容总结中……")
+            summary = self._summarize_files(files, language)
             status = i18n("总结完成")
-            logging.info(i18n("生成内容总结中……"))
-            os.environ["OPENAI_API_KEY"] = self.api_key
-            from langchain.chains.summarize import load_summarize_chain
-            from langchain.chat_models import ChatOpenAI
-            from langchain.prompts import PromptTemplate
-
-            prompt_template = (
-                "Write a concise summary of the following:\n\n{text}\n\nCONCISE SUMMARY IN "
-                + language
-                + ":"
-            )
-            PROMPT = PromptTemplate(template=prompt_template, input_variables=["text"])
-            llm = ChatOpenAI()
-            chain = load_summarize_chain(
-                llm,
-                chain_type="map_reduce",
-                return_intermediate_steps=True,
-                map_prompt=PROMPT,
-                combine_prompt=PROMPT,
-            )
-            summary = chain(
-                {"input_documents": list(index.docstore.__dict__["_dict"].values())},
-                return_only_outputs=True,
-            )["output_text"]
-            print(i18n("总结") + f": {summary}")
             chatbot.append([i18n("上传了") + str(len(files)) + "个文件", summary])
-        return chatbot, status
+        yield chatbot, status
+
+    def _summarize_files(self, files, language):
+        index = construct_index(self.api_key, file_src=files)
+        logging.info(i18n("生成内容总结中……"))
+        os.environ["OPENAI_API_KEY"] = self.api_key
+        from langchain.chains.summarize import load_summarize_chain
+        from langchain.chat_models import ChatOpenAI
+        from langchain.prompts import PromptTemplate
+
+        prompt_template = (
+            "Write a concise summary of the following:\n\n{text}\n\nCONCISE SUMMARY IN "
+            + language
+            + ":"
+        )
+        PROMPT = PromptTemplate(template=prompt_template, input_variables=["text"])
+        llm = ChatOpenAI()
+        chain = load_summarize_chain(
+            llm,
+            chain_type="map_reduce",
+            return_intermediate_steps=True,
+            map_prompt=PROMPT,
+            combine_prompt=PROMPT,
+        )
+        summary = chain(
+            {"input_documents": list(index.docstore.__dict__["_dict"].values())},
+            return_only_outputs=True,
+        )["output_text"]
+        print(i18n("总结") + f": {summary}")
+        return summary
 
     def prepare_inputs(
         self,
@@ -350,7 +705,6 @@ class BaseLLMModel:
         load_from_cache_if_possible=True,
     ):
         display_append = []
-        limited_context = False
         if type(real_inputs) == list:
             fake_inputs = real_inputs[0]["text"]
         else:
@@ -359,7 +713,6 @@ class BaseLLMModel:
             from langchain.embeddings.huggingface import HuggingFaceEmbeddings
             from langchain.vectorstores.base import VectorStoreRetriever
 
-            limited_context = True
             msg = "加载索引中……"
             logging.info(msg)
             index = construct_index(
@@ -453,18 +806,9 @@ class BaseLLMModel:
                 )
         else:
             display_append = ""
-        return limited_context, fake_inputs, display_append, real_inputs, chatbot
+        return fake_inputs, display_append, real_inputs, chatbot
 
-    def predict(
-        self,
-        inputs,
-        chatbot,
-        use_websearch=False,
-        files=None,
-        reply_language="中文",
-        should_check_token_count=True,
-    ):  # repetition_penalty, top_k
-        status_text = "开始生成回答……"
+    def _log_user_input(self, inputs):
         if type(inputs) == list:
             logging.info(
                 "用户"
@@ -486,29 +830,9 @@ class BaseLLMModel:
                 + f"{inputs}"
                 + colorama.Style.RESET_ALL
             )
-        if should_check_token_count:
-            if type(inputs) == list:
-                yield chatbot + [(inputs[0]["text"], "")], status_text
-            else:
-                yield chatbot + [(inputs, "")], status_text
-        if reply_language == "跟随问题语言（不稳定）":
-            reply_language = "the same language as the question, such as English, 中文, 日本語, Español, Français, or Deutsch."
-
-        (
-            limited_context,
-            fake_inputs,
-            display_append,
-            inputs,
-            chatbot,
-        ) = self.prepare_inputs(
-            real_inputs=inputs,
-            use_websearch=use_websearch,
-            files=files,
-            reply_language=reply_language,
-            chatbot=chatbot,
-        )
-        yield chatbot + [(fake_inputs, "")], status_text
 
+    def _check_predict_inputs(self, fake_inputs, chatbot):
+        """检查输入是否可以发送给模型，不可以时返回错误信息"""
         if (
             self.need_api_key
             and self.api_key is None
@@ -523,47 +847,40 @@ class BaseLLMModel:
                 self.all_token_counts.append(0)
             else:
                 self.history[-2] = construct_user(fake_inputs)
-            yield chatbot + [(fake_inputs, "")], status_text
-            return
+            return status_text
         elif len(fake_inputs.strip()) == 0:
             status_text = STANDARD_ERROR_MSG + NO_INPUT_MSG
             logging.info(status_text)
-            yield chatbot + [(fake_inputs, "")], status_text
-            return
+            return status_text
+        return None
+
+    @staticmethod
+    def _queue_message(ticket):
+        return i18n("排队中：第 {position} 位，预计等待 {eta} 秒").format(position=ticket.position, eta=ticket.eta)
 
+    def _append_user_input(self, inputs):
+        self.last_ttft = None
         if self.single_turn:
             self.history = []
-            self.all_token_counts = []
+            self.all_token_counts = TokenLedger()
         if type(inputs) == list:
             self.history.append(inputs)
         else:
             self.history.append(construct_user(inputs))
 
-        start_time = time.time()
-        try:
-            if self.stream:
-                logging.debug("使用流式传输")
-                iter = self.stream_next_chatbot(
-                    inputs,
-                    chatbot,
-                    fake_input=fake_inputs,
-                    display_append=display_append,
-                )
-                for chatbot, status_text in iter:
-                    yield chatbot, status_text
-            else:
-                logging.debug("不使用流式传输")
-                chatbot, status_text = self.next_chatbot_at_once(
-                    inputs,
-                    chatbot,
-                    fake_input=fake_inputs,
-                    display_append=display_append,
-                )
-                yield chatbot, status_text
-        except Exception as e:
-            traceback.print_exc()
-            status_text = STANDARD_ERROR_MSG + beautify_err_msg(str(e))
-            yield chatbot, status_text
+    def _drop_retrieved_context(self, fake_inputs):
+        """知识库检索的结果只用于本轮回答，对话记录中只保留用户的问题，以免之后每轮都重复发送检索到的文档"""
+        start = split_turns(self.history)[-1] if self.history else None
+        if start is None or self.history[start]["role"] != "user" or self.history[start]["content"] == fake_inputs:
+            return
+        previous_count = self._count_messages([self.history[start]])[0]
+        self.history[start] = construct_user(fake_inputs)
+        if self.all_token_counts:
+            delta = self._count_messages([self.history[start]])[0] - previous_count
+            self.all_token_counts[-1] = max(self.all_token_counts[-1] + delta, 0)
+
+    def _finish_predict(self, fake_inputs, start_time, should_check_token_count):
+        """回答结束后的日志与 token 计数整理，有早期对话没有发送给模型时返回提示信息"""
         end_time = time.time()
         if len(self.history) > 1 and self.history[-1]["content"] != fake_inputs:
             logging.info(
@@ -572,30 +889,317 @@ class BaseLLMModel:
                 + f"{self.history[-1]['content']}"
                 + colorama.Style.RESET_ALL
             )
-            logging.info(i18n("Tokens per second：{token_generation_speed}").format(token_generation_speed=str(self.all_token_counts[-1] / (end_time - start_time))))
+            usage = self.last_usage or {}
+            if usage.get("eval_duration"):
+                # 服务端统计的生成速度，不包含排队、加载模型和处理 prompt 的时间
+                token_generation_speed = usage.get("eval_count", 0) / (usage["eval_duration"] / 1e9)
+                logging.info(
+                    f"prompt_eval_count: {usage.get('prompt_eval_count', 0)}, eval_count: {usage.get('eval_count', 0)}, "
+                    f"load_duration: {usage.get('load_duration', 0) / 1e9:.2f}s, eval_duration: {usage['eval_duration'] / 1e9:.2f}s"
+                )
+            else:
+                token_generation_speed = self.all_token_counts[-1] / (end_time - start_time)
+            logging.info(i18n("Tokens per second：{token_generation_speed}").format(token_generation_speed=str(token_generation_speed)))
+            self._record_turn_usage(end_time - start_time)
+
+        # history 保留完整的对话，token 计数只保留实际发送给模型的轮次
+        if self.context.sent_turns:
+            while len(self.all_token_counts) > self.context.sent_turns:
+                self.all_token_counts.popleft()
+        if self.context.dropped_turns and should_check_token_count:
+            return f"为了防止token超限，早期的 {self.context.dropped_turns} 轮对话没有发送给模型"
+        return None
+
+    def _count_messages(self, messages):
+        """优先使用消息中保存的 token 数，只对没有保存的消息调用分词器，并把结果保存到消息中"""
+        missing = [message for message in messages if "token_count" not in message]
+        if missing:
+            for message, count in zip(missing, count_token_batch(missing, self.model_name, self.tokenizer)):
+                message["token_count"] = count
+        return [message["token_count"] for message in messages]
+
+    def _record_turn_usage(self, duration=None):
+        """把本轮服务端统计的用量和耗时保存到回答消息中，随对话记录一起保存"""
+        if not self.history or self.history[-1]["role"] != "assistant":
+            return
+        usage = dict(self.last_usage or {})
+        if self.last_ttft is not None:
+            usage["ttft"] = round(self.last_ttft, 3)
+        if duration is not None:
+            usage["duration"] = round(duration, 3)
+        if usage:
+            self.history[-1]["usage"] = usage
+
+    def token_count_metadata(self):
+        """保存对话记录时调用：补齐每条消息的 token 数，返回分词器名称和系统提示词的 token 数"""
+        self._count_messages(self.history)
+        system_token_count = self._count_messages([construct_system(self.system_prompt)])[0] if self.system_prompt else 0
+        return {
+            "tokenizer": get_tokenizer(self.model_name, self.tokenizer).identity,
+            "system_token_count": system_token_count,
+        }
+
+    def _restore_token_counts(self, saved_json):
+        """按对话记录中保存的 token 数重建 all_token_counts；旧版记录中没有的在这里计数，下次保存时写入"""
+        if saved_json.get("tokenizer") != get_tokenizer(self.model_name, self.tokenizer).identity:
+            # 换了分词器时保存的 token 数不再准确
+            for message in self.history:
+                message.pop("token_count", None)
+        starts = [start for start in split_turns(self.history) if start >= self.context.summarized]
+        ledger = TokenLedger()
+        if starts:
+            counts = self._count_messages(self.history[starts[0]:])
+            bounds = [start - starts[0] for start in starts] + [len(counts)]
+            for begin, end in zip(bounds, bounds[1:]):
+                ledger.append(sum(counts[begin:end]))
+            system_prompt = saved_json.get("system")
+            system_token_count = saved_json.get("system_token_count")
+            if system_prompt and system_token_count is None:
+                system_token_count = self._count_messages([construct_system(system_prompt)])[0]
+            ledger[0] += system_token_count or 0
+        self.all_token_counts = ledger
+
+    def _packed_context(self):
+        """返回 (系统提示词, 要发送的历史消息)：放不进 token 预算的早期对话不发送，已有的摘要并入系统提示词"""
+        if self._token_limit_pending and MODEL_METADATA.resolved(self.model_name):
+            self._token_limit_pending = False
+            self.token_upper_limit = MODEL_METADATA[self.model_name]["token_limit"]
+        budget = self.token_upper_limit - TOKEN_OFFSET
+        if self.system_prompt:
+            budget -= self._count_messages([construct_system(self.system_prompt)])[0]
+        messages, summary = self.context.pack(self.history, budget, self._count_messages)
+        # 保存在消息中的 token 数和用量统计不发送给模型
+        messages = [{"role": message["role"], "content": message["content"]} for message in messages]
+        system_prompt = self.system_prompt
+        if summary:
+            summary = CONTEXT_SUMMARY_MESSAGE.format(summary=summary)
+            system_prompt = f"{system_prompt}\n\n{summary}" if system_prompt else summary
+        return system_prompt, messages
+
+    def _summary_model(self):
+        return context_manager.SUMMARY_MODEL or self.model_name
+
+    def _summarize_context(self, summary, messages):
+        """把 messages 并入摘要 summary，返回新的摘要；不支持时返回 None"""
+        return None
+
+    def _compact_context(self):
+        """每轮结束后在后台低优先级通道里把较早的对话并入摘要"""
+        if self.single_turn:
+            return
+        model = self._summary_model()
+        self.context.compact(
+            self.history,
+            self._count_messages,
+            self._summarize_context,
+            lambda fn: scheduler.submit_background(self.user_name, model, fn),
+        )
 
-        if limited_context:
-            # self.history = self.history[-4:]
-            # self.all_token_counts = self.all_token_counts[-2:]
-            self.history = []
-            self.all_token_counts = []
-
-        max_token = self.token_upper_limit - TOKEN_OFFSET
-
-        if sum(self.all_token_counts) > max_token and should_check_token_count:
-            count = 0
-            while (
-                sum(self.all_token_counts)
-                > self.token_upper_limit * REDUCE_TOKEN_FACTOR
-                and sum(self.all_token_counts) > 0
-            ):
-                count += 1
-                del self.all_token_counts[0]
-                del self.history[:2]
+    def predict(
+        self,
+        inputs,
+        chatbot,
+        use_websearch=False,
+        files=None,
+        reply_language="中文",
+        should_check_token_count=True,
+    ):  # repetition_penalty, top_k
+        status_text = "开始生成回答……"
+        if self.pending_choices:
+            # 用户没有选择就继续对话时，保留第一个回答
+            self.keep_choice(1, chatbot)
+        self._log_user_input(inputs)
+        if should_check_token_count:
+            if type(inputs) == list:
+                yield chatbot + [(inputs[0]["text"], "")], status_text
+            else:
+                yield chatbot + [(inputs, "")], status_text
+        if reply_language == "跟随问题语言（不稳定）":
+            reply_language = "the same language as the question, such as English, 中文, 日本語, Español, Français, or Deutsch."
+
+        (
+            fake_inputs,
+            display_append,
+            inputs,
+            chatbot,
+        ) = self.prepare_inputs(
+            real_inputs=inputs,
+            use_websearch=use_websearch,
+            files=files,
+            reply_language=reply_language,
+            chatbot=chatbot,
+        )
+        yield chatbot + [(fake_inputs, "")], status_text
+
+        error_status = self._check_predict_inputs(fake_inputs, chatbot)
+        if error_status is not None:
+            yield chatbot + [(fake_inputs, "")], error_status
+            return
+
+        ticket = scheduler.submit(self.user_name, self.model_name)
+        admitted = False
+        # 从排队到生成结束都在同一个 try 中：生成器在 yield 处被关闭（用户关闭页面、Gradio 取消）时，
+        # 排队中的请求从队列中移除，已经放行的请求释放占用的位置
+        try:
+            queue_state = None
+            while not ticket.wait(POLL_INTERVAL):
+                if self.interrupted:
+                    break
+                if ticket.queue_state != queue_state:
+                    queue_state = ticket.queue_state
+                    yield chatbot + [(fake_inputs, "")], self._queue_message(ticket)
+            admitted = ticket.admitted.is_set()
+            if admitted:
+                self._append_user_input(inputs)
+                start_time = time.time()
+                self._ticket = ticket
+                try:
+                    if self.stream:
+                        logging.debug("使用流式传输")
+                        iter = self.stream_next_chatbot(
+                            inputs,
+                            chatbot,
+                            fake_input=fake_inputs,
+                            display_append=display_append,
+                        )
+                        for chatbot, status_text in iter:
+                            yield chatbot, status_text
+                    else:
+                        logging.debug("不使用流式传输")
+                        chatbot, status_text = self.next_chatbot_at_once(
+                            inputs,
+                            chatbot,
+                            fake_input=fake_inputs,
+                            display_append=display_append,
+                        )
+                        yield chatbot, status_text
+                except Exception as e:
+                    traceback.print_exc()
+                    status_text = STANDARD_ERROR_MSG + beautify_err_msg(str(e))
+                    yield chatbot, status_text
+        finally:
+            self._ticket = None
+            scheduler.cancel(ticket)
+        if not admitted:
+            self.recover()
+            yield chatbot, i18n("已取消排队")
+            return
+
+        if files:
+            self._drop_retrieved_context(fake_inputs)
+        trim_status = self._finish_predict(fake_inputs, start_time, should_check_token_count)
+        if trim_status is not None:
+            logging.info(status_text)
+            status_text = trim_status
+            yield chatbot, status_text
+
+        self._compact_context()
+        self.chatbot = chatbot
+        self.auto_save(chatbot)
+
+    async def predict_async(
+        self,
+        inputs,
+        chatbot,
+        use_websearch=False,
+        files=None,
+        reply_language="中文",
+        should_check_token_count=True,
+    ):
+        """predict 的异步版本，流式生成期间不占用 Gradio 的工作线程"""
+        status_text = "开始生成回答……"
+        if self.pending_choices:
+            # 用户没有选择就继续对话时，保留第一个回答
+            self.keep_choice(1, chatbot)
+        self._log_user_input(inputs)
+        if should_check_token_count:
+            if type(inputs) == list:
+                yield chatbot + [(inputs[0]["text"], "")], status_text
+            else:
+                yield chatbot + [(inputs, "")], status_text
+        if reply_language == "跟随问题语言（不稳定）":
+            reply_language = "the same language as the question, such as English, 中文, 日本語, Español, Français, or Deutsch."
+
+        # 联网搜索和知识库检索是阻塞操作，放到线程里执行
+        (
+            fake_inputs,
+            display_append,
+            inputs,
+            chatbot,
+        ) = await asyncio.to_thread(
+            self.prepare_inputs,
+            real_inputs=inputs,
+            use_websearch=use_websearch,
+            files=files,
+            reply_language=reply_language,
+            chatbot=chatbot,
+        )
+        yield chatbot + [(fake_inputs, "")], status_text
+
+        error_status = self._check_predict_inputs(fake_inputs, chatbot)
+        if error_status is not None:
+            yield chatbot + [(fake_inputs, "")], error_status
+            return
+
+        ticket = scheduler.submit(self.user_name, self.model_name)
+        admitted = False
+        # 从排队到生成结束都在同一个 try 中：生成器在 yield 处被关闭（用户关闭页面、Gradio 取消）时，
+        # 排队中的请求从队列中移除，已经放行的请求释放占用的位置
+        try:
+            queue_state = None
+            while not ticket.admitted.is_set():
+                if self.interrupted:
+                    break
+                if ticket.queue_state != queue_state:
+                    queue_state = ticket.queue_state
+                    yield chatbot + [(fake_inputs, "")], self._queue_message(ticket)
+                await asyncio.sleep(POLL_INTERVAL)
+            admitted = ticket.admitted.is_set()
+            if admitted:
+                self._append_user_input(inputs)
+                start_time = time.time()
+                self._ticket = ticket
+                try:
+                    if self.stream:
+                        logging.debug("使用异步流式传输")
+                        async for chatbot, status_text in self.stream_next_chatbot_async(
+                            inputs,
+                            chatbot,
+                            fake_input=fake_inputs,
+                            display_append=display_append,
+                        ):
+                            yield chatbot, status_text
+                    else:
+                        logging.debug("不使用流式传输")
+                        chatbot, status_text = await asyncio.to_thread(
+                            self.next_chatbot_at_once,
+                            inputs,
+                            chatbot,
+                            fake_input=fake_inputs,
+                            display_append=display_append,
+                        )
+                        yield chatbot, status_text
+                except Exception as e:
+                    traceback.print_exc()
+                    status_text = STANDARD_ERROR_MSG + beautify_err_msg(str(e))
+                    yield chatbot, status_text
+        finally:
+            self._ticket = None
+            scheduler.cancel(ticket)
+        if not admitted:
+            self.recover()
+            yield chatbot, i18n("已取消排队")
+            return
+
+        if files:
+            self._drop_retrieved_context(fake_inputs)
+        trim_status = self._finish_predict(fake_inputs, start_time, should_check_token_count)
+        if trim_status is not None:
             logging.info(status_text)
-            status_text = f"为了防止token超限，模型忘记了早期的 {count} 轮对话"
+            status_text = trim_status
             yield chatbot, status_text
 
+        self._compact_context()
         self.chatbot = chatbot
         self.auto_save(chatbot)
 
@@ -607,7 +1211,13 @@ class BaseLLMModel:
         reply_language="中文",
     ):
         logging.debug("重试中……")
-        if len(self.history) > 1:
+        if self.pending_choices:
+            # 候选回答还没有选择，直接重新生成
+            self.pending_choices = None
+            inputs = self.history.pop()["content"]
+            if len(self.all_token_counts) > 0:
+                self.all_token_counts.pop()
+        elif len(self.history) > 1:
             inputs = self.history[-2]["content"]
             del self.history[-2:]
             if len(self.all_token_counts) > 0:
@@ -623,6 +1233,7 @@ class BaseLLMModel:
         else:
             yield chatbot, f"{STANDARD_ERROR_MSG}上下文是空的"
             return
+        self.context.truncate(len(self.history))
 
         iter = self.predict(
             inputs,
@@ -654,12 +1265,16 @@ class BaseLLMModel:
 
     def interrupt(self):
         self.interrupted = True
+        self._cancel_active_stream()
+        for client in self._choice_clients or ():
+            client.interrupt()
 
     def recover(self):
         self.interrupted = False
 
     def set_token_upper_limit(self, new_upper_limit):
         self.token_upper_limit = new_upper_limit
+        self._token_limit_pending = False
         self.auto_save()
 
     def set_temperature(self, new_temperature):
@@ -700,11 +1315,18 @@ class BaseLLMModel:
             return {}
         logit_bias = self.logit_bias.split()
         bias_map = {}
-        encoding = tiktoken.get_encoding("cl100k_base")
+        tokenizer = get_tokenizer(self.model_name, self.tokenizer)
+        if not tokenizer.exact:
+            logging.warning(f"模型 {self.model_name} 没有可用的分词器，logit_bias 中的 token id 可能不准确")
         for line in logit_bias:
             word, bias_amount = line.split(":")
             if word:
-                for token in encoding.encode(word):
+                try:
+                    tokens = tokenizer.encode(word)
+                except ValueError as e:
+                    logging.warning(f"无法设置 logit_bias：{e}")
+                    return {}
+                for token in tokens:
                     bias_map[token] = float(bias_amount)
         return bias_map
 
@@ -735,7 +1357,9 @@ class BaseLLMModel:
 
     def reset(self, remain_system_prompt=False):
         self.history = []
-        self.all_token_counts = []
+        self.pending_choices = None
+        self.all_token_counts = TokenLedger()
+        self.context.reset()
         self.interrupted = False
         self.history_file_path = new_auto_history_filename(self.user_name)
         history_name = self.history_file_path[:-5]
@@ -777,8 +1401,11 @@ class BaseLLMModel:
 
     def delete_first_conversation(self):
         if self.history:
+            # token 计数只包含发送给模型的轮次，删除的一轮已经不在其中时不需要修改
+            if len(self.all_token_counts) >= len(split_turns(self.history)):
+                self.all_token_counts.popleft()
             del self.history[:2]
-            del self.all_token_counts[0]
+            self.context.drop_front(2)
         return self.token_message()
 
     def delete_last_conversation(self, chatbot):
@@ -788,6 +1415,7 @@ class BaseLLMModel:
             return chatbot, self.history
         if len(self.history) > 0:
             self.history = self.history[:-2]
+            self.context.truncate(len(self.history))
         if len(chatbot) > 0:
             msg = "删除了一组chatbot对话"
             chatbot = chatbot[:-1]
@@ -802,14 +1430,13 @@ class BaseLLMModel:
     def token_message(self, token_lst=None):
         if token_lst is None:
             token_lst = self.all_token_counts
-        token_sum = 0
-        for i in range(len(token_lst)):
-            token_sum += sum(token_lst[: i + 1])
+        elif not isinstance(token_lst, TokenLedger):
+            token_lst = TokenLedger(token_lst)
         return (
             i18n("Token 计数: ")
-            + f"{sum(token_lst)}"
+            + f"{token_lst.total}"
             + i18n("，本次对话累计消耗了 ")
-            + f"{token_sum} tokens"
+            + f"{token_lst.consumed} tokens"
         )
 
     def rename_chat_history(self, filename):
@@ -844,9 +1471,22 @@ class BaseLLMModel:
         else:
             return gr.update()
 
+    async def wait_for_chat_title(self):
+        """等待后台生成的标题，重命名完成后更新对话列表；等待期间不占用线程"""
+        future, self.pending_title = self.pending_title, None
+        if future is None:
+            return gr.update()
+        try:
+            update = await asyncio.wrap_future(future)
+        except Exception as e:
+            logging.info(f"自动命名失败。{e}")
+            return gr.update()
+        return gr.update() if update is None else update
+
     def auto_save(self, chatbot=None):
-        if chatbot is not None:
-            save_file(self.history_file_path, self)
+        # 修改设置时也保存；保存请求在后台合并写入，不阻塞界面
+        if chatbot is not None or self.history:
+            save_file(self.history_file_path, self, journal=True)
 
     def export_markdown(self, filename, chatbot):
         if filename == "":
@@ -885,6 +1525,8 @@ class BaseLLMModel:
 
     def load_chat_history(self, new_history_file_path=None):
         logging.debug(f"{self.user_name} 加载对话历史中……")
+        # 切换对话前写入还没有保存的内容
+        history_writer.flush(os.path.join(HISTORY_DIR, self.user_name))
         if new_history_file_path is not None:
             self.history_file_path = new_history_file_path
         try:
@@ -896,8 +1538,7 @@ class BaseLLMModel:
                 history_file_path = self.history_file_path
             if not self.history_file_path.endswith(".json"):
                 history_file_path += ".json"
-            with open(history_file_path, "r", encoding="utf-8") as f:
-                saved_json = json.load(f)
+            saved_json = history_store.load(history_file_path)
             try:
                 if type(saved_json["history"][0]) == str:
                     logging.info("历史记录格式为旧版，正在转换……")
@@ -922,6 +1563,9 @@ class BaseLLMModel:
             saved_json["chatbot"] = saved_json["chatbot"]
             logging.debug(f"{self.user_name} 加载对话历史完毕")
             self.history = saved_json["history"]
+            self.context.load(saved_json.get("context_summary"))
+            self._restore_token_counts(saved_json)
+            self.pending_choices = None
             self.single_turn = saved_json.get("single_turn", self.single_turn)
             self.temperature = saved_json.get("temperature", self.temperature)
             self.top_p = saved_json.get("top_p", self.top_p)
@@ -947,6 +1591,8 @@ class BaseLLMModel:
 
             history_json_path = os.path.realpath(os.path.join(HISTORY_DIR, self.user_name, self.history_file_path + ".json"))
             history_md_path = os.path.realpath(os.path.join(HISTORY_DIR, self.user_name, self.history_file_path + ".md"))
+            # 下载用的 JSON 和 .md 文件在这里按日志生成
+            history_store.materialize(history_file_path, markdown=True)
             tmp_json_for_download = save_file_to_cache(history_json_path, GRADIO_CACHE)
             tmp_md_for_download = save_file_to_cache(history_md_path, GRADIO_CACHE)
             return (
@@ -1011,11 +1657,10 @@ class BaseLLMModel:
         # check if history file path is in history directory
         assert os.path.realpath(history_file_path).startswith(os.path.realpath(HISTORY_DIR))
         assert os.path.realpath(md_history_file_path).startswith(os.path.realpath(HISTORY_DIR))
-        try:
-            os.remove(history_file_path)
-            os.remove(md_history_file_path)
+        history_writer.discard(history_file_path)
+        if history_store.delete(history_file_path):
             return i18n("删除对话历史成功"), get_history_list(self.user_name), []
-        except:
+        else:
             logging.info(f"删除对话历史失败 {history_file_path}")
             return (
                 i18n("对话历史") + filename + i18n("已经被删除啦"),
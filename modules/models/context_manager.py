@@ -0,0 +1,176 @@
+# -*- coding:utf-8 -*-
+"""
+按 token 预算组织发送给模型的上下文
+
+- 打包：从最近一轮开始往前选取完整的对话轮次，直到达到 token 预算，history 本身不再删除
+- 摘要：每轮结束后，若还没有并入摘要的对话超过 RECENT_TOKENS，在后台用（较小的）模型把较早的轮次
+  并入滚动摘要，之后只发送摘要和最近的几轮，prompt 长度和首个 token 的时间不随对话变长而增长
+- 摘要与它覆盖的消息数一起保存在对话记录文件中
+默认只打包不摘要，在 config.json 中设置 "context_summary": true 开启摘要。
+"""
+import logging
+import threading
+
+SUMMARY_ENABLED = False
+SUMMARY_MODEL = None  # 生成摘要使用的模型，None 表示使用当前对话的模型
+RECENT_TOKENS = 4096  # 还没有并入摘要的对话超过这个 token 数时生成摘要
+KEEP_RATIO = 0.5  # 生成摘要后保留的最近对话占 RECENT_TOKENS 的比例，避免每轮都重新摘要
+
+
+def configure(enabled=None, model=None, recent_tokens=None):
+    global SUMMARY_ENABLED, SUMMARY_MODEL, RECENT_TOKENS
+    if enabled is not None:
+        SUMMARY_ENABLED = bool(enabled)
+    if model is not None:
+        SUMMARY_MODEL = model or None
+    if recent_tokens is not None:
+        RECENT_TOKENS = int(recent_tokens)
+
+
+def split_turns(history):
+    """按用户消息划分对话轮次，返回每轮的起始下标；图片消息归入其后的用户消息"""
+    return [
+        index
+        for index, message in enumerate(history)
+        if index == 0 or (message["role"] in ("user", "image") and history[index - 1]["role"] != "image")
+    ]
+
+
+def format_transcript(messages):
+    lines = []
+    for message in messages:
+        content = message["content"]
+        if message["role"] == "image":
+            lines.append("User: [image]")
+            continue
+        if type(content) == list:
+            content = content[0]["text"]
+        lines.append(f"{'User' if message['role'] == 'user' else 'Assistant'}: {content}")
+    return "\n\n".join(lines)
+
+
+class ContextManager:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.summary = ""
+        self.summarized = 0  # history 开头已经并入摘要的消息数
+        self.generation = 0  # history 被删除、替换时加一，使进行中的摘要作废
+        self.unsent_tokens = 0  # 最近一次打包时没有发送的消息的 token 数减去摘要的 token 数
+        self.dropped_turns = 0  # 最近一次打包时既没有发送也没有并入摘要的轮数
+        self.sent_turns = 0  # 最近一次打包时发送的轮数
+        self._compacting = False
+
+    def reset(self, summary="", summarized=0):
+        with self.lock:
+            self.summary = summary
+            self.summarized = summarized
+            self.generation += 1
+            self.unsent_tokens = 0
+            self.dropped_turns = 0
+            self.sent_turns = 0
+
+    def load(self, saved):
+        """读取对话记录中保存的摘要"""
+        saved = saved or {}
+        self.reset(saved.get("summary", ""), saved.get("summarized", 0))
+
+    def to_json(self):
+        with self.lock:
+            return {"summary": self.summary, "summarized": self.summarized}
+
+    def drop_front(self, count):
+        """history 开头删除了 count 条消息"""
+        with self.lock:
+            self.summarized = max(self.summarized - count, 0)
+            if self.summarized == 0:
+                self.summary = ""
+            self.generation += 1
+
+    def truncate(self, length):
+        """history 末尾的消息被删除后调用"""
+        with self.lock:
+            if self.summarized > length:
+                self.summarized = length
+            self.generation += 1
+
+    def pack(self, history, budget, count_messages):
+        """返回 (要发送的消息, 摘要)；最后一轮总是发送，之前的轮次从新到旧放入剩余的预算"""
+        with self.lock:
+            summary = self.summary
+            summarized = min(self.summarized, len(history))
+        starts = [start for start in split_turns(history) if start >= summarized]
+        if not starts:
+            return [], summary
+        counts = count_messages(history)
+        summary_tokens = count_messages([{"role": "system", "content": summary}])[0] if summary else 0
+        remaining = budget - summary_tokens
+        first = len(starts) - 1
+        remaining -= sum(counts[starts[first]:])
+        while first > 0:
+            turn_tokens = sum(counts[starts[first - 1]:starts[first]])
+            if turn_tokens > remaining:
+                break
+            remaining -= turn_tokens
+            first -= 1
+        with self.lock:
+            self.unsent_tokens = sum(counts[:starts[first]]) - summary_tokens
+            self.dropped_turns = first
+            self.sent_turns = len(starts) - first
+        return history[starts[first]:], summary
+
+    def needs_compaction(self, history, count_messages):
+        """还没有并入摘要的对话超过 RECENT_TOKENS 时，返回本次应该并入摘要的消息范围"""
+        if not SUMMARY_ENABLED or self._compacting:
+            return None
+        with self.lock:
+            summarized = min(self.summarized, len(history))
+        starts = [start for start in split_turns(history) if start >= summarized]
+        if len(starts) < 2:
+            return None
+        counts = count_messages(history)
+        if sum(counts[starts[0]:]) <= RECENT_TOKENS:
+            return None
+        kept = len(starts) - 1
+        kept_tokens = sum(counts[starts[kept]:])
+        while kept > 1:
+            turn_tokens = sum(counts[starts[kept - 1]:starts[kept]])
+            if kept_tokens + turn_tokens > RECENT_TOKENS * KEEP_RATIO:
+                break
+            kept_tokens += turn_tokens
+            kept -= 1
+        return summarized, starts[kept]
+
+    def compact(self, history, count_messages, summarize, submit):
+        """在后台把较早的轮次并入摘要；submit(fn) 负责把 fn 放到后台执行"""
+        span = self.needs_compaction(history, count_messages)
+        if span is None:
+            return
+        start, end = span
+        with self.lock:
+            previous_summary = self.summary
+            generation = self.generation
+            self._compacting = True
+        messages = list(history[start:end])
+
+        def run():
+            try:
+                summary = summarize(previous_summary, messages)
+            except Exception as e:
+                logging.warning(f"生成对话摘要失败：{e}")
+                return
+            finally:
+                self._compacting = False
+            if not summary:
+                return
+            with self.lock:
+                if self.generation != generation or self.summarized != start:
+                    return
+                self.summary = summary
+                self.summarized = end
+            logging.info(f"已将前 {end} 条消息并入对话摘要")
+
+        try:
+            submit(run)
+        except Exception:
+            self._compacting = False
+            raise
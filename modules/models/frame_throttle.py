@@ -0,0 +1,171 @@
+# -*- coding:utf-8 -*-
+"""
+流式输出的界面刷新节流
+
+模型每输出一个 chunk，stream_next_chatbot 都会把整个 chatbot 推送给 Gradio。
+在两次推送之间合并新到的 token：距离上次推送超过 FRAME_INTERVAL 秒，
+或者新增超过 FLUSH_CHARS 个字符时才推送；生成结束或中断时立即推送最后的内容。
+
+异步路径在等待下一个 chunk 时按 flush_delay() 设置超时，模型暂停输出（加载工具、一阵输出之后）时
+缓冲的内容到了帧间隔也会推送。同步路径阻塞在读取上游的流上，只能在下一个 chunk 到达时推送，
+暂停期间留在服务端的是上次推送之后不到 FRAME_INTERVAL 秒、且不超过 FLUSH_CHARS 个字符的内容，
+因此 FLUSH_CHARS 不超过 MAX_FLUSH_CHARS。
+每轮结束时在 info 级别记录本轮和累计的推送统计，用于按部署调整这两个参数。
+"""
+import asyncio
+import logging
+import threading
+import time
+
+from .stream_answer import StreamFrame
+
+FRAME_INTERVAL = 0.05  # 两次推送之间的最短间隔（秒），0 表示每个 chunk 都推送
+FLUSH_CHARS = 200  # 新增字符数达到该值时不等间隔直接推送，0 表示不按字符数推送
+MAX_FLUSH_CHARS = 400  # FLUSH_CHARS 的上限，同步路径在模型暂停时最多积压这么多字符
+
+
+def configure(frame_interval=None, flush_chars=None):
+    global FRAME_INTERVAL, FLUSH_CHARS
+    if frame_interval is not None:
+        FRAME_INTERVAL = float(frame_interval)
+    if flush_chars is not None:
+        flush_chars = int(flush_chars)
+        if flush_chars > MAX_FLUSH_CHARS:
+            logging.warning(f"stream_flush_chars 为 {flush_chars}，使用上限 {MAX_FLUSH_CHARS}")
+            flush_chars = MAX_FLUSH_CHARS
+        FLUSH_CHARS = flush_chars
+
+
+FLUSH = object()  # aiter_with_flush 在模型暂停、到了帧间隔时产出的标记
+
+
+def _message_bytes(message):
+    if isinstance(message, StreamFrame):
+        return len(message)  # 按字符数估算，不为统计拼接整个回答
+    return len(message.encode("utf-8")) if isinstance(message, str) else 0
+
+
+class FrameThrottle:
+    """一轮流式输出的节流状态"""
+
+    def __init__(self, chatbot):
+        self.last_flush = 0.0
+        self.flushed_chars = 0
+        self.pending = False
+        self.chunks = 0
+        self.yields = 0
+        self.timer_flushes = 0  # 模型暂停时按定时器推送的次数
+        self.bytes_pushed = 0
+        # 本轮输出期间只有最后一条消息会变化，之前的消息大小只计算一次
+        self.history_bytes = sum(
+            _message_bytes(message) for pair in chatbot[:-1] for message in pair
+        )
+        self.start_time = time.monotonic()
+        self.ttft = None  # 收到第一个 chunk 的时间（秒），保存到对话记录的用量统计中
+
+    def ready(self, text):
+        """收到新内容后调用，返回是否应该推送；text 为当前的完整回答或它的长度"""
+        self.chunks += 1
+        self.pending = True
+        length = text if isinstance(text, int) else len(text)
+        now = time.monotonic()
+        if self.ttft is None:
+            self.ttft = now - self.start_time
+        if (
+            FRAME_INTERVAL <= 0
+            or now - self.last_flush >= FRAME_INTERVAL
+            or (FLUSH_CHARS > 0 and length - self.flushed_chars >= FLUSH_CHARS)
+        ):
+            self.last_flush = now
+            self.flushed_chars = length
+            return True
+        return False
+
+    def flush_delay(self):
+        """有未推送的内容时，距离按帧间隔推送还有多少秒；没有未推送的内容或不限制间隔时返回 None"""
+        if not self.pending or FRAME_INTERVAL <= 0:
+            return None
+        return max(self.last_flush + FRAME_INTERVAL - time.monotonic(), 0)
+
+    def timer_flush(self, text):
+        """等待下一个 chunk 超时、推送缓冲的内容之前调用，text 与 ready 相同"""
+        self.last_flush = time.monotonic()
+        self.flushed_chars = text if isinstance(text, int) else len(text)
+        self.timer_flushes += 1
+
+    def pushed(self, chatbot):
+        """每次推送后调用，记录推送次数和数据量"""
+        self.pending = False
+        self.yields += 1
+        if chatbot:
+            self.bytes_pushed += self.history_bytes + sum(_message_bytes(message) for message in chatbot[-1])
+
+    def finish(self):
+        throttle_stats.record(self)
+
+
+async def aiter_with_flush(stream_iter, throttle):
+    """逐个产出 stream_iter 的内容；等待下一个 chunk 期间有未推送的内容且到了帧间隔时产出 FLUSH"""
+    next_item = None
+    try:
+        while True:
+            if next_item is None:
+                next_item = asyncio.ensure_future(stream_iter.__anext__())
+            done, _ = await asyncio.wait({next_item}, timeout=throttle.flush_delay())
+            if not done:
+                yield FLUSH
+                continue
+            item, next_item = next_item, None
+            try:
+                value = item.result()
+            except StopAsyncIteration:
+                return
+            yield value
+    finally:
+        if next_item is not None:
+            # 提前结束时取消正在等待的读取，之后调用方才能关闭 stream_iter
+            next_item.cancel()
+            try:
+                await next_item
+            except (asyncio.CancelledError, Exception):
+                pass
+
+
+class ThrottleStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.turns = 0
+        self.chunks = 0
+        self.yields = 0
+        self.timer_flushes = 0
+        self.bytes_pushed = 0
+
+    def record(self, throttle):
+        with self.lock:
+            self.turns += 1
+            self.chunks += throttle.chunks
+            self.yields += throttle.yields
+            self.timer_flushes += throttle.timer_flushes
+            self.bytes_pushed += throttle.bytes_pushed
+        stats = self.stats()
+        logging.info(
+            f"本轮收到 {throttle.chunks} 个 chunk，推送 {throttle.yields} 次（定时推送 {throttle.timer_flushes} 次），"
+            f"共 {throttle.bytes_pushed} 字节，耗时 {time.monotonic() - throttle.start_time:.1f} 秒；"
+            f"累计 {stats['turns']} 轮，平均每轮推送 {stats['yields_per_turn']:.1f} 次、{stats['bytes_per_turn']:.0f} 字节"
+        )
+
+    def stats(self):
+        with self.lock:
+            turns = max(self.turns, 1)
+            return {
+                "turns": self.turns,
+                "chunks": self.chunks,
+                "yields": self.yields,
+                "timer_flushes": self.timer_flushes,
+                "bytes_pushed": self.bytes_pushed,
+                "yields_per_turn": self.yields / turns,
+                "bytes_per_turn": self.bytes_pushed / turns,
+            }
+
+
+throttle_stats = ThrottleStats()
@@ -0,0 +1,105 @@
+# -*- coding:utf-8 -*-
+"""
+对冲请求（hedged requests），降低首个 token 的长尾延迟
+
+流式请求在主机的 p95 TTFT 之后仍没有输出时，向另一台主机发送相同的请求，
+先产出 token 的一方胜出，另一方的连接立即关闭。
+对冲会额外占用一台主机，因此只在预算内进行：最近的请求中被对冲的比例不超过 BUDGET。
+默认关闭，在 config.json 中设置 "hedged_requests": true，或在模型元数据中设置 "hedge" 开启。
+"""
+import threading
+from collections import deque
+
+from .latency import MIN_SAMPLES, _percentile, latency_tracker
+
+ENABLED = False
+PERCENTILE = 0.95  # 首个 token 超过该分位数仍未到达时发出对冲请求
+BUDGET = 0.1  # 最近的请求中最多有多少比例可以对冲
+MIN_DELAY = 0.5  # 对冲前至少等待的秒数
+WINDOW = 200  # 统计对冲比例和延迟的最近请求数
+
+
+class Hedger:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.recent = deque(maxlen=WINDOW)  # 最近的请求是否发出了对冲，元素为 [bool]
+        self.effective_ttft = deque(maxlen=WINDOW)  # 用户实际等到首个 token 的时间
+        self.baseline_ttft = deque(maxlen=WINDOW)  # 不对冲时首个 token 的时间（对冲胜出时取下界）
+        self.requests = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+
+    def configure(self, enabled=None, percentile=None, budget=None, min_delay=None):
+        global ENABLED, PERCENTILE, BUDGET, MIN_DELAY
+        if enabled is not None:
+            ENABLED = bool(enabled)
+        if percentile is not None:
+            PERCENTILE = float(percentile)
+        if budget is not None:
+            BUDGET = float(budget)
+        if min_delay is not None:
+            MIN_DELAY = float(min_delay)
+
+    @staticmethod
+    def enabled_for(hedge):
+        """hedge 为模型元数据中的设置，None 表示沿用全局设置"""
+        return ENABLED if hedge is None else bool(hedge)
+
+    def delay(self, host, model):
+        """发出对冲请求前等待的秒数；延迟统计不足时返回 None，不对冲"""
+        ttft = latency_tracker.percentile(host, model, "ttft", PERCENTILE)
+        if ttft is None:
+            return None
+        return max(ttft, MIN_DELAY)
+
+    def begin(self):
+        """登记一次可以对冲的请求，返回的标记交给 try_hedge"""
+        entry = [False]
+        with self.lock:
+            self.recent.append(entry)
+            self.requests += 1
+        return entry
+
+    def try_hedge(self, entry):
+        """在预算内时占用一次对冲名额"""
+        with self.lock:
+            hedged = sum(1 for recent in self.recent if recent[0])
+            if hedged + 1 > BUDGET * max(len(self.recent), MIN_SAMPLES):
+                return False
+            entry[0] = True
+            self.hedges += 1
+            return True
+
+    def record(self, ttft, host=None, model=None, primary_wait=None):
+        """记录一次请求的首个 token 时间
+
+        对冲胜出时原请求被取消，只知道它等待了 primary_wait 秒仍没有输出，
+        用原主机历史上超过这个时间的 TTFT 的中位数估计不对冲时的 TTFT。
+        """
+        baseline = ttft
+        if primary_wait is not None:
+            longer = [value for value in latency_tracker.values(host, model, "ttft") if value > primary_wait]
+            baseline = _percentile(longer, 0.5) if longer else primary_wait
+        with self.lock:
+            self.effective_ttft.append(ttft)
+            self.baseline_ttft.append(max(baseline, ttft))
+            if primary_wait is not None:
+                self.hedge_wins += 1
+
+    def stats(self):
+        with self.lock:
+            effective = list(self.effective_ttft)
+            baseline = list(self.baseline_ttft)
+            stats = {
+                "requests": self.requests,
+                "hedges": self.hedges,
+                "hedge_wins": self.hedge_wins,
+                "hedge_rate": self.hedges / self.requests if self.requests else 0.0,
+            }
+        if len(effective) >= MIN_SAMPLES:
+            stats["p99_ttft"] = _percentile(effective, 0.99)
+            stats["p99_improvement"] = _percentile(baseline, 0.99) - stats["p99_ttft"]
+        return stats
+
+
+hedger = Hedger()
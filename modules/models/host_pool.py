@@ -0,0 +1,170 @@
+# -*- coding:utf-8 -*-
+"""
+多 Ollama 主机的负载均衡
+
+- 每个主机记录进行中的请求数，优先选择请求最少的主机
+- 通过 /api/ps 得知每个主机已经加载了哪些模型，优先选择已加载目标模型的主机
+- 被动健康检查：请求失败累计到阈值后，主机在冷却时间内不参与调度
+- 主动健康检查：后台线程定期访问 /api/ps
+- 调用方按 candidates() 给出的顺序依次尝试，实现自动故障转移
+"""
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+from .http_pool import get_session
+
+FAILURE_THRESHOLD = 3  # 连续失败多少次后认为主机不可用
+COOLDOWN = 30  # 不可用主机的冷却时间（秒），之后重新参与调度
+CHECK_INTERVAL = 15  # 主动健康检查间隔（秒）
+CHECK_TIMEOUT = 3  # 健康检查请求的超时时间（秒）
+
+
+def model_key(model):
+    """/api/ps 返回的名称带有标签，没有标签的模型名按 :latest 比较"""
+    if model and ":" not in model.rsplit("/", 1)[-1]:
+        return f"{model}:latest"
+    return model
+
+
+class OllamaHost:
+    def __init__(self, base_url):
+        base_url = base_url.rstrip("/")
+        if not base_url.startswith("http"):
+            base_url = f"http://{base_url}"
+        self.base_url = base_url
+        self.in_flight = 0
+        self.failures = 0
+        self.down_until = 0.0
+        self.loaded_models = set()
+
+    def url(self, path):
+        return f"{self.base_url}{path}"
+
+    @property
+    def available(self):
+        return self.down_until <= time.time()
+
+    def __repr__(self):
+        return f"OllamaHost({self.base_url}, in_flight={self.in_flight}, failures={self.failures})"
+
+
+class HostPool:
+    def __init__(self, hosts=()):
+        self.lock = threading.Lock()
+        self.hosts = [OllamaHost(host) for host in hosts]
+        self._checker = None
+
+    def set_hosts(self, hosts):
+        with self.lock:
+            existing = {host.base_url: host for host in self.hosts}
+            new_hosts = []
+            for url in hosts:
+                host = OllamaHost(url)
+                new_hosts.append(existing.get(host.base_url, host))
+            self.hosts = new_hosts
+        logging.info(f"Ollama 主机列表：{[host.base_url for host in self.hosts]}")
+
+    def __len__(self):
+        return len(self.hosts)
+
+    def candidates(self, model=None, exclude=()):
+        """按优先级排列的候选主机：可用 > 已加载模型 > 请求数少 > 失败次数少"""
+        with self.lock:
+            hosts = [host for host in self.hosts if host not in exclude]
+            available = [host for host in hosts if host.available]
+            # 全部不可用时仍然尝试，避免所有请求直接失败
+            hosts = available or hosts
+            return sorted(
+                hosts,
+                key=lambda host: (model_key(model) not in host.loaded_models, host.in_flight, host.failures),
+            )
+
+    def is_resident(self, model):
+        """是否有可用的主机已经加载了该模型"""
+        key = model_key(model)
+        with self.lock:
+            return any(key in host.loaded_models for host in self.hosts if host.available)
+
+    def select(self, model=None, exclude=()):
+        candidates = self.candidates(model, exclude)
+        return candidates[0] if candidates else None
+
+    def begin(self, host):
+        with self.lock:
+            host.in_flight += 1
+
+    def end(self, host, ok=True):
+        with self.lock:
+            host.in_flight = max(host.in_flight - 1, 0)
+        if ok:
+            self.mark_success(host)
+        else:
+            self.mark_failure(host)
+
+    @contextmanager
+    def acquire(self, model=None, exclude=()):
+        host = self.select(model, exclude)
+        if host is None:
+            raise RuntimeError("没有可用的 Ollama 主机")
+        self.begin(host)
+        ok = False
+        try:
+            yield host
+            ok = True
+        finally:
+            self.end(host, ok)
+
+    def mark_success(self, host):
+        with self.lock:
+            host.failures = 0
+            host.down_until = 0.0
+
+    def mark_failure(self, host):
+        with self.lock:
+            host.failures += 1
+            if host.failures >= FAILURE_THRESHOLD:
+                host.down_until = time.time() + COOLDOWN
+                logging.warning(f"Ollama 主机 {host.base_url} 连续失败 {host.failures} 次，暂停调度 {COOLDOWN} 秒")
+
+    def mark_loaded(self, host, model, loaded=True):
+        with self.lock:
+            if loaded:
+                host.loaded_models.add(model_key(model))
+            else:
+                host.loaded_models.discard(model_key(model))
+
+    def check_host(self, host):
+        """访问 /api/ps，更新主机的健康状态和已加载模型"""
+        try:
+            response = get_session(host.base_url).get(host.url("/api/ps"), timeout=CHECK_TIMEOUT)
+            response.raise_for_status()
+            models = response.json().get("models", [])
+        except Exception as e:
+            logging.debug(f"Ollama 主机 {host.base_url} 健康检查失败：{e}")
+            self.mark_failure(host)
+            return False
+        with self.lock:
+            host.loaded_models = {model_key(model.get("name") or model.get("model")) for model in models}
+        self.mark_success(host)
+        return True
+
+    def check_all(self):
+        for host in list(self.hosts):
+            self.check_host(host)
+
+    def start_health_checks(self, interval=CHECK_INTERVAL):
+        if self._checker is not None or interval <= 0:
+            return
+
+        def run():
+            while True:
+                self.check_all()
+                time.sleep(interval)
+
+        self._checker = threading.Thread(target=run, name="ollama-health-check", daemon=True)
+        self._checker.start()
+
+
+host_pool = HostPool()
@@ -0,0 +1,149 @@
+# -*- coding:utf-8 -*-
+"""
+进程级 HTTP 连接池
+
+每个 Ollama host 共享一个 requests.Session，所有会话的 OllamaVisionClient
+以及 MyOllama.OllamaClient 都从这里取连接，避免每轮对话重新建立 TCP 连接。
+"""
+import asyncio
+import logging
+import socket
+import threading
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection
+from urllib3.util.retry import Retry
+
+POOL_SIZE = 100  # 每个 host 的最大连接数，默认与 CONCURRENT_COUNT 一致
+KEEP_ALIVE = True  # 是否开启 TCP keep-alive
+MAX_RETRIES = 2  # 连接失败 / 网关错误时的重试次数
+BACKOFF_FACTOR = 0.3  # 重试间隔的指数退避因子
+RETRY_STATUS_CODES = (502, 503, 504)
+
+_sessions = {}
+_async_clients = {}
+_lock = threading.Lock()
+
+
+class KeepAliveAdapter(HTTPAdapter):
+    def __init__(self, keep_alive=True, **kwargs):
+        self.keep_alive = keep_alive
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        if self.keep_alive:
+            kwargs["socket_options"] = HTTPConnection.default_socket_options + [
+                (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1),
+            ]
+        super().init_poolmanager(*args, **kwargs)
+
+
+def configure(pool_size=None, keep_alive=None, max_retries=None, backoff_factor=None):
+    """更新连接池参数，已经创建的 Session 会被关闭并在下次使用时重建"""
+    global POOL_SIZE, KEEP_ALIVE, MAX_RETRIES, BACKOFF_FACTOR
+    if pool_size is not None:
+        POOL_SIZE = int(pool_size)
+    if keep_alive is not None:
+        KEEP_ALIVE = bool(keep_alive)
+    if max_retries is not None:
+        MAX_RETRIES = int(max_retries)
+    if backoff_factor is not None:
+        BACKOFF_FACTOR = float(backoff_factor)
+    close_all()
+
+
+def host_key(url):
+    parts = urlsplit(url)
+    return f"{parts.scheme}://{parts.netloc}"
+
+
+def _new_session():
+    retry = Retry(
+        total=MAX_RETRIES,
+        connect=MAX_RETRIES,
+        read=0,  # 流式请求读到一半不能重放
+        status=MAX_RETRIES,
+        status_forcelist=RETRY_STATUS_CODES,
+        allowed_methods=None,
+        backoff_factor=BACKOFF_FACTOR,
+        raise_on_status=False,
+    )
+    adapter = KeepAliveAdapter(
+        keep_alive=KEEP_ALIVE,
+        pool_connections=1,
+        pool_maxsize=POOL_SIZE,
+        max_retries=retry,
+    )
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    if not KEEP_ALIVE:
+        session.headers["Connection"] = "close"
+    return session
+
+
+def get_session(url) -> requests.Session:
+    """获取 url 所在 host 的共享 Session"""
+    key = host_key(url)
+    session = _sessions.get(key)
+    if session is None:
+        with _lock:
+            session = _sessions.get(key)
+            if session is None:
+                logging.debug(f"为 {key} 创建连接池，大小 {POOL_SIZE}")
+                session = _new_session()
+                _sessions[key] = session
+    return session
+
+
+def get_async_client(url):
+    """获取 url 所在 host 的共享 httpx.AsyncClient，供异步流式生成使用
+
+    AsyncClient 绑定在创建它的事件循环上，Gradio 只有一个事件循环，
+    因此这里按 (host, 事件循环) 缓存。
+    """
+    import httpx
+
+    loop = asyncio.get_running_loop()
+    key = (host_key(url), id(loop))
+    client = _async_clients.get(key)
+    if client is None or client.is_closed:
+        with _lock:
+            client = _async_clients.get(key)
+            if client is None or client.is_closed:
+                logging.debug(f"为 {key[0]} 创建异步连接池，大小 {POOL_SIZE}")
+                # 传入 transport 时 AsyncClient 的 limits 不起作用，连接数上限要设置在 transport 上
+                client = httpx.AsyncClient(
+                    transport=httpx.AsyncHTTPTransport(
+                        limits=httpx.Limits(
+                            max_connections=POOL_SIZE,
+                            max_keepalive_connections=POOL_SIZE if KEEP_ALIVE else 0,
+                        ),
+                        retries=MAX_RETRIES,
+                    ),
+                )
+                _async_clients[key] = client
+    return client
+
+
+def close_response(response, loop=None):
+    """关闭流式响应；httpx 的响应需要回到所属的事件循环中关闭"""
+    try:
+        if loop is None:
+            response.close()
+        else:
+            asyncio.run_coroutine_threadsafe(response.aclose(), loop)
+    except Exception as e:
+        logging.debug(f"关闭流式响应失败：{e}")
+
+
+def close_all():
+    with _lock:
+        sessions = list(_sessions.values())
+        _sessions.clear()
+        # 异步客户端只能在所属的事件循环里关闭，这里只丢弃引用
+        _async_clients.clear()
+    for session in sessions:
+        session.close()
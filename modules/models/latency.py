@@ -0,0 +1,141 @@
+# -*- coding:utf-8 -*-
+"""
+按主机、按模型统计延迟，并据此给出自适应的超时时间
+
+统计三项：响应头到达时间（连接）、首个 token 时间（TTFT）、相邻 token 的间隔。
+超时取对应分位数的若干倍，并限制在上下限之内；样本不足时使用默认值。
+StreamWatchdog 在首个 token 或相邻 token 超时后关闭响应，调用方可以换一台主机重试。
+"""
+import logging
+import threading
+import time
+from collections import defaultdict, deque, namedtuple
+
+from .http_pool import close_response
+
+MIN_SAMPLES = 5  # 样本数少于这个值时使用默认超时
+MAX_SAMPLES = 200  # 每项统计保留的最近样本数
+PERCENTILE = 0.99
+
+DEFAULT_CONNECT_TIMEOUT = 10
+DEFAULT_FIRST_TOKEN_TIMEOUT = 200  # 大模型长 prompt 的预填充可能需要几分钟
+DEFAULT_IDLE_TIMEOUT = 60
+
+# (倍数, 下限, 上限)
+CONNECT_RULE = (3, 2, 30)
+FIRST_TOKEN_RULE = (3, 15, 600)
+IDLE_RULE = (10, 5, 120)
+
+Timeouts = namedtuple("Timeouts", ["connect", "first_token", "idle"])
+
+
+def _percentile(samples, q):
+    ordered = sorted(samples)
+    return ordered[min(int(len(ordered) * q), len(ordered) - 1)]
+
+
+class LatencyTracker:
+    def __init__(self):
+        self.lock = threading.Lock()
+        # (host, model, metric) -> deque
+        self.samples = defaultdict(lambda: deque(maxlen=MAX_SAMPLES))
+
+    def configure(self, connect=None, first_token=None, idle=None):
+        global DEFAULT_CONNECT_TIMEOUT, DEFAULT_FIRST_TOKEN_TIMEOUT, DEFAULT_IDLE_TIMEOUT
+        if connect is not None:
+            DEFAULT_CONNECT_TIMEOUT = connect
+        if first_token is not None:
+            DEFAULT_FIRST_TOKEN_TIMEOUT = first_token
+        if idle is not None:
+            DEFAULT_IDLE_TIMEOUT = idle
+
+    def record(self, host, model, metric, seconds):
+        with self.lock:
+            self.samples[(host, model, metric)].append(seconds)
+
+    def values(self, host, model, metric):
+        with self.lock:
+            return list(self.samples.get((host, model, metric), ()))
+
+    def percentile(self, host, model, metric, q=PERCENTILE):
+        with self.lock:
+            samples = list(self.samples.get((host, model, metric), ()))
+        if len(samples) < MIN_SAMPLES:
+            return None
+        return _percentile(samples, q)
+
+    def _adaptive(self, host, model, metric, rule, default):
+        value = self.percentile(host, model, metric)
+        if value is None:
+            return default
+        factor, lower, upper = rule
+        return min(max(value * factor, lower), upper)
+
+    def timeouts(self, host, model):
+        return Timeouts(
+            connect=self._adaptive(host, model, "connect", CONNECT_RULE, DEFAULT_CONNECT_TIMEOUT),
+            first_token=self._adaptive(host, model, "ttft", FIRST_TOKEN_RULE, DEFAULT_FIRST_TOKEN_TIMEOUT),
+            idle=self._adaptive(host, model, "gap", IDLE_RULE, DEFAULT_IDLE_TIMEOUT),
+        )
+
+    def summary(self, host, model):
+        return {
+            metric: {
+                "p50": self.percentile(host, model, metric, 0.5),
+                "p95": self.percentile(host, model, metric, 0.95),
+                "p99": self.percentile(host, model, metric, 0.99),
+            }
+            for metric in ("connect", "ttft", "gap")
+        }
+
+
+class Watch:
+    def __init__(self, response, timeout, loop=None):
+        self.response = response
+        self.loop = loop
+        self.deadline = time.monotonic() + timeout
+        self.timed_out = False
+
+    def touch(self, timeout):
+        """收到 token 后推迟截止时间"""
+        self.deadline = time.monotonic() + timeout
+
+
+class StreamWatchdog:
+    """用一个后台线程检查所有流式响应，超过截止时间仍没有新 token 时关闭响应"""
+
+    CHECK_INTERVAL = 0.25
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.watches = set()
+        self._thread = None
+
+    def watch(self, response, timeout, loop=None):
+        watch = Watch(response, timeout, loop)
+        with self.lock:
+            self.watches.add(watch)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="stream-watchdog", daemon=True)
+                self._thread.start()
+        return watch
+
+    def unwatch(self, watch):
+        with self.lock:
+            self.watches.discard(watch)
+
+    def _run(self):
+        while True:
+            time.sleep(self.CHECK_INTERVAL)
+            now = time.monotonic()
+            with self.lock:
+                expired = [watch for watch in self.watches if watch.deadline < now]
+                self.watches.difference_update(expired)
+            for watch in expired:
+                watch.timed_out = True
+                logging.warning("等待模型输出超时，关闭连接")
+                close_response(watch.response, watch.loop)
+
+
+latency_tracker = LatencyTracker()
+stream_watchdog = StreamWatchdog()
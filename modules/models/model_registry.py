@@ -0,0 +1,249 @@
+# -*- coding:utf-8 -*-
+"""
+Ollama 模型列表
+
+- 启动时直接读取上次保存的快照，不再在 import 时等待网络请求
+- 后台线程定期请求 /api/tags（多主机时取并集），有变化时更新快照并通知界面
+- 模型元数据按需生成，上下文长度来自 /api/show，查询结果同样保存在快照中；
+  只读取描述等字段时用 ModelMetadata.peek，不请求 /api/show
+- /api/show 只在后台线程中请求（访问元数据、预热时触发），请求路径上不等待网络；
+  还没有获取到（或获取失败）时使用 DEFAULT_CONTEXT_LENGTH，但不缓存，之后的访问会重新获取
+"""
+import json
+import logging
+import os
+import threading
+import time
+
+from .host_pool import host_pool
+from .http_pool import get_session
+
+SNAPSHOT_PATH = os.path.join("cache", "models.json")
+REFRESH_INTERVAL = 300  # 后台刷新模型列表的间隔（秒）
+REQUEST_TIMEOUT = 5
+DEFAULT_CONTEXT_LENGTH = 64000  # /api/show 无法获取时使用的上下文长度
+RESOLVE_RETRY_INTERVAL = 30  # /api/show 失败后，至少间隔多少秒才在后台重新获取
+
+
+class ModelRegistry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.models = []
+        self.context_lengths = {}
+        self.version = 0  # 模型列表每变化一次加一，界面据此判断是否需要刷新
+        self._bound_lists = []
+        self._refresher = None
+        self._resolving = set()  # 正在后台获取上下文长度的模型
+        self._failed_at = {}  # model -> 最近一次获取上下文长度失败的时间
+
+    def load(self, fallback=()):
+        """读取快照；没有快照时同步请求一次，仍然失败则使用 fallback"""
+        if self._load_snapshot() or self.refresh():
+            return list(self.models)
+        logging.warning(f"无法获取 Ollama 模型列表，使用默认列表：{list(fallback)}")
+        return list(fallback)
+
+    def bind(self, models):
+        """模型列表变化时同步更新 models（原地修改，保留其中不属于 Ollama 的条目）"""
+        self._bound_lists.append(models)
+
+    def fetch_models(self):
+        models = []
+        reachable = False
+        for host in host_pool.candidates():
+            try:
+                response = get_session(host.base_url).get(host.url("/api/tags"), timeout=REQUEST_TIMEOUT)
+                response.raise_for_status()
+                names = [model["name"] for model in response.json().get("models", [])]
+            except Exception as e:
+                logging.debug(f"获取 {host.base_url} 的模型列表失败：{e}")
+                continue
+            reachable = True
+            models.extend(name for name in names if name not in models)
+        return models if reachable else None
+
+    def refresh(self):
+        models = self.fetch_models()
+        if models is None:
+            return False
+        with self.lock:
+            if models == self.models:
+                return True
+            previous, self.models = self.models, models
+            self.version += 1
+            for bound in self._bound_lists:
+                extra = [name for name in bound if name not in previous and name not in models]
+                bound[:] = models + extra
+        logging.info(f"Ollama 模型列表已更新：{models}")
+        self._save_snapshot()
+        return True
+
+    def context_length(self, model):
+        if model in self.context_lengths:
+            return self.context_lengths[model]
+        try:
+            host = host_pool.select(model)
+            response = get_session(host.base_url).post(
+                host.url("/api/show"), json={"model": model}, timeout=REQUEST_TIMEOUT
+            )
+            response.raise_for_status()
+            model_info = response.json().get("model_info", {})
+        except Exception as e:
+            logging.debug(f"获取模型 {model} 的信息失败：{e}")
+            with self.lock:
+                self._failed_at[model] = time.time()
+            return DEFAULT_CONTEXT_LENGTH
+        context_length = next(
+            (value for key, value in model_info.items() if key.endswith(".context_length")),
+            DEFAULT_CONTEXT_LENGTH,
+        )
+        with self.lock:
+            self.context_lengths[model] = context_length
+        self._save_snapshot()
+        return context_length
+
+    def resolved(self, model):
+        return model in self.context_lengths
+
+    def resolve_in_background(self, model):
+        """在后台线程中获取上下文长度，同一个模型同时只请求一次"""
+        with self.lock:
+            if model in self.context_lengths or model in self._resolving:
+                return
+            if time.time() - self._failed_at.get(model, 0) < RESOLVE_RETRY_INTERVAL:
+                return
+            self._resolving.add(model)
+
+        def run():
+            try:
+                self.context_length(model)
+            finally:
+                with self.lock:
+                    self._resolving.discard(model)
+
+        threading.Thread(target=run, name=f"model-info-{model}", daemon=True).start()
+
+    def describe(self, model, fetch=True):
+        """生成 MODEL_METADATA 中的条目；fetch 为 False 时不请求 /api/show，没有缓存的上下文长度使用默认值"""
+        if fetch:
+            token_limit = self.context_length(model)
+        else:
+            token_limit = self.context_lengths.get(model, DEFAULT_CONTEXT_LENGTH)
+        return {
+            "model_name": model,
+            "api_host": "OPENAI_API_BASE",
+            "description": model,
+            "token_limit": token_limit,
+            "multimodal": False,
+            "model_type": model.split("-")[0],  # 根据模型名称来推断模型类型
+        }
+
+    def _load_snapshot(self):
+        try:
+            with open(SNAPSHOT_PATH, "r", encoding="utf-8") as f:
+                snapshot = json.load(f)
+        except FileNotFoundError:
+            return False
+        except (OSError, ValueError) as e:
+            logging.warning(f"读取模型列表快照失败：{e}")
+            return False
+        self.models = snapshot.get("models", [])
+        self.context_lengths = snapshot.get("context_lengths", {})
+        return bool(self.models)
+
+    def _save_snapshot(self):
+        with self.lock:
+            snapshot = {
+                "models": self.models,
+                "context_lengths": self.context_lengths,
+                "updated_at": time.time(),
+            }
+        try:
+            os.makedirs(os.path.dirname(SNAPSHOT_PATH), exist_ok=True)
+            tmp_path = f"{SNAPSHOT_PATH}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(snapshot, f, ensure_ascii=False, indent=2)
+            os.replace(tmp_path, SNAPSHOT_PATH)
+        except OSError as e:
+            logging.warning(f"保存模型列表快照失败：{e}")
+
+    def start(self, interval=REFRESH_INTERVAL):
+        """启动后台刷新；第一次刷新立即进行，以便尽快替换掉过期的快照"""
+        if self._refresher is not None or interval <= 0:
+            return
+
+        def run():
+            while True:
+                self.refresh()
+                time.sleep(interval)
+
+        self._refresher = threading.Thread(target=run, name="model-registry-refresh", daemon=True)
+        self._refresher.start()
+
+
+class ModelMetadata(dict):
+    """访问到某个模型时才生成它的元数据，避免启动时为每个模型请求 /api/show
+
+    known 返回当前的模型列表；列表中还没有生成元数据的模型同样参与 in、遍历和 items()，
+    遍历时用 peek 生成，不请求 /api/show，也不缓存。
+    resolver（ModelRegistry）给出上下文长度是否已经获取到；没有获取到时元数据使用默认的上下文长度，
+    不缓存，并交给 resolver 在后台获取。
+    """
+
+    def __init__(self, describe, defaults=None, *args, known=None, resolver=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.describe = describe
+        self.defaults = defaults or {}
+        self.known = known or (lambda: ())
+        self.resolver = resolver
+
+    def __missing__(self, model):
+        metadata = self._build(model)
+        if self.resolved(model):
+            self[model] = metadata
+        else:
+            self.resolver.resolve_in_background(model)
+        return metadata
+
+    def resolved(self, model):
+        """元数据中的上下文长度是否为实际值（不是获取之前的默认值）"""
+        return dict.__contains__(self, model) or self.resolver is None or self.resolver.resolved(model)
+
+    def _build(self, model):
+        metadata = self.defaults.copy()
+        metadata.update(self.describe(model, fetch=False))
+        return metadata
+
+    def _unresolved(self):
+        return [model for model in self.known() if not dict.__contains__(self, model)]
+
+    def peek(self, model):
+        """读取元数据但不请求 /api/show，用于启动时的界面文字、预热参数等"""
+        if dict.__contains__(self, model):
+            return dict.__getitem__(self, model)
+        return self._build(model)
+
+    def __contains__(self, model):
+        return dict.__contains__(self, model) or model in self.known()
+
+    def __iter__(self):
+        yield from dict.__iter__(self)
+        yield from self._unresolved()
+
+    def __len__(self):
+        return dict.__len__(self) + len(self._unresolved())
+
+    def keys(self):
+        return list(self)
+
+    def values(self):
+        return [self.peek(model) for model in self]
+
+    def items(self):
+        return [(model, self.peek(model)) for model in self]
+
+    def get(self, model, default=None):
+        return self[model] if model in self else default
+
+
+model_registry = ModelRegistry()
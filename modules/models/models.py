@@ -1,7 +1,10 @@
 from __future__ import annotations
 
+from .OllamaChat import OllamaChatClient
 from .OllamaVision import OllamaVisionClient
 from .base_model import BaseLLMModel
+from .warmup import is_resident, warm_up_in_background
+from ..config import ollama_native_api
 from ..utils import *
 
 
@@ -25,7 +28,16 @@ def get_model(
     try:
         logging.info(f"正在加载 Ollama 模型: {model_name}")
         access_key = os.environ.get("OPENAI_API_KEY", access_key)
-        model = OllamaVisionClient(model_name, api_key=access_key, user_name=user_name)
+        if ollama_native_api:
+            model = OllamaChatClient(model_name, api_key=access_key, user_name=user_name)
+        else:
+            model = OllamaVisionClient(model_name, api_key=access_key, user_name=user_name)
+        # 在后台提前加载模型，用户的第一条消息不再承担加载时间；
+        # 刷新页面、重建客户端时模型通常已经加载，不再重复预热
+        if is_resident(model.model_name):
+            logging.debug(f"模型 {model.model_name} 已加载，跳过预热")
+        else:
+            warm_up_in_background(model.model_name, model.keep_alive)
         logging.info(msg)
     except Exception as e:
         import traceback
@@ -0,0 +1,142 @@
+# -*- coding:utf-8 -*-
+"""
+temperature 为 0 时的回答缓存
+
+相同的模型、消息和采样参数会得到相同的回答，直接复用即可。
+两级缓存：内存中的 LRU，以及磁盘缓存（进程重启后仍然有效），两级使用同一个过期时间。
+默认关闭，在 config.json 中设置 "response_cache": true 开启。
+"""
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+ENABLED = False
+MAX_ENTRIES = 256  # 内存中最多缓存多少条回答
+TTL = 7 * 24 * 3600  # 缓存的有效期（秒），从写入时算起
+DIRECTORY = os.path.join("cache", "responses")
+REPLAY_CHUNK_SIZE = 8  # 重放缓存时每次输出的字符数
+
+
+def _normalize_content(content):
+    if isinstance(content, str):
+        return content.strip()
+    if isinstance(content, list):
+        return [_normalize_content(item) for item in content]
+    if isinstance(content, dict):
+        return {key: _normalize_content(value) for key, value in content.items()}
+    return content
+
+
+class ResponseCache:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # key -> (写入时间, 回答)
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self):
+        return ENABLED
+
+    def configure(self, enabled=None, max_entries=None, ttl=None, directory=None):
+        global ENABLED, MAX_ENTRIES, TTL, DIRECTORY
+        if enabled is not None:
+            ENABLED = bool(enabled)
+        if max_entries is not None:
+            MAX_ENTRIES = int(max_entries)
+        if ttl is not None:
+            TTL = int(ttl)
+        if directory is not None:
+            DIRECTORY = directory
+
+    @staticmethod
+    def make_key(model, messages, params):
+        """根据模型、规范化后的消息和采样参数生成缓存键"""
+        messages = [
+            {"role": message["role"], "content": _normalize_content(message["content"])}
+            for message in messages
+        ]
+        raw = json.dumps([model, messages, params], ensure_ascii=False, sort_keys=True, default=str)
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(DIRECTORY, key[:2], f"{key}.json")
+
+    def get(self, key):
+        if not ENABLED or key is None:
+            return None
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                stored_at, value = entry
+                if time.time() - stored_at <= TTL:
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self.entries[key]
+        entry = self._read_disk(key)
+        with self.lock:
+            if entry is None:
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+            self._remember(key, *entry)
+        return entry[1]
+
+    def put(self, key, value):
+        if not ENABLED or key is None:
+            return
+        with self.lock:
+            self._remember(key, time.time(), value)
+        self._write_disk(key, value)
+
+    def _remember(self, key, stored_at, value):
+        self.entries[key] = (stored_at, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > MAX_ENTRIES:
+            self.entries.popitem(last=False)
+
+    def _read_disk(self, key):
+        """返回 (写入时间, 回答)，过期或不存在时返回 None"""
+        path = self._path(key)
+        try:
+            stored_at = os.path.getmtime(path)
+            if time.time() - stored_at > TTL:
+                os.remove(path)
+                return None
+            with open(path, "r", encoding="utf-8") as f:
+                return stored_at, json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logging.debug(f"读取回答缓存失败：{e}")
+            return None
+
+    def _write_disk(self, key, value):
+        path = self._path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(value, f, ensure_ascii=False)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logging.debug(f"写入回答缓存失败：{e}")
+
+    def stats(self):
+        lookups = self.hits + self.disk_hits + self.misses
+        return {
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits + self.disk_hits) / lookups if lookups else 0.0,
+            "entries": len(self.entries),
+        }
+
+
+response_cache = ResponseCache()
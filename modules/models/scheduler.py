@@ -0,0 +1,274 @@
+# -*- coding:utf-8 -*-
+"""
+生成请求的准入控制
+
+- 每个主机、每个模型同时进行的生成数量有上限，超出的请求排队
+- 排队策略：fair 在不同用户之间轮流放行，fifo 按提交顺序放行
+- 排队期间可以查询当前位置和预计等待时间，用于在 status_display 中展示
+- 优先级：交互式对话优先；起标题、总结等后台任务走低优先级通道，
+  有交互请求排队时一律推迟，并且只能占用主机的空余容量
+- 同一轮对话并发生成多个回答时（n_choices > 1），它们属于同一组，
+  每组在一台主机上同时进行的数量不超过 MAX_CHOICES_PER_HOST
+"""
+import logging
+import math
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+from .host_pool import host_pool
+
+MAX_INFLIGHT_PER_HOST = 4  # 与 Ollama 默认的 OLLAMA_NUM_PARALLEL 一致
+MAX_INFLIGHT_PER_MODEL = 0  # 0 表示不限制
+POLICY = "fair"  # fair / fifo
+AVERAGE_DURATION = 20.0  # 还没有统计数据时假定的单次生成耗时（秒）
+DURATION_SMOOTHING = 0.2  # 生成耗时滑动平均的权重
+POLL_INTERVAL = 0.5  # 排队时刷新状态的间隔（秒）
+MAX_BACKGROUND_INFLIGHT = 1  # 后台任务同时进行的数量上限
+BACKGROUND_WORKERS = 2  # 执行后台任务的线程数
+MAX_CHOICES_PER_HOST = 2  # 同一组请求在一台主机上同时进行的数量上限，0 表示不限制
+
+INTERACTIVE = 0
+BACKGROUND = 1
+
+
+class Ticket:
+    def __init__(self, user, model, priority=INTERACTIVE, group=None):
+        self.user = user
+        self.model = model
+        self.priority = priority
+        self.group = group or self  # 同一组的请求共享第一个请求作为组标识
+        self.host = None  # 放行时分配的主机
+        self.submitted_at = time.time()
+        self.admitted_at = None
+        self.admitted = threading.Event()
+        self.position = 0  # 排在第几位，放行后为 0
+        self.eta = 0  # 预计等待秒数
+
+    def wait(self, timeout=None):
+        return self.admitted.wait(timeout)
+
+    @property
+    def queue_state(self):
+        return self.position, self.eta
+
+    def __repr__(self):
+        return f"Ticket({self.user}, {self.model}, host={self.host})"
+
+
+class Scheduler:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.queues = OrderedDict()  # user -> deque[Ticket]，fifo 策略下只有一个队列
+        self.host_counts = {}  # base_url -> 进行中的生成数
+        self.model_counts = {}  # model -> 进行中的生成数
+        self.user_counts = {}  # user -> 进行中的生成数
+        self.group_host_counts = {}  # (组, base_url) -> 进行中的生成数
+        self.background_queue = deque()  # 低优先级通道，按提交顺序放行
+        self.background_host_counts = {}  # base_url -> 进行中的后台任务数
+        self.background_count = 0
+        self.average_duration = AVERAGE_DURATION
+        self._executor = None
+
+    def configure(self, max_per_host=None, max_per_model=None, policy=None, max_background=None, max_choices_per_host=None):
+        global MAX_INFLIGHT_PER_HOST, MAX_INFLIGHT_PER_MODEL, POLICY, MAX_BACKGROUND_INFLIGHT, MAX_CHOICES_PER_HOST
+        if max_choices_per_host is not None:
+            MAX_CHOICES_PER_HOST = int(max_choices_per_host)
+        if max_background is not None:
+            MAX_BACKGROUND_INFLIGHT = int(max_background)
+        if max_per_host is not None:
+            MAX_INFLIGHT_PER_HOST = int(max_per_host)
+        if max_per_model is not None:
+            MAX_INFLIGHT_PER_MODEL = int(max_per_model)
+        if policy is not None:
+            if policy not in ("fair", "fifo"):
+                logging.warning(f"未知的排队策略 {policy}，使用 fair")
+                policy = "fair"
+            POLICY = policy
+
+    def submit(self, user, model, priority=INTERACTIVE, group=None):
+        ticket = Ticket(user, model, priority, group)
+        with self.lock:
+            if priority == BACKGROUND:
+                self.background_queue.append(ticket)
+            else:
+                key = user if POLICY == "fair" else None
+                self.queues.setdefault(key, deque()).append(ticket)
+            self._dispatch()
+        return ticket
+
+    def submit_background(self, user, model, fn, *args, **kwargs):
+        """在后台线程中以低优先级执行 fn，返回 Future"""
+        if self._executor is None:
+            with self.lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(BACKGROUND_WORKERS, thread_name_prefix="llm-background")
+
+        def run():
+            ticket = self.submit(user, model, BACKGROUND)
+            ticket.wait()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.release(ticket)
+
+        return self._executor.submit(run)
+
+    def try_admit(self, user, model, host, group=None):
+        """不排队，立即在指定主机上放行一个交互请求；主机没有空余容量或有请求在排队时返回 None
+
+        用于对冲请求：额外的一路请求同样计入主机的并发上限，但不能插到排队的请求前面。
+        """
+        ticket = Ticket(user, model, group=group)
+        with self.lock:
+            if self.queues or (MAX_INFLIGHT_PER_MODEL > 0 and self.model_counts.get(model, 0) >= MAX_INFLIGHT_PER_MODEL):
+                return None
+            if not self._has_room(host, group=ticket.group):
+                return None
+            self._admit(ticket, host)
+        # 对冲请求大多很快被放弃，不计入平均生成耗时
+        ticket.admitted_at = None
+        return ticket
+
+    def cancel(self, ticket):
+        """放弃排队；已经放行的请求等同于 release"""
+        with self.lock:
+            # 放行在持有锁时进行，必须在锁内判断，否则判断之后被放行的请求既不在队列中也不会被释放
+            if ticket.admitted.is_set():
+                self._release(ticket)
+                return
+            if ticket in self.background_queue:
+                self.background_queue.remove(ticket)
+            for key, queue in self.queues.items():
+                if ticket in queue:
+                    queue.remove(ticket)
+                    if not queue:
+                        del self.queues[key]
+                    break
+            self._dispatch()
+
+    def release(self, ticket):
+        with self.lock:
+            self._release(ticket)
+
+    def _release(self, ticket):
+        if ticket.priority == BACKGROUND:
+            self.background_count -= 1
+            if ticket.host is not None:
+                self.background_host_counts[ticket.host] -= 1
+            self._dispatch()
+            return
+        if ticket.host is not None:
+            self.host_counts[ticket.host] = max(self.host_counts.get(ticket.host, 0) - 1, 0)
+            group_key = (ticket.group, ticket.host)
+            self.group_host_counts[group_key] = self.group_host_counts.get(group_key, 0) - 1
+            if self.group_host_counts[group_key] <= 0:
+                del self.group_host_counts[group_key]
+        self.model_counts[ticket.model] = max(self.model_counts.get(ticket.model, 0) - 1, 0)
+        self.user_counts[ticket.user] = max(self.user_counts.get(ticket.user, 0) - 1, 0)
+        if ticket.admitted_at is not None:
+            duration = time.time() - ticket.admitted_at
+            self.average_duration += DURATION_SMOOTHING * (duration - self.average_duration)
+        self._dispatch()
+
+    def _capacity(self, model):
+        capacity = len(host_pool) * MAX_INFLIGHT_PER_HOST if MAX_INFLIGHT_PER_HOST > 0 and len(host_pool) else math.inf
+        if MAX_INFLIGHT_PER_MODEL > 0:
+            capacity = min(capacity, MAX_INFLIGHT_PER_MODEL)
+        return capacity
+
+    def _pick_host(self, model, background=False, group=None):
+        """返回可用的主机，没有空闲主机时返回 False
+
+        交互请求不把后台任务计入主机负载，因此后台任务永远不会挡住交互请求；
+        后台任务只能使用交互请求没有占用的容量。
+        """
+        if MAX_INFLIGHT_PER_MODEL > 0 and self.model_counts.get(model, 0) >= MAX_INFLIGHT_PER_MODEL:
+            return False
+        candidates = host_pool.candidates(model)
+        if not candidates:
+            return None
+        for host in candidates:
+            if self._has_room(host.base_url, background, group):
+                return host.base_url
+        return False
+
+    def _has_room(self, host, background=False, group=None):
+        used = self.host_counts.get(host, 0)
+        if background:
+            used += self.background_host_counts.get(host, 0)
+        if MAX_INFLIGHT_PER_HOST > 0 and used >= MAX_INFLIGHT_PER_HOST:
+            return False
+        if (
+            group is not None
+            and MAX_CHOICES_PER_HOST > 0
+            and self.group_host_counts.get((group, host), 0) >= MAX_CHOICES_PER_HOST
+        ):
+            return False
+        return True
+
+    def _admit(self, ticket, host):
+        ticket.host = host
+        ticket.admitted_at = time.time()
+        ticket.position = 0
+        ticket.eta = 0
+        if ticket.priority == BACKGROUND:
+            self.background_count += 1
+            if host is not None:
+                self.background_host_counts[host] = self.background_host_counts.get(host, 0) + 1
+            ticket.admitted.set()
+            return
+        if host is not None:
+            self.host_counts[host] = self.host_counts.get(host, 0) + 1
+            group_key = (ticket.group, host)
+            self.group_host_counts[group_key] = self.group_host_counts.get(group_key, 0) + 1
+        self.model_counts[ticket.model] = self.model_counts.get(ticket.model, 0) + 1
+        self.user_counts[ticket.user] = self.user_counts.get(ticket.user, 0) + 1
+        ticket.admitted.set()
+
+    def _ordered_queues(self):
+        # 正在生成的请求越少的用户越先放行，相同时按轮转顺序
+        return sorted(self.queues, key=lambda key: self.user_counts.get(key, 0) if key is not None else 0)
+
+    def _dispatch(self):
+        """在持有锁的情况下放行所有能放行的请求，然后更新排队位置"""
+        progressed = True
+        while progressed:
+            progressed = False
+            for key in self._ordered_queues():
+                queue = self.queues[key]
+                host = self._pick_host(queue[0].model, group=queue[0].group)
+                if host is False:
+                    continue
+                self._admit(queue.popleft(), host)
+                # 轮转到队尾，下一次优先放行其他用户
+                self.queues.move_to_end(key)
+                if not queue:
+                    del self.queues[key]
+                progressed = True
+                break
+        # 有交互请求在排队时推迟所有后台任务
+        while self.background_queue and not self.queues and self.background_count < MAX_BACKGROUND_INFLIGHT:
+            host = self._pick_host(self.background_queue[0].model, background=True)
+            if host is False:
+                break
+            self._admit(self.background_queue.popleft(), host)
+        self._update_positions()
+
+    def _update_positions(self):
+        queues = [self.queues[key] for key in self._ordered_queues()]
+        for index, queue in enumerate(queues):
+            for depth, ticket in enumerate(queue):
+                # 轮转放行：排在前面的用户最多放行 depth + 1 个，后面的用户最多 depth 个
+                ahead = depth
+                for other_index, other in enumerate(queues):
+                    if other_index != index:
+                        ahead += min(len(other), depth + 1 if other_index < index else depth)
+                ticket.position = ahead + 1
+                capacity = self._capacity(ticket.model)
+                rounds = 1 if capacity == math.inf else math.ceil(ticket.position / capacity)
+                ticket.eta = int(rounds * self.average_duration)
+
+
+scheduler = Scheduler()
@@ -0,0 +1,165 @@
+# -*- coding:utf-8 -*-
+"""
+流式回答的结构化表示
+
+思考过程（reasoning）和正文分段追加，不在每个 chunk 上拼接整个字符串。
+推送给界面的是 StreamFrame：只记录此刻两段的长度，delta_streaming 模式下只取出新增的部分，
+需要完整字符串时（交给 Gradio 渲染、生成结束）才拼接一次，并加上 <details> 包装。
+get_answer_stream_iter 可以直接产出 StreamAnswer，str() 之后与原来的字符串完全相同。
+并发生成多个回答时，生成线程追加、界面线程读取同一个对象，追加、合并和读取都在锁内进行。
+"""
+import threading
+import time
+
+
+def reasoning_summary(thinking, elapsed_seconds):
+    return f"Thinking ({elapsed_seconds}s)" if thinking else f"Thought for {elapsed_seconds} s"
+
+
+def wrap_reasoning(reasoning, content, thinking, elapsed_seconds):
+    if not reasoning:
+        return content
+    summary = reasoning_summary(thinking, elapsed_seconds)
+    return f"<details{' open' if thinking else ''}>\n<summary>{summary}</summary>\n{reasoning}</details>\n\n" + content
+
+
+class _Segment:
+    """只追加的文本：保存各次追加的片段和总长度，可以只取出某个位置之后的文本"""
+
+    __slots__ = ("parts", "length")
+
+    def __init__(self, text=""):
+        self.parts = [text] if text else []
+        self.length = len(text)
+
+    def append(self, text):
+        self.parts.append(text)
+        self.length += len(text)
+
+    def text(self, end=None):
+        # 合并后只保留一段，之后的追加和读取都从这一段开始
+        if len(self.parts) > 1:
+            self.parts[:] = ["".join(self.parts)]
+        text = self.parts[0] if self.parts else ""
+        return text if end is None or end >= self.length else text[:end]
+
+    def slice(self, offset, end):
+        """[offset, end) 之间的文本，从末尾向前只访问这一范围内的片段"""
+        if offset <= 0:
+            return self.text(end)
+        last = self.parts[-1]
+        if end == self.length and offset >= end - len(last):
+            # 常见情况：上一帧之后只追加了最后一个片段
+            return last[offset - end:] if offset < end else ""
+        pieces = []
+        position = self.length
+        for part in reversed(self.parts):
+            start = position - len(part)
+            if start < end and position > offset:
+                pieces.append(part[max(offset - start, 0):min(end, position) - start])
+            if start <= offset:
+                break
+            position = start
+        return "".join(reversed(pieces))
+
+
+class StreamAnswer:
+    def __init__(self, reasoning="", elapsed_seconds=0):
+        self._content = _Segment()
+        self._reasoning = _Segment(reasoning)
+        self.reasoning_start_time = None
+        self.elapsed_seconds = elapsed_seconds
+        self.thinking = False  # 最近收到的是否为思考过程，决定 <details> 是否展开
+        self._lock = threading.Lock()
+
+    def add_content(self, text):
+        with self._lock:
+            self._content.append(text)
+            self.thinking = False
+
+    def add_reasoning(self, text):
+        with self._lock:
+            now = time.time()
+            if self.reasoning_start_time is None:
+                self.reasoning_start_time = now
+            self._reasoning.append(text)
+            self.elapsed_seconds = int(now - self.reasoning_start_time)
+            self.thinking = True
+
+    @property
+    def content(self):
+        with self._lock:
+            return self._content.text()
+
+    @property
+    def reasoning(self):
+        with self._lock:
+            return self._reasoning.text()
+
+    def __len__(self):
+        return self._content.length + self._reasoning.length
+
+    def frame(self, suffix=""):
+        """当前状态的一帧，suffix 为附加在正文之后的内容（搜索结果等）"""
+        with self._lock:
+            return StreamFrame(
+                self, self._reasoning.length, self._content.length, self.thinking, self.elapsed_seconds, suffix
+            )
+
+    def _slice(self, segment, offset, end):
+        with self._lock:
+            return (self._reasoning if segment == "reasoning" else self._content).slice(offset, end)
+
+    def render(self):
+        with self._lock:
+            content = self._content.text()
+            reasoning = self._reasoning.text()
+            thinking = self.thinking
+            elapsed_seconds = self.elapsed_seconds
+        return wrap_reasoning(reasoning, content, thinking, elapsed_seconds)
+
+    __str__ = render
+
+
+class StreamFrame:
+    """推送给界面的一帧：只记录此刻思考过程和正文的长度，str() 时才拼接成完整的回答"""
+
+    __slots__ = ("answer", "reasoning_length", "content_length", "thinking", "elapsed_seconds", "suffix")
+
+    def __init__(self, answer, reasoning_length, content_length, thinking, elapsed_seconds, suffix=""):
+        self.answer = answer
+        self.reasoning_length = reasoning_length
+        self.content_length = content_length
+        self.thinking = thinking
+        self.elapsed_seconds = elapsed_seconds
+        self.suffix = suffix
+
+    @property
+    def summary(self):
+        return reasoning_summary(self.thinking, self.elapsed_seconds) if self.reasoning_length else ""
+
+    def reasoning_since(self, offset):
+        if offset >= self.reasoning_length:
+            return ""
+        return self.answer._slice("reasoning", offset, self.reasoning_length)
+
+    def content_since(self, offset):
+        """offset 之后的正文，不包含 suffix"""
+        if offset >= self.content_length:
+            return ""
+        return self.answer._slice("content", offset, self.content_length)
+
+    def __len__(self):
+        return self.reasoning_length + self.content_length + len(self.suffix)
+
+    def __str__(self):
+        return wrap_reasoning(
+            self.reasoning_since(0), self.content_since(0), self.thinking, self.elapsed_seconds
+        ) + self.suffix
+
+
+def stream_frame(partial_text, suffix=""):
+    """推送给界面的内容：StreamAnswer 返回 StreamFrame，其他模型产出的字符串直接拼接"""
+    if isinstance(partial_text, StreamAnswer):
+        return partial_text.frame(suffix)
+    return str(partial_text) + suffix
@@ -0,0 +1,136 @@
+# -*- coding:utf-8 -*-
+"""
+增量式 SSE / NDJSON 流解码器
+
+直接在字节上按行切分，复用同一个缓冲区，每一行只做一次 JSON 解析，
+输出统一的 StreamDelta，供同步和异步两条流式路径共用。
+"""
+import json
+from collections import namedtuple
+
+try:
+    import orjson
+
+    _loads = orjson.loads  # 可以直接解析 memoryview，不需要拷贝
+    _ACCEPTS_MEMORYVIEW = True
+except ImportError:
+    _loads = json.loads
+    _ACCEPTS_MEMORYVIEW = False
+
+# content: 正文增量；reasoning: 思考过程增量；finish_reason: 结束原因；usage: 服务端统计的 token 用量
+StreamDelta = namedtuple("StreamDelta", ["content", "reasoning", "finish_reason", "usage"])
+
+SSE = "sse"  # OpenAI 兼容接口 /v1/chat/completions
+NDJSON = "ndjson"  # Ollama 原生接口 /api/chat
+
+_DATA_PREFIX = b"data:"
+_DONE = b"[DONE]"
+
+
+class StreamDecoder:
+    def __init__(self, mode=SSE):
+        self.mode = mode
+        self.buffer = bytearray()
+        self.done = False  # 收到 [DONE] 或 NDJSON 的 done=true
+        self.error_text = ""  # 无法解析的内容，通常是服务端返回的错误信息
+
+    def feed(self, data):
+        """送入一段字节，返回其中完整行解析出的 StreamDelta 列表"""
+        buffer = self.buffer
+        buffer += data
+        view = memoryview(buffer)
+        deltas = []
+        start = 0
+        try:
+            while True:
+                end = buffer.find(b"\n", start)
+                if end < 0:
+                    break
+                line_end = end - 1 if end > start and buffer[end - 1] == 0x0D else end
+                if line_end > start:
+                    delta = self._decode_line(view[start:line_end])
+                    if delta is not None:
+                        deltas.append(delta)
+                start = end + 1
+        finally:
+            view.release()
+        if start:
+            del buffer[:start]
+        return deltas
+
+    def close(self):
+        """流结束时处理缓冲区中没有换行结尾的最后一行"""
+        deltas = []
+        if self.buffer:
+            deltas = self.feed(b"\n")
+        self.buffer.clear()
+        return deltas
+
+    def _decode_line(self, line):
+        if self.mode == SSE:
+            if line[0] == 0x3A:  # ":" 开头是注释，例如 ": keep-alive"
+                return None
+            if line[:5] != _DATA_PREFIX:
+                self.error_text += bytes(line).decode("utf-8", "replace")
+                return None
+            line = line[6:] if line[5:6] == b" " else line[5:]
+            if line == _DONE:
+                self.done = True
+                return None
+        try:
+            chunk = _loads(line if _ACCEPTS_MEMORYVIEW else bytes(line))
+        except ValueError:
+            self.error_text += bytes(line).decode("utf-8", "replace")
+            return None
+        if self.mode == SSE:
+            return self._decode_openai_chunk(chunk)
+        return self._decode_ollama_chunk(chunk)
+
+    def _decode_openai_chunk(self, chunk):
+        choices = chunk.get("choices")
+        usage = chunk.get("usage")
+        if not choices:
+            if "error" in chunk:
+                self.error_text += json.dumps(chunk["error"], ensure_ascii=False)
+                return None
+            return StreamDelta(None, None, None, usage) if usage else None
+        choice = choices[0]
+        delta = choice.get("delta")
+        if delta is None:
+            return None
+        finish_reason = choice.get("finish_reason") or choice.get("finish_details") or chunk.get("finish_details")
+        reasoning = delta.get("reasoning_content") or delta.get("reasoning")
+        return StreamDelta(delta.get("content"), reasoning, finish_reason, usage)
+
+    def _decode_ollama_chunk(self, chunk):
+        if "error" in chunk:
+            self.error_text += str(chunk["error"])
+            return None
+        message = chunk.get("message") or {}
+        if chunk.get("done"):
+            self.done = True
+            usage = {key: value for key, value in chunk.items() if key.endswith(("_count", "_duration"))}
+            return StreamDelta(message.get("content"), message.get("thinking"), chunk.get("done_reason", "stop"), usage)
+        return StreamDelta(message.get("content"), message.get("thinking"), None, None)
+
+
+def iter_stream_deltas(response, mode=SSE):
+    """从 requests 的流式响应中逐个产出 StreamDelta"""
+    decoder = StreamDecoder(mode)
+    for data in response.iter_content(chunk_size=None):
+        yield from decoder.feed(data)
+    yield from decoder.close()
+    if decoder.error_text:
+        raise Exception(decoder.error_text)
+
+
+async def aiter_stream_deltas(response, mode=SSE):
+    """从 httpx 的流式响应中逐个产出 StreamDelta"""
+    decoder = StreamDecoder(mode)
+    async for data in response.aiter_bytes():
+        for delta in decoder.feed(data):
+            yield delta
+    for delta in decoder.close():
+        yield delta
+    if decoder.error_text:
+        raise Exception(decoder.error_text)
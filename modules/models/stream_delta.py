@@ -0,0 +1,74 @@
+# -*- coding:utf-8 -*-
+"""
+delta_streaming 模式下正在生成的回答的增量
+
+每条回答记录已经发送到前端的部分，下一次只发送新增的文本：
+- 普通字符串：按与上次发送内容的公共前缀计算 {"offset", "text"}，由前端截断后追加
+- StreamFrame：思考过程和正文分别计算，另外发送 <details> 的标题。
+  标题中的 Thinking (Ns) 每秒都会变化，放在回答的最前面，按整个字符串比较时每秒都要重新发送全文；
+  分段后标题单独发送，思考过程和正文只发送新增的部分，前端用 DOM 组装，不显示原始的 <details> 标记
+"""
+from .stream_answer import StreamFrame
+
+
+def common_prefix_length(a, b):
+    if b.startswith(a):
+        return len(a)
+    # 二分查找，每次比较都在 C 中完成
+    low, high = 0, min(len(a), len(b))
+    while low < high:
+        middle = (low + high + 1) // 2
+        if a[:middle] == b[:middle]:
+            low = middle
+        else:
+            high = middle - 1
+    return low
+
+
+class MessageDelta:
+    """一条回答已经发送到前端的部分；完整同步之后新建，第一次增量从头发送"""
+
+    def __init__(self, message_id):
+        self.message_id = message_id
+        self.sent = ""  # 字符串回答已发送的内容
+        self.segmented = False  # 上一次发送的是否为 StreamFrame
+        self.reasoning = 0  # StreamFrame 已发送的思考过程长度
+        self.content = 0  # StreamFrame 已发送的正文长度
+        self.summary = None
+
+    def next(self, message):
+        """返回下一次要发送的增量，没有变化时返回 None"""
+        if isinstance(message, StreamFrame):
+            return self._next_segments(message)
+        if self.segmented:
+            self.segmented = False
+            self.sent = ""
+        if message == self.sent:
+            return None
+        offset = common_prefix_length(self.sent, message)
+        self.sent = message
+        return {"id": self.message_id, "offset": offset, "text": message[offset:]}
+
+    def _next_segments(self, frame):
+        if not self.segmented:
+            self.segmented = True
+            self.reasoning = self.content = 0
+            self.summary = None
+        reasoning = frame.reasoning_since(self.reasoning)
+        content = frame.content_since(self.content)
+        summary = frame.summary
+        if not reasoning and not content and summary == self.summary:
+            return None
+        delta = {
+            "id": self.message_id,
+            "offset": self.content,
+            "text": content,
+            "reasoning_offset": self.reasoning,
+            "reasoning": reasoning,
+            "summary": summary,
+            "open": frame.thinking,
+        }
+        self.reasoning = frame.reasoning_length
+        self.content = frame.content_length
+        self.summary = summary
+        return delta
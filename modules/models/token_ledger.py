@@ -0,0 +1,62 @@
+# -*- coding:utf-8 -*-
+"""
+每轮对话的 token 计数
+
+代替原来的 all_token_counts 列表：用 deque 保存各轮的 token 数，同时维护总数和累计消耗，
+追加、删除最早或最后一轮、修改某一轮都是 O(1)，裁剪上下文和 token_message 不再反复求和。
+累计消耗按每轮都重新发送之前全部上下文计算，即各轮前缀和之和。
+"""
+from collections import deque
+
+
+class TokenLedger:
+    def __init__(self, counts=()):
+        self._counts = deque()
+        self.total = 0  # 各轮之和，即当前上下文的 token 数
+        self.consumed = 0  # 各轮前缀和之和
+        for count in counts:
+            self.append(count)
+
+    def append(self, count):
+        self._counts.append(count)
+        self.total += count
+        self.consumed += self.total
+
+    def pop(self):
+        count = self._counts.pop()
+        self.consumed -= self.total
+        self.total -= count
+        return count
+
+    def popleft(self):
+        # 剩下每一轮的前缀和都少了 count，被删除的一轮本身的前缀和就是 count
+        count = self._counts.popleft()
+        self.consumed -= count * (len(self._counts) + 1)
+        self.total -= count
+        return count
+
+    @property
+    def previous_total(self):
+        """除最后一轮以外的 token 数"""
+        return self.total - self._counts[-1] if self._counts else 0
+
+    def __getitem__(self, index):
+        return self._counts[index]
+
+    def __setitem__(self, index, count):
+        if index < 0:
+            index += len(self._counts)
+        delta = count - self._counts[index]
+        self._counts[index] = count
+        self.total += delta
+        # 从这一轮开始的每个前缀和都变化 delta
+        self.consumed += delta * (len(self._counts) - index)
+
+    def __len__(self):
+        return len(self._counts)
+
+    def __iter__(self):
+        return iter(self._counts)
+
+    def __repr__(self):
+        return f"TokenLedger({list(self._counts)})"
@@ -0,0 +1,71 @@
+# -*- coding:utf-8 -*-
+"""
+模型预热
+
+选择模型或启动时，用空 prompt 调用 /api/generate 让 Ollama 提前把模型加载进显存，
+把冷启动的耗时从用户的第一条消息中移走；同时获取模型的上下文长度（/api/show）。加载到哪台主机记录在 host_pool 中，
+之后的请求会优先发往已经加载了该模型的主机。
+"""
+import logging
+import threading
+import time
+
+from .host_pool import host_pool
+from .http_pool import get_session
+from .model_registry import model_registry
+
+ENABLED = True
+WARMUP_TIMEOUT = 300  # 大模型加载可能需要几分钟
+
+_pending = set()
+_lock = threading.Lock()
+
+
+def configure(enabled=None):
+    global ENABLED
+    if enabled is not None:
+        ENABLED = bool(enabled)
+
+
+def is_resident(model):
+    return host_pool.is_resident(model)
+
+
+def warm_up(model, keep_alive=None, host=None):
+    """在 host（默认为调度时会选中的主机）上加载模型，不生成任何 token"""
+    host = host or host_pool.select(model)
+    if host is None:
+        return False
+    payload = {"model": model, "prompt": ""}
+    if keep_alive is not None:
+        payload["keep_alive"] = keep_alive
+    start_time = time.time()
+    try:
+        response = get_session(host.base_url).post(host.url("/api/generate"), json=payload, timeout=WARMUP_TIMEOUT)
+        response.raise_for_status()
+    except Exception as e:
+        logging.warning(f"预热模型 {model} 失败：{e}")
+        return False
+    host_pool.mark_loaded(host, model)
+    logging.info(f"模型 {model} 已在 {host.base_url} 上加载，耗时 {time.time() - start_time:.1f} 秒")
+    return True
+
+
+def warm_up_in_background(model, keep_alive=None):
+    if not ENABLED or not model or is_resident(model):
+        return
+    with _lock:
+        if model in _pending:
+            return
+        _pending.add(model)
+
+    def run():
+        try:
+            if not model_registry.resolved(model):
+                model_registry.context_length(model)
+            warm_up(model, keep_alive)
+        finally:
+            with _lock:
+                _pending.discard(model)
+
+    threading.Thread(target=run, name=f"warmup-{model}", daemon=True).start()
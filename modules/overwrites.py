@@ -1,5 +1,7 @@
 from __future__ import annotations
 
+from functools import lru_cache
+
 import gradio as gr
 import multipart
 from multipart.multipart import MultipartState, CR, LF, HYPHEN, COLON, lower_char, LOWER_A, LOWER_Z, SPACE, FLAG_PART_BOUNDARY, FLAG_LAST_BOUNDARY, join_bytes
@@ -10,6 +12,9 @@ from gradio_client import utils as client_utils
 
 from modules.utils import convert_bot_before_marked, convert_user_before_marked
 
+# 已经渲染过的历史消息数量上限；流式输出时每个 token 都会重新渲染整个 chatbot
+POSTPROCESS_CACHE_SIZE = 2048
+
 
 def postprocess(
     self,
@@ -24,7 +29,8 @@ def postprocess(
     if value is None:
         return ChatbotData(root=[])
     processed_messages = []
-    for message_pair in value:
+    last_index = len(value) - 1
+    for index, message_pair in enumerate(value):
         if not isinstance(message_pair, (tuple, list)):
             raise TypeError(
                 f"Expected a list of lists or list of tuples. Received: {message_pair}"
@@ -33,17 +39,33 @@ def postprocess(
             raise TypeError(
                 f"Expected a list of lists of length 2 or list of tuples of length 2. Received: {message_pair}"
             )
+        # 最后一条消息在流式输出中每次都不同，不放进缓存，以免挤掉历史消息
+        cache = index != last_index
         processed_messages.append(
             [
-                self._postprocess_chat_messages(message_pair[0], "user"),
-                self._postprocess_chat_messages(message_pair[1], "bot"),
+                self._postprocess_chat_messages(message_pair[0], "user", cache),
+                self._postprocess_chat_messages(message_pair[1], "bot", cache),
             ]
         )
     return ChatbotData(root=processed_messages)
 
 
+@lru_cache(maxsize=POSTPROCESS_CACHE_SIZE)
+def convert_message_cached(chat_message: str, role: str) -> str:
+    return convert_message(chat_message, role)
+
+
+def convert_message(chat_message: str, role: str) -> str:
+    if role == "bot":
+        # chat_message = inspect.cleandoc(chat_message)
+        return convert_bot_before_marked(chat_message)
+    elif role == "user":
+        return convert_user_before_marked(chat_message)
+    return chat_message
+
+
 def postprocess_chat_messages(
-    self, chat_message: str | tuple | list | None, role: str
+    self, chat_message: str | tuple | list | None, role: str, cache: bool = False
 ) -> str | FileMessage | None:
     if chat_message is None:
         return None
@@ -57,12 +79,9 @@ def postprocess_chat_messages(
         )
     elif isinstance(chat_message, str):
         # chat_message = inspect.cleandoc(chat_message)
-        if role == "bot":
-            # chat_message = inspect.cleandoc(chat_message)
-            chat_message = convert_bot_before_marked(chat_message)
-        elif role == "user":
-            chat_message = convert_user_before_marked(chat_message)
-        return chat_message
+        if cache:
+            return convert_message_cached(chat_message, role)
+        return convert_message(chat_message, role)
     else:
         raise ValueError(f"Invalid message for Chatbot component: {chat_message}")
 
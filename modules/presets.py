@@ -3,7 +3,8 @@ import os
 from pathlib import Path
 import gradio as gr
 
-from modules.models.MyOllama import OllamaClient
+from modules.models.host_pool import host_pool
+from modules.models.model_registry import model_registry, ModelMetadata
 from .webui_locale import I18nAuto
 
 i18n = I18nAuto()  # internationalization
@@ -57,9 +58,10 @@ INDEX_QUERY_TEMPRATURE = 1.0
 CHUANHU_TITLE = i18n("SAMT Chat 🚀")
 
 
-# 获取本地模型数据
-client = OllamaClient(API_HOST)
-LOCAL_MODELS = client.get_local_models()
+# 获取本地模型数据：优先读取上次保存的快照，之后由后台线程定期刷新
+# config.json 中的 ollama_hosts 会覆盖这里的主机列表
+host_pool.set_hosts([API_HOST])
+LOCAL_MODELS = model_registry.load(fallback=["llama3", "mistral"])
 
 DEFAULT_METADATA = {
     "repo_id": None, # HuggingFace repo id, used if this model is meant to be downloaded from HuggingFace then run locally
@@ -85,21 +87,15 @@ DEFAULT_METADATA = {
     "frequency_penalty": 0.0,
     "logit_bias": None,
     "stream": True,
+    "keep_alive": None, # how long Ollama keeps the model loaded after a request, e.g. "30m" or -1; None uses the server default
+    "hedge": None, # whether to send a duplicate request to a second Ollama host when the first token is slow; None follows "hedged_requests" in config.json
+    "tokenizer": None, # tokenizer used to count tokens, a HuggingFace repo id or "tiktoken:<encoding>"; None infers it from the model name
     "metadata": {} # additional metadata for the model
 }
 
 # Additional metadata for online and local models
-MODEL_METADATA = {}
-# 循环LOCAL_MODELS数组
-for model in LOCAL_MODELS:
-    MODEL_METADATA[model] = {
-        "model_name": model,
-        "api_host": "OPENAI_API_BASE",  # 这里请根据实际情况替换
-        "description": model,
-        "token_limit": 64000,
-        "multimodal": False,
-        "model_type": model.split("-")[0]  # 根据模型名称来推断模型类型
-    }
+# Ollama 模型的元数据在第一次访问时生成，上下文长度取自 /api/show
+MODEL_METADATA = ModelMetadata(model_registry.describe, known=lambda: MODELS, resolver=model_registry)
 
 
 MODELS = LOCAL_MODELS
@@ -111,6 +107,10 @@ DEFAULT_MODEL = 0
 
 RENAME_MODEL = 0
 
+# 后台刷新会原地修改 MODELS，上面的下标在 config 中解析为模型名称后只使用名称
+DEFAULT_MODEL_NAME = MODELS[DEFAULT_MODEL] if MODELS else None
+RENAME_MODEL_NAME = MODELS[RENAME_MODEL] if MODELS else None
+
 os.makedirs("models", exist_ok=True)
 os.makedirs("lora", exist_ok=True)
 os.makedirs("history", exist_ok=True)
@@ -121,7 +121,7 @@ for dir_name in os.listdir("models"):
             if "model_name" in metadata and metadata["model_name"] == dir_name:
                 display_name = model_name
                 break
-        if display_name is None:
+        if display_name is None and dir_name not in MODELS:
             MODELS.append(dir_name)
 
 TOKEN_OFFSET = 1000 # 模型的token上限减去这个值，得到软上限。到达软上限之后，自动尝试减少token占用。
@@ -197,6 +197,25 @@ Not including '.' ':' '?' '!' '“' '*' '<' '>'.
 Reply in user's language.
 """
 
+CONTEXT_SUMMARY_SYSTEM_PROMPT = """\
+You maintain a running summary of a conversation between a user and an assistant.
+Merge the previous summary and the new messages into one updated summary.
+Keep facts, decisions, names, numbers, code identifiers and open questions that later turns may refer to.
+Drop greetings and small talk. Write in the language of the conversation. Output only the summary.
+"""
+
+CONTEXT_SUMMARY_PROMPT = """\
+Previous summary:
+{summary}
+
+New messages:
+{transcript}
+"""
+
+CONTEXT_SUMMARY_MESSAGE = """\
+Summary of the earlier conversation, which is no longer shown in full:
+{summary}"""
+
 ALREADY_CONVERTED_MARK = "<!-- ALREADY CONVERTED BY PARSER. -->"
 START_OF_OUTPUT_MARK = "<!-- SOO IN MESSAGE -->"
 END_OF_OUTPUT_MARK = "<!-- EOO IN MESSAGE -->"
@@ -0,0 +1,215 @@
+# -*- coding:utf-8 -*-
+"""
+按模型计算 token 数
+
+- 编码器在进程内只加载一次，之前每次计数都要调用 tiktoken.get_encoding
+- 根据模型名称（或模型元数据中的 "tokenizer"）选择分词器：Llama / Qwen / DeepSeek 等使用
+  HuggingFace 上对应的 tokenizer.json，需要安装 tokenizers 和 huggingface_hub；
+  本地没有缓存且不允许下载时，用 tiktoken 的计数乘以系数近似，tiktoken 也没有时按字符估算
+- 已经计算过的文本（历史消息不会再变化）直接返回缓存的结果，支持批量计数
+"""
+import logging
+import re
+import threading
+from collections import OrderedDict
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+DEFAULT_ENCODING = "cl100k_base"
+COUNT_CACHE_SIZE = 4096  # 缓存的 (分词器, 文本) 计数条数
+ALLOW_DOWNLOAD = False  # 本地没有缓存时是否从 HuggingFace 下载 tokenizer.json
+TOKENIZER_OVERRIDES = {}  # 模型名称前缀 -> 分词器，来自 config.json 的 "tokenizers"
+
+# (模型名称前缀, 分词器, 近似计数时相对 cl100k_base 的系数)，按顺序匹配第一个
+# 分词器写法：HuggingFace 仓库名、"tiktoken:<编码名>" 或 "approx"
+MODEL_TOKENIZERS = (
+    ("qwen3", "Qwen/Qwen3-8B", 1.0),
+    ("qwq", "Qwen/QwQ-32B", 1.0),
+    ("qwen", "Qwen/Qwen2.5-7B-Instruct", 1.0),
+    ("deepseek", "deepseek-ai/DeepSeek-V3", 1.0),
+    ("llama3", "unsloth/Llama-3.1-8B-Instruct", 1.0),
+    ("llama-3", "unsloth/Llama-3.1-8B-Instruct", 1.0),
+    ("llama", "approx", 1.2),  # Llama 2 的 32k 词表
+    ("mistral", "approx", 1.2),
+    ("mixtral", "approx", 1.2),
+    ("gemma", "approx", 0.95),
+    ("gpt-4o", "tiktoken:o200k_base", 1.0),
+    ("o1", "tiktoken:o200k_base", 1.0),
+    ("o3", "tiktoken:o200k_base", 1.0),
+    ("gpt", "tiktoken:cl100k_base", 1.0),
+)
+
+# 没有 tiktoken 时的估算：中日韩字符约一个 token，其余约四个字符一个 token
+CJK_PATTERN = re.compile(r"[\u3000-\u9fff\uac00-\ud7af\uf900-\ufaff\uff00-\uffef]")
+
+
+def configure(overrides=None, allow_download=None, cache_size=None):
+    global ALLOW_DOWNLOAD, COUNT_CACHE_SIZE
+    if overrides is not None:
+        TOKENIZER_OVERRIDES.update(overrides)
+    if allow_download is not None:
+        ALLOW_DOWNLOAD = bool(allow_download)
+    if cache_size is not None:
+        COUNT_CACHE_SIZE = int(cache_size)
+
+
+def approximate_count(text):
+    cjk = len(CJK_PATTERN.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+class Tokenizer:
+    """encode 为 None 时只能近似计数；exact 表示计数与模型实际使用的分词器一致"""
+
+    def __init__(self, name, encode=None, encode_batch=None, exact=False, scale=1.0):
+        self.name = name
+        self._encode = encode
+        self._encode_batch = encode_batch
+        self.exact = exact
+        self.scale = scale
+        self._counts = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def identity(self):
+        """区分计数结果的标识：同一编码乘以不同系数的近似计数结果不同，系数也计入标识"""
+        return self.name if self.scale == 1.0 else f"{self.name}*{self.scale:g}"
+
+    def encode(self, text):
+        if self._encode is None:
+            raise ValueError(f"分词器 {self.name} 不支持编码")
+        return self._encode(text)
+
+    def _count_uncached(self, texts):
+        if self._encode is None:
+            counts = [approximate_count(text) for text in texts]
+        elif self._encode_batch is not None and len(texts) > 1:
+            counts = [len(tokens) for tokens in self._encode_batch(texts)]
+        else:
+            counts = [len(self._encode(text)) for text in texts]
+        if self.scale != 1.0:
+            counts = [round(count * self.scale) for count in counts]
+        return counts
+
+    def count(self, text):
+        return self.count_batch([text])[0]
+
+    def count_batch(self, texts):
+        results = [None] * len(texts)
+        missing = {}
+        with self._lock:
+            for i, text in enumerate(texts):
+                count = self._counts.get(text)
+                if count is None:
+                    missing.setdefault(text, []).append(i)
+                else:
+                    self._counts.move_to_end(text)
+                    results[i] = count
+        if missing:
+            counts = self._count_uncached(list(missing))
+            with self._lock:
+                for (text, indexes), count in zip(missing.items(), counts):
+                    self._counts[text] = count
+                    for i in indexes:
+                        results[i] = count
+                while len(self._counts) > COUNT_CACHE_SIZE:
+                    self._counts.popitem(last=False)
+        return results
+
+
+_lock = threading.Lock()
+_tokenizers = {}  # 分词器写法 + 系数 -> Tokenizer
+_model_tokenizers = {}  # (模型名称, 元数据中的分词器) -> Tokenizer
+
+
+def _load_tiktoken(encoding_name, scale=1.0, exact=True):
+    if tiktoken is None:
+        return None
+    try:
+        encoding = tiktoken.get_encoding(encoding_name)
+    except Exception as e:
+        logging.warning(f"加载 tiktoken 编码 {encoding_name} 失败：{e}")
+        return None
+    return Tokenizer(
+        f"tiktoken:{encoding_name}",
+        encode=lambda text: encoding.encode(text, disallowed_special=()),
+        encode_batch=lambda texts: encoding.encode_batch(texts, disallowed_special=()),
+        exact=exact,
+        scale=scale,
+    )
+
+
+def _load_huggingface(repo_id):
+    try:
+        from huggingface_hub import hf_hub_download
+        from tokenizers import Tokenizer as HFTokenizer
+    except ImportError:
+        logging.debug(f"没有安装 tokenizers / huggingface_hub，{repo_id} 的 token 数将近似计算")
+        return None
+    try:
+        path = hf_hub_download(repo_id, "tokenizer.json", local_files_only=not ALLOW_DOWNLOAD)
+        tokenizer = HFTokenizer.from_file(path)
+    except Exception as e:
+        logging.debug(f"加载分词器 {repo_id} 失败，token 数将近似计算：{e}")
+        return None
+    return Tokenizer(
+        repo_id,
+        encode=lambda text: tokenizer.encode(text, add_special_tokens=False).ids,
+        encode_batch=lambda texts: [
+            encoding.ids for encoding in tokenizer.encode_batch(texts, add_special_tokens=False)
+        ],
+        exact=True,
+    )
+
+
+def _load(spec, scale):
+    """按写法加载分词器，失败时依次退回到 tiktoken 近似和字符估算"""
+    key = (spec, scale)
+    with _lock:
+        if key in _tokenizers:
+            return _tokenizers[key]
+    tokenizer = None
+    if spec.startswith("tiktoken:"):
+        tokenizer = _load_tiktoken(spec[len("tiktoken:"):])
+    elif spec != "approx":
+        tokenizer = _load_huggingface(spec)
+    if tokenizer is None:
+        tokenizer = _load_tiktoken(DEFAULT_ENCODING, scale, exact=False)
+    if tokenizer is None:
+        tokenizer = Tokenizer("approx", scale=scale)
+    with _lock:
+        return _tokenizers.setdefault(key, tokenizer)
+
+
+def _resolve(model):
+    """根据模型名称选择分词器写法和近似系数"""
+    name = (model or "").lower().rsplit("/", 1)[-1]
+    for prefix, spec in TOKENIZER_OVERRIDES.items():
+        if name.startswith(prefix.lower()):
+            return spec, 1.0
+    for prefix, spec, scale in MODEL_TOKENIZERS:
+        if name.startswith(prefix):
+            return spec, scale
+    return f"tiktoken:{DEFAULT_ENCODING}", 1.0
+
+
+def get_tokenizer(model=None, spec=None):
+    """spec 为模型元数据中的 "tokenizer"，None 时根据模型名称选择"""
+    key = (model, spec)
+    tokenizer = _model_tokenizers.get(key)
+    if tokenizer is None:
+        tokenizer = _load(spec, 1.0) if spec else _load(*_resolve(model))
+        _model_tokenizers[key] = tokenizer
+        logging.debug(f"模型 {model} 使用分词器 {tokenizer.identity}{'' if tokenizer.exact else '（近似）'}")
+    return tokenizer
+
+
+def count_tokens(text, model=None, spec=None):
+    return get_tokenizer(model, spec).count(text)
+
+
+def count_tokens_batch(texts, model=None, spec=None):
+    return get_tokenizer(model, spec).count_batch(list(texts))
@@ -9,7 +9,10 @@ import hmac
 import html
 import logging
 import threading
+import uuid
+from collections import namedtuple
 from enum import Enum
+from functools import lru_cache
 from typing import TYPE_CHECKING, List
 
 import colorama
@@ -17,7 +20,6 @@ import commentjson as json
 import pandas as pd
 import regex as re
 import requests
-import tiktoken
 from markdown import markdown
 from pygments import highlight
 from pygments.formatters import HtmlFormatter
@@ -26,6 +28,11 @@ from pypinyin import lazy_pinyin
 
 from modules.config import retrieve_proxy, hide_history_when_not_logged_in, admin_list
 from modules.presets import *
+from modules.models.model_registry import model_registry
+from modules.models.stream_answer import StreamFrame
+from modules.models.stream_delta import MessageDelta
+from modules.tokenizer import count_tokens, count_tokens_batch
+from modules.history_store import history_store, history_writer
 from . import shared
 
 if TYPE_CHECKING:
@@ -37,9 +44,84 @@ if TYPE_CHECKING:
         data: List[List[str | int | bool]]
 
 
+def materialize_chatbot(chatbot):
+    """正在生成的回答是 StreamFrame 时拼接成字符串，交给 Gradio 渲染"""
+    if chatbot and isinstance(chatbot[-1][1], StreamFrame):
+        chatbot[-1] = (chatbot[-1][0], str(chatbot[-1][1]))
+    return chatbot
+
+
 def predict(current_model, *args):
     iter = current_model.predict(*args)
-    for i in iter:
+    for chatbot, status_text in iter:
+        yield materialize_chatbot(chatbot), status_text
+
+
+async def predict_async(current_model, *args):
+    async for chatbot, status_text in current_model.predict_async(*args):
+        yield materialize_chatbot(chatbot), status_text
+
+
+class StreamDeltaEncoder:
+    """把 (chatbot, status_text) 转换为 (chatbot, status_text, stream_delta)
+
+    只有最后一条回答变化时不更新 chatbot，而是通过 stream_delta 发送新增的文本（见 stream_delta.MessageDelta），
+    由前端截断后追加；其他变化（新增消息等）发送完整的 chatbot。
+    """
+
+    def __init__(self):
+        self.turn_id = uuid.uuid4().hex[:8]
+        self.length = None
+        self.user_message = None
+        self.delta = None
+
+    def encode(self, chatbot, status_text):
+        if (
+            not chatbot
+            or len(chatbot) != self.length
+            or chatbot[-1][0] is not self.user_message
+            or not isinstance(chatbot[-1][1], (str, StreamFrame))
+            or self.delta is None
+        ):
+            self.length = len(chatbot)
+            self.user_message, message = chatbot[-1] if chatbot else (None, None)
+            # 前端只能拿到渲染后的 HTML，完整同步后的第一次增量从头发送
+            if isinstance(message, (str, StreamFrame)):
+                self.delta = MessageDelta(f"{self.turn_id}-{len(chatbot) - 1}")
+            else:
+                self.delta = None
+            return materialize_chatbot(chatbot), status_text, ""
+        delta = self.delta.next(chatbot[-1][1])
+        if delta is None:
+            return gr.update(), status_text, gr.update()
+        return gr.update(), status_text, html.escape(json.dumps(delta, ensure_ascii=False))
+
+
+def encode_stream_deltas(iter):
+    encoder = StreamDeltaEncoder()
+    chatbot = status_text = None
+    for chatbot, status_text in iter:
+        yield encoder.encode(chatbot, status_text)
+    if chatbot is not None:
+        # 每轮结束时同步完整的对话，由 Gradio 重新渲染
+        yield materialize_chatbot(chatbot), status_text, ""
+
+
+async def aencode_stream_deltas(iter):
+    encoder = StreamDeltaEncoder()
+    chatbot = status_text = None
+    async for chatbot, status_text in iter:
+        yield encoder.encode(chatbot, status_text)
+    if chatbot is not None:
+        yield materialize_chatbot(chatbot), status_text, ""
+
+
+def predict_delta(current_model, *args):
+    yield from encode_stream_deltas(current_model.predict(*args))
+
+
+async def predict_delta_async(current_model, *args):
+    async for i in aencode_stream_deltas(current_model.predict_async(*args)):
         yield i
 
 
@@ -63,14 +145,25 @@ def interrupt(current_model, *args):
     return current_model.interrupt(*args)
 
 
+def refresh_model_choices(model_list_version):
+    """模型列表在后台更新后，同步到 model_select_dropdown"""
+    if model_list_version == model_registry.version:
+        return gr.update(), model_list_version
+    return gr.update(choices=MODELS), model_registry.version
+
+
 def reset(current_model, *args):
     return current_model.reset(*args)
 
 
 def retry(current_model, *args):
     iter = current_model.retry(*args)
-    for i in iter:
-        yield i
+    for chatbot, status_text in iter:
+        yield materialize_chatbot(chatbot), status_text
+
+
+def retry_delta(current_model, *args):
+    yield from encode_stream_deltas(current_model.retry(*args))
 
 
 def delete_first_conversation(current_model, *args):
@@ -93,6 +186,18 @@ def auto_name_chat_history(current_model, *args):
     return current_model.auto_name_chat_history(*args)
 
 
+async def wait_for_chat_title(current_model, *args):
+    return await current_model.wait_for_chat_title(*args)
+
+
+def keep_choice(current_model, *args):
+    return current_model.keep_choice(*args)
+
+
+def get_choice_selector(current_model, *args):
+    return current_model.get_choice_selector(*args)
+
+
 def export_markdown(current_model, *args):
     return current_model.export_markdown(*args)
 
@@ -164,12 +269,19 @@ def dislike(current_model, *args):
     return current_model.dislike(*args)
 
 
-def count_token(input_str):
-    encoding = tiktoken.get_encoding("cl100k_base")
+def _token_count_text(input_str):
     if type(input_str) == dict:
-        input_str = f"role: {input_str['role']}, content: {input_str['content']}"
-    length = len(encoding.encode(input_str))
-    return length
+        return f"role: {input_str['role']}, content: {input_str['content']}"
+    return input_str
+
+
+def count_token(input_str, model=None, tokenizer=None):
+    """model 为模型名称，tokenizer 为模型元数据中的 "tokenizer"，都为 None 时使用 cl100k_base"""
+    return count_tokens(_token_count_text(input_str), model, tokenizer)
+
+
+def count_token_batch(inputs, model=None, tokenizer=None):
+    return count_tokens_batch([_token_count_text(input_str) for input_str in inputs], model, tokenizer)
 
 
 def markdown_to_html_with_syntax_highlight(md_str):  # deprecated
@@ -242,29 +354,89 @@ def convert_mdtext(md_text):  # deprecated
     output += ALREADY_CONVERTED_MARK
     return output
 
+APPENDIX_MARK = '\n\n<hr class="append-display no-in-raw" />'
+# agent 前缀与 ``` 在一次扫描中切出，代码块由各个使用者按 ``` 配对
+MESSAGE_TOKEN_PATTERN = re.compile(r"(<!-- S O PREFIX -->.*?<!-- E O PREFIX -->)|```", re.DOTALL)
+HTML_TAG_PATTERN = re.compile(r"<[^>]+>")
+HTML_ENTITY_PATTERN = re.compile(r"&[#\w]+;")
+
+SEGMENT_TEXT = "text"
+SEGMENT_PREFIX = "prefix"
+SEGMENT_FENCE = "fence"
+
+MessageSegment = namedtuple("MessageSegment", ["kind", "text"])
+MessageSegments = namedtuple("MessageSegments", ["body", "appendix"])
+
+
+def _tokenize_message(text):
+    segments = []
+    position = 0
+    for match in MESSAGE_TOKEN_PATTERN.finditer(text):
+        if match.start() > position:
+            segments.append(MessageSegment(SEGMENT_TEXT, text[position:match.start()]))
+        segments.append(MessageSegment(SEGMENT_PREFIX if match.group(1) else SEGMENT_FENCE, match.group()))
+        position = match.end()
+    if position < len(text):
+        segments.append(MessageSegment(SEGMENT_TEXT, text[position:]))
+    return tuple(segments)
+
+
+@lru_cache(maxsize=64)
+def segment_message(text):
+    """把消息切分为正文、agent 前缀和 ```，附加内容（搜索结果等）单独切分，结果按内容缓存"""
+    body, mark, appendix = text.partition(APPENDIX_MARK)
+    return MessageSegments(_tokenize_message(body), _tokenize_message(mark + appendix))
+
+
+def split_code_blocks(segments):
+    """按 ``` 配对，依次产出 (是否为代码块, 代码块是否有结尾, 内容)
+
+    与 ```(.*?)(?:```|$) 的切分相同：代码块的内容不含 ```，agent 前缀视为普通文本，
+    其中的 ``` 同样参与配对。前缀的边界是 < 和 >，``` 不会跨过边界，在前缀内部单独切分即可。
+    """
+    buffer = []
+    in_code = False
+    for segment in segments:
+        if segment.kind == SEGMENT_FENCE:
+            yield in_code, True, "".join(buffer)
+            buffer = []
+            in_code = not in_code
+        elif segment.kind == SEGMENT_PREFIX and "```" in segment.text:
+            first, *rest = segment.text.split("```")
+            buffer.append(first)
+            for piece in rest:
+                yield in_code, True, "".join(buffer)
+                buffer = [piece]
+                in_code = not in_code
+        else:
+            buffer.append(segment.text)
+    rest = "".join(buffer)
+    if in_code and rest.endswith("\n"):
+        # $ 在结尾的换行符之前就能匹配，没有结尾的代码块不包含最后的换行符
+        yield True, False, rest[:-1]
+        rest, in_code = "\n", False
+    yield in_code, False, rest
+
+
 def remove_html_tags(chatbot):
     def clean_text(text):
-        # Regular expression to match code blocks, including all newlines
-        code_block_pattern = r'(```[\s\S]*?```)'
-
-        # Split the text into code blocks and non-code blocks
-        parts = re.split(code_block_pattern, text)
+        # 完整的代码块原样保留，其余部分（包括没有结尾的代码块）去掉 HTML 标签和实体；
+        # 标签可能跨过没有结尾的 ```，两个完整代码块之间的内容要合在一起清理
+        def clean(parts):
+            return HTML_ENTITY_PATTERN.sub("", HTML_TAG_PATTERN.sub("", "".join(parts)))
 
+        segments = segment_message(text)
         cleaned_parts = []
-        for part in parts:
-            if part.startswith('```') and part.endswith('```'):
-                # This is a code block, keep it exactly as is
-                cleaned_parts.append(part)
+        pending = []
+        for is_code, closed, part in split_code_blocks(segments.body + segments.appendix):
+            if is_code and closed:
+                cleaned_parts.append(clean(pending))
+                cleaned_parts.append(f"```{part}```")
+                pending = []
             else:
-                # This is not a code block, remove HTML tags
-                # Remove all HTML tags
-                cleaned = re.sub(r'<[^>]+>', '', part)
-                # Remove any remaining HTML entities
-                cleaned = re.sub(r'&[#\w]+;', '', cleaned)
-                cleaned_parts.append(cleaned)  # Don't strip here to preserve newlines
-
-        # Join the cleaned parts back together
-        return ''.join(cleaned_parts)
+                pending.append("```" + part if is_code else part)
+        cleaned_parts.append(clean(pending))
+        return "".join(cleaned_parts)
 
     processed = []
     for conv in chatbot:
@@ -279,28 +451,22 @@ def remove_html_tags(chatbot):
 
 
 def clip_rawtext(chat_message, need_escape=True):
-    # first, clip hr line
-    hr_pattern = r'\n\n<hr class="append-display no-in-raw" />(.*?)'
-    hr_match = re.search(hr_pattern, chat_message, re.DOTALL)
-    message_clipped = chat_message[: hr_match.start()] if hr_match else chat_message
-    # second, avoid agent-prefix being escaped
-    agent_prefix_pattern = (
-        r'(<!-- S O PREFIX -->.*?<!-- E O PREFIX -->)'
-    )
-    # agent_matches = re.findall(agent_prefix_pattern, message_clipped)
-    agent_parts = re.split(agent_prefix_pattern, message_clipped, flags=re.DOTALL)
+    # 去掉附加内容；agent 前缀原样保留，其余部分转义后放进 fake-pre
     final_message = ""
-    for i, part in enumerate(agent_parts):
-        if i % 2 == 0:
-            if part != "" and part != "\n":
-                final_message += (
-                    f'<pre class="fake-pre">{escape_markdown(part)}</pre>'
-                    if need_escape
-                    else f'<pre class="fake-pre">{part}</pre>'
-                )
-        else:
-            part = part.replace(' data-fancybox="gallery"', '')
-            final_message += part
+    parts = []
+    for segment in segment_message(chat_message).body + (MessageSegment(SEGMENT_PREFIX, ""),):
+        if segment.kind != SEGMENT_PREFIX:
+            parts.append(segment.text)
+            continue
+        part = "".join(parts)
+        parts = []
+        if part != "" and part != "\n":
+            final_message += (
+                f'<pre class="fake-pre">{escape_markdown(part)}</pre>'
+                if need_escape
+                else f'<pre class="fake-pre">{part}</pre>'
+            )
+        final_message += segment.text.replace(' data-fancybox="gallery"', '')
     return final_message
 
 
@@ -314,16 +480,12 @@ def convert_bot_before_marked(chat_message):
         raw = f'<div class="raw-message hideM">{clip_rawtext(chat_message)}</div>'
         # really_raw = f'{START_OF_OUTPUT_MARK}<div class="really-raw hideM">{clip_rawtext(chat_message, need_escape=False)}\n</div>{END_OF_OUTPUT_MARK}'
 
-        code_block_pattern = re.compile(r"```(.*?)(?:```|$)", re.DOTALL)
-        code_blocks = code_block_pattern.findall(chat_message)
-        non_code_parts = code_block_pattern.split(chat_message)[::2]
+        segments = segment_message(chat_message)
         result = []
-        for non_code, code in zip(non_code_parts, code_blocks + [""]):
-            if non_code.strip():
-                result.append(non_code)
-            if code.strip():
-                code = f"\n```{code}\n```"
-                result.append(code)
+        for is_code, closed, part in split_code_blocks(segments.body + segments.appendix):
+            if not part.strip():
+                continue
+            result.append(f"\n```{part}\n```" if is_code else part)
         result = "".join(result)
         md = f'<div class="md-message">\n\n{result}\n</div>'
         return raw + md
@@ -336,36 +498,42 @@ def convert_user_before_marked(chat_message):
         return f'<div class="user-message">{escape_markdown(chat_message)}</div>'
 
 
+# 逐个 str.replace 比逐字符查表快得多；替换结果中会出现 "#"、"<"、">"，
+# 所以 "#" 最先替换，换行最后替换
+MARKDOWN_ESCAPES = (
+    ("#", "&#35;"),
+    # (' ', '&nbsp;'),
+    ('"', "&quot;"),
+    ("_", "&#95;"),
+    ("*", "&#42;"),
+    ("[", "&#91;"),
+    ("]", "&#93;"),
+    ("(", "&#40;"),
+    (")", "&#41;"),
+    ("{", "&#123;"),
+    ("}", "&#125;"),
+    ("+", "&#43;"),
+    ("-", "&#45;"),
+    (".", "&#46;"),
+    ("!", "&#33;"),
+    ("`", "&#96;"),
+    (">", "&#62;"),
+    ("<", "&#60;"),
+    ("|", "&#124;"),
+    ("$", "&#36;"),
+    (":", "&#58;"),
+    ("\n", "<br>"),
+)
+
+
 def escape_markdown(text):
     """
     Escape Markdown special characters to HTML-safe equivalents.
     """
-    escape_chars = {
-        # ' ': '&nbsp;',
-        '"': "&quot;",
-        "_": "&#95;",
-        "*": "&#42;",
-        "[": "&#91;",
-        "]": "&#93;",
-        "(": "&#40;",
-        ")": "&#41;",
-        "{": "&#123;",
-        "}": "&#125;",
-        "#": "&#35;",
-        "+": "&#43;",
-        "-": "&#45;",
-        ".": "&#46;",
-        "!": "&#33;",
-        "`": "&#96;",
-        ">": "&#62;",
-        "<": "&#60;",
-        "|": "&#124;",
-        "$": "&#36;",
-        ":": "&#58;",
-        "\n": "<br>",
-    }
     text = text.replace("    ", "&nbsp;&nbsp;&nbsp;&nbsp;")
-    return "".join(escape_chars.get(c, c) for c in text)
+    for char, escaped in MARKDOWN_ESCAPES:
+        text = text.replace(char, escaped)
+    return text
 
 
 def convert_asis(userinput):  # deprecated
@@ -414,28 +582,13 @@ def construct_assistant(text):
     return construct_text("assistant", text)
 
 
-def save_file(filename, model):
-    system = model.system_prompt
-    history = model.history
-    chatbot = []
-    i = 0
-    while i < len(history):
-        if history[i]["role"] == "image":
-            # Handle image
-            chatbot.append(((history[i]["content"], None), None))
-            i += 1
-        elif i + 1 < len(history) and history[i + 1]["role"] != "image":
-            # Handle user-assistant pair
-            chatbot.append((history[i]["content"], history[i + 1]["content"]))
-            i += 2
-        else:
-            # Handle unpaired message (could be at the end or before an image)
-            chatbot.append((history[i]["content"], None))
-            i += 1
+def save_file(filename, model, journal=False):
+    """保存对话记录；journal 为 True 时交给后台合并写入，只向日志追加变化，否则立即写入完整的快照"""
     user_name = model.user_name
     os.makedirs(os.path.join(HISTORY_DIR, user_name), exist_ok=True)
     if filename is None:
         filename = new_auto_history_filename(user_name)
+    export_markdown = filename.endswith(".md")
     if filename.endswith(".md"):
         filename = filename[:-3]
     if not filename.endswith(".json") and not filename.endswith(".md"):
@@ -443,10 +596,8 @@ def save_file(filename, model):
     if filename == ".json":
         raise Exception("文件名不能为空")
 
-    json_s = {
-        "system": system,
-        "history": history,
-        "chatbot": chatbot,
+    meta = {
+        "system": model.system_prompt,
         "model_name": model.model_name,
         "single_turn": model.single_turn,
         "temperature": model.temperature,
@@ -461,6 +612,8 @@ def save_file(filename, model):
         "user_identifier": model.user_identifier,
         "stream": model.stream,
         "metadata": model.metadata,
+        "context_summary": model.context.to_json(),
+        **model.token_count_metadata(),
     }
     if not filename == os.path.basename(filename):
         history_file_path = filename
@@ -470,23 +623,18 @@ def save_file(filename, model):
     # check if history file path matches user_name
     # if user access control is not enabled, user_name is empty, don't check
     assert os.path.basename(os.path.dirname(history_file_path)) == model.user_name or model.user_name == ""
-    with open(history_file_path, "w", encoding="utf-8") as f:
-        json.dump(json_s, f, ensure_ascii=False, indent=4)
-
-    save_md_file(history_file_path)
+    if journal:
+        history_writer.submit(history_file_path, model.history, meta)
+    else:
+        history_writer.write(history_file_path, model.history, meta)
+    if export_markdown:
+        history_writer.flush(history_file_path)
+        history_store.materialize(history_file_path, markdown=True)
     return history_file_path
 
 def save_md_file(json_file_path):
-    with open(json_file_path, "r", encoding="utf-8") as f:
-        json_data = json.load(f)
-
-    md_file_path = json_file_path[:-5] + ".md"
-    md_s = f"system: \n- {json_data['system']} \n"
-    for data in json_data['history']:
-        md_s += f"\n{data['role']}: \n- {data['content']} \n"
-
-    with open(md_file_path, "w", encoding="utf8") as f:
-        f.write(md_s)
+    history_writer.flush(json_file_path)
+    history_store.materialize(json_file_path, markdown=True)
 
 def sorted_by_pinyin(list):
     return sorted(list, key=lambda char: lazy_pinyin(char)[0][0])
@@ -494,7 +642,7 @@ def sorted_by_pinyin(list):
 
 def sorted_by_last_modified_time(list, dir):
     return sorted(
-        list, key=lambda char: os.path.getctime(os.path.join(dir, char)), reverse=True
+        list, key=lambda char: history_store.modified_time(os.path.join(dir, char)), reverse=True
     )
 
 
@@ -537,6 +685,8 @@ def get_history_names(user_name=""):
         user_history_dir = os.path.join(HISTORY_DIR, user_name)
         # ensure the user history directory is inside the HISTORY_DIR
         assert os.path.realpath(user_history_dir).startswith(os.path.realpath(HISTORY_DIR))
+        # 新建的对话可能还没有写入磁盘
+        history_writer.flush(user_history_dir)
         history_files = get_file_names_by_last_modified_time(
             os.path.join(HISTORY_DIR, user_name)
         )
@@ -1509,22 +1659,22 @@ def setPlaceholder(model_name: str | None = "", model: BaseLLMModel | None = Non
 
     if model is None:
         try:
-            model_logo = MODEL_METADATA[model_name]["placeholder"]["logo"]
+            model_logo = MODEL_METADATA.peek(model_name)["placeholder"]["logo"]
         except:
             logo_class = "hideK"
         try:
-            model_logo_round = MODEL_METADATA[model_name]["placeholder"]["logo_rounded"]
+            model_logo_round = MODEL_METADATA.peek(model_name)["placeholder"]["logo_rounded"]
         except:
             pass
         try:
-            model_slogan = i18n(MODEL_METADATA[model_name]["placeholder"]["slogan"])
+            model_slogan = i18n(MODEL_METADATA.peek(model_name)["placeholder"]["slogan"])
         except:
             slogan_class = "hideK"
         try:
-            model_question_1 = i18n(MODEL_METADATA[model_name]["placeholder"]["question_1"])
-            model_question_2 = i18n(MODEL_METADATA[model_name]["placeholder"]["question_2"])
-            model_question_3 = i18n(MODEL_METADATA[model_name]["placeholder"]["question_3"])
-            model_question_4 = i18n(MODEL_METADATA[model_name]["placeholder"]["question_4"])
+            model_question_1 = i18n(MODEL_METADATA.peek(model_name)["placeholder"]["question_1"])
+            model_question_2 = i18n(MODEL_METADATA.peek(model_name)["placeholder"]["question_2"])
+            model_question_3 = i18n(MODEL_METADATA.peek(model_name)["placeholder"]["question_3"])
+            model_question_4 = i18n(MODEL_METADATA.peek(model_name)["placeholder"]["question_4"])
         except:
             question_class = "hideK"
     else:
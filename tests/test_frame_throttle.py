@@ -0,0 +1,102 @@
+# -*- coding:utf-8 -*-
+import asyncio
+import time
+
+import pytest
+
+from modules.models import frame_throttle
+from modules.models.frame_throttle import FLUSH, FrameThrottle, aiter_with_flush, throttle_stats
+
+
+@pytest.fixture(autouse=True)
+def settings(monkeypatch):
+    monkeypatch.setattr(frame_throttle, "FRAME_INTERVAL", 0.05)
+    monkeypatch.setattr(frame_throttle, "FLUSH_CHARS", 200)
+
+
+def test_ready_by_interval_and_chars():
+    throttle = FrameThrottle([])
+    assert throttle.ready("a")  # 第一个 chunk 立即推送
+    throttle.pushed([("q", "a")])
+    assert not throttle.ready("ab")
+    assert throttle.flush_delay() is not None
+    assert throttle.ready("a" * 300)
+    throttle.pushed([("q", "a" * 300)])
+    assert throttle.flush_delay() is None
+
+
+def test_configure_clamps_flush_chars(monkeypatch):
+    frame_throttle.configure(flush_chars=10000)
+    assert frame_throttle.FLUSH_CHARS == frame_throttle.MAX_FLUSH_CHARS
+    frame_throttle.configure(flush_chars=0)
+    assert frame_throttle.FLUSH_CHARS == 0
+
+
+def test_pause_flushes_buffered_text():
+    async def stream():
+        for text in ("a", "ab", "abc"):
+            yield text
+        await asyncio.sleep(0.3)  # 模型暂停输出
+        yield "abcd"
+
+    async def run():
+        throttle = FrameThrottle([])
+        events = []
+        text = ""
+        async for item in aiter_with_flush(stream(), throttle):
+            if item is FLUSH:
+                throttle.timer_flush(text)
+                events.append(("flush", text, time.monotonic()))
+                throttle.pushed([("q", text)])
+                continue
+            text = item
+            if throttle.ready(text):
+                events.append(("push", text, time.monotonic()))
+                throttle.pushed([("q", text)])
+        return throttle, events
+
+    throttle, events = asyncio.run(run())
+    assert [event[:2] for event in events] == [("push", "a"), ("flush", "abc"), ("push", "abcd")]
+    # 缓冲的内容在帧间隔之后推送，而不是等到暂停结束
+    assert events[1][2] - events[0][2] < 0.2
+    assert throttle.timer_flushes == 1
+
+
+def test_close_cancels_pending_read():
+    closed = []
+
+    async def stream():
+        try:
+            yield "a"
+            await asyncio.sleep(10)
+            yield "b"
+        finally:
+            closed.append(True)
+
+    async def run():
+        source = stream()
+        chunks = aiter_with_flush(source, FrameThrottle([]))
+        async for _ in chunks:
+            break
+        # 第二次读取已经在等待时关闭
+        chunks = aiter_with_flush(source, FrameThrottle([]))
+        task = asyncio.ensure_future(chunks.__anext__())
+        await asyncio.sleep(0.01)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        await chunks.aclose()
+        await source.aclose()
+
+    asyncio.run(run())
+    assert closed == [True]
+
+
+def test_stats_are_logged_per_turn(caplog):
+    throttle = FrameThrottle([])
+    throttle.ready("a")
+    throttle.pushed([("q", "a")])
+    with caplog.at_level("INFO"):
+        throttle.finish()
+    assert "推送 1 次" in caplog.text
+    assert throttle_stats.stats()["turns"] >= 1
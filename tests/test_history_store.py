@@ -0,0 +1,69 @@
+# -*- coding:utf-8 -*-
+import os
+
+from modules import history_store as store_module
+from modules.history_store import HistoryStore, journal_path
+
+
+def user(content, **extra):
+    return {"role": "user", "content": content, **extra}
+
+
+def assistant(content, **extra):
+    return {"role": "assistant", "content": content, **extra}
+
+
+def test_append_writes_journal_and_load_replays(tmp_path):
+    path = str(tmp_path / "chat.json")
+    store = HistoryStore()
+    history = [user("你好"), assistant("你好！")]
+    store.append(path, history, {"system": "s", "temperature": 1.0})
+    assert not os.path.exists(journal_path(path))
+
+    history = history + [user("再见"), assistant("再见！")]
+    store.append(path, history, {"system": "s", "temperature": 0.5})
+    assert os.path.exists(journal_path(path))
+
+    data = HistoryStore().load(path)
+    assert data["history"] == history
+    assert data["temperature"] == 0.5
+    assert data["chatbot"] == [("你好", "你好！"), ("再见", "再见！")]
+
+
+def test_in_place_changes_after_load_are_saved(tmp_path):
+    # 读取后在原地重新计数，再换分词器保存：修改过的消息必须重新写入
+    path = str(tmp_path / "chat.json")
+    HistoryStore().append(path, [user("a", token_count=5), assistant("b", token_count=7)], {"tokenizer": "A"})
+
+    store = HistoryStore()
+    history = store.load(path)["history"]
+    for message in history:
+        message["token_count"] = 99
+    history.append(user("c", token_count=1))
+    store.append(path, history, {"tokenizer": "B"})
+
+    data = HistoryStore().load(path)
+    assert data["tokenizer"] == "B"
+    assert [message["token_count"] for message in data["history"]] == [99, 99, 1]
+
+
+def test_in_place_changes_after_append_are_saved(tmp_path):
+    path = str(tmp_path / "chat.json")
+    store = HistoryStore()
+    history = [user("a"), assistant("b")]
+    store.append(path, history, {})
+    history[1]["usage"] = {"eval_count": 3}
+    store.append(path, history, {})
+    assert HistoryStore().load(path)["history"][1]["usage"] == {"eval_count": 3}
+
+
+def test_compaction_rewrites_snapshot(tmp_path, monkeypatch):
+    monkeypatch.setattr(store_module, "COMPACT_RECORDS", 2)
+    path = str(tmp_path / "chat.json")
+    store = HistoryStore()
+    history = []
+    for i in range(4):
+        history = history + [user(f"q{i}"), assistant(f"a{i}")]
+        store.append(path, history, {})
+    assert not os.path.exists(journal_path(path))
+    assert HistoryStore().load(path)["history"] == history
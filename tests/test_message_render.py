@@ -0,0 +1,97 @@
+# -*- coding:utf-8 -*-
+"""单次切分的消息渲染与原来按正则多次切分的实现逐字节一致"""
+import random
+import re
+
+import pytest
+
+pytest.importorskip("gradio")
+from modules import utils  # noqa: E402
+
+PREFIX_START = "<!-- S O PREFIX -->"
+PREFIX_END = "<!-- E O PREFIX -->"
+APPENDIX = '\n\n<hr class="append-display no-in-raw" />'
+
+
+# 以下为改写之前的实现
+def baseline_escape_markdown(text):
+    escape_chars = {
+        '"': "&quot;", "_": "&#95;", "*": "&#42;", "[": "&#91;", "]": "&#93;", "(": "&#40;", ")": "&#41;",
+        "{": "&#123;", "}": "&#125;", "#": "&#35;", "+": "&#43;", "-": "&#45;", ".": "&#46;", "!": "&#33;",
+        "`": "&#96;", ">": "&#62;", "<": "&#60;", "|": "&#124;", "$": "&#36;", ":": "&#58;", "\n": "<br>",
+    }
+    text = text.replace("    ", "&nbsp;&nbsp;&nbsp;&nbsp;")
+    return "".join(escape_chars.get(c, c) for c in text)
+
+
+def baseline_clip_rawtext(chat_message):
+    hr_match = re.search(r'\n\n<hr class="append-display no-in-raw" />(.*?)', chat_message, re.DOTALL)
+    message_clipped = chat_message[: hr_match.start()] if hr_match else chat_message
+    agent_parts = re.split(r"(<!-- S O PREFIX -->.*?<!-- E O PREFIX -->)", message_clipped, flags=re.DOTALL)
+    final_message = ""
+    for i, part in enumerate(agent_parts):
+        if i % 2 == 0:
+            if part != "" and part != "\n":
+                final_message += f'<pre class="fake-pre">{baseline_escape_markdown(part)}</pre>'
+        else:
+            final_message += part.replace(' data-fancybox="gallery"', "")
+    return final_message
+
+
+def baseline_convert_bot_before_marked(chat_message):
+    if '<div class="md-message">' in chat_message:
+        return chat_message
+    raw = f'<div class="raw-message hideM">{baseline_clip_rawtext(chat_message)}</div>'
+    code_block_pattern = re.compile(r"```(.*?)(?:```|$)", re.DOTALL)
+    code_blocks = code_block_pattern.findall(chat_message)
+    non_code_parts = code_block_pattern.split(chat_message)[::2]
+    result = []
+    for non_code, code in zip(non_code_parts, code_blocks + [""]):
+        if non_code.strip():
+            result.append(non_code)
+        if code.strip():
+            result.append(f"\n```{code}\n```")
+    return raw + f'<div class="md-message">\n\n{"".join(result)}\n</div>'
+
+
+def baseline_clean_text(text):
+    cleaned_parts = []
+    for part in re.split(r"(```[\s\S]*?```)", text):
+        if part.startswith("```") and part.endswith("```"):
+            cleaned_parts.append(part)
+        else:
+            cleaned_parts.append(re.sub(r"&[#\w]+;", "", re.sub(r"<[^>]+>", "", part)))
+    return "".join(cleaned_parts)
+
+
+TOKENS = [
+    "```", "````", "``", "`", "\n", "\n\n", " ", "    ", "a", "py", "#", "-", "$x$", "<", ">", "-->", "<b>", "</b>",
+    "&amp;", PREFIX_START, PREFIX_END, APPENDIX, ' data-fancybox="gallery"',
+]
+
+CASES = [
+    f"{PREFIX_START}```py\nprint(1)\n```{PREFIX_END}正文",
+    f"开头```js\ncode{PREFIX_START}```{PREFIX_END}之后",
+    f"{PREFIX_START}<img src='a.png' data-fancybox=\"gallery\">{PREFIX_END}\n```\n没有结尾的代码块\n",
+    f"回答 `code` 与 <b>粗体</b>{APPENDIX}1. [来源](http://a.b)```",
+    "<``a\n\n```<&amp;>",
+]
+
+
+def random_messages(count, seed=0):
+    rng = random.Random(seed)
+    for _ in range(count):
+        yield "".join(rng.choice(TOKENS) for _ in range(rng.randrange(0, 40)))
+
+
+@pytest.mark.parametrize("message", CASES)
+def test_known_cases(message):
+    assert utils.convert_bot_before_marked(message) == baseline_convert_bot_before_marked(message)
+    assert utils.remove_html_tags([[message, None]]) == [[baseline_clean_text(message), None]]
+
+
+def test_random_messages_match_baseline():
+    for message in random_messages(20000):
+        assert utils.convert_bot_before_marked(message) == baseline_convert_bot_before_marked(message), message
+        assert utils.remove_html_tags([[message, None]]) == [[baseline_clean_text(message), None]], message
+        assert utils.escape_markdown(message) == baseline_escape_markdown(message), message
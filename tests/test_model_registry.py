@@ -0,0 +1,55 @@
+# -*- coding:utf-8 -*-
+import threading
+
+from modules.models import model_registry as registry_module
+from modules.models.model_registry import DEFAULT_CONTEXT_LENGTH, ModelMetadata, ModelRegistry
+
+
+def make_metadata(registry):
+    return ModelMetadata(registry.describe, {"keep_alive": None}, known=lambda: ["qwen3"], resolver=registry)
+
+
+def test_fallback_is_not_cached(monkeypatch):
+    registry = ModelRegistry()
+    monkeypatch.setattr(registry, "_save_snapshot", lambda: None)
+    release = threading.Event()
+    done = threading.Event()
+
+    def context_length(model):
+        release.wait(5)
+        registry.context_lengths[model] = 8192
+        done.set()
+        return 8192
+
+    monkeypatch.setattr(registry, "context_length", context_length)
+    metadata = make_metadata(registry)
+    # 请求路径上不等待 /api/show，先使用默认值
+    assert metadata["qwen3"]["token_limit"] == DEFAULT_CONTEXT_LENGTH
+    assert not metadata.resolved("qwen3")
+    assert not dict.__contains__(metadata, "qwen3")
+    release.set()
+    assert done.wait(5)
+    assert metadata["qwen3"]["token_limit"] == 8192
+    assert dict.__contains__(metadata, "qwen3")
+
+
+def test_failed_lookup_retries_after_interval(monkeypatch):
+    registry = ModelRegistry()
+    monkeypatch.setattr(registry_module.host_pool, "select", lambda model: None)
+    assert registry.context_length("qwen3") == DEFAULT_CONTEXT_LENGTH
+    assert not registry.resolved("qwen3")
+    started = []
+
+    class Thread:
+        def __init__(self, **kwargs):
+            self.name = kwargs["name"]
+
+        def start(self):
+            started.append(self.name)
+
+    monkeypatch.setattr(registry_module.threading, "Thread", Thread)
+    registry.resolve_in_background("qwen3")
+    assert started == []
+    monkeypatch.setattr(registry_module, "RESOLVE_RETRY_INTERVAL", 0)
+    registry.resolve_in_background("qwen3")
+    assert started == ["model-info-qwen3"]
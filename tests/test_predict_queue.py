@@ -0,0 +1,101 @@
+# -*- coding:utf-8 -*-
+"""生成器在排队或生成期间被关闭时，排队凭据必须被取消或释放"""
+import asyncio
+
+import pytest
+
+pytest.importorskip("gradio")
+pytest.importorskip("langchain")
+from modules.models import base_model  # noqa: E402
+from modules.models.host_pool import host_pool  # noqa: E402
+from modules.models.scheduler import Scheduler  # noqa: E402
+from modules.models.token_ledger import TokenLedger  # noqa: E402
+
+
+class FakeModel(base_model.BaseLLMModel):
+    def __init__(self):
+        # 不读取模型元数据，只设置 predict 用到的属性
+        self.model_name = "llama3"
+        self.user_name = "alice"
+        self.api_key = None
+        self.need_api_key = False
+        self.stream = True
+        self.single_turn = False
+        self.interrupted = False
+        self.pending_choices = None
+        self.history = []
+        self.all_token_counts = TokenLedger()
+        self.last_ttft = None
+        self._ticket = None
+
+    def stream_next_chatbot(self, inputs, chatbot, fake_input=None, display_append=""):
+        while True:
+            yield chatbot + [(fake_input, "……")], "生成中"
+
+    async def stream_next_chatbot_async(self, inputs, chatbot, fake_input=None, display_append=""):
+        while True:
+            yield chatbot + [(fake_input, "……")], "生成中"
+            await asyncio.sleep(0)
+
+    def recover(self):
+        pass
+
+
+@pytest.fixture
+def scheduler(monkeypatch):
+    previous = host_pool.hosts
+    host_pool.set_hosts(["http://host-a:11434"])
+    monkeypatch.setattr(base_model, "POLL_INTERVAL", 0.01)
+    monkeypatch.setattr("modules.models.scheduler.MAX_INFLIGHT_PER_HOST", 1)
+    fresh = Scheduler()
+    monkeypatch.setattr(base_model, "scheduler", fresh)
+    yield fresh
+    host_pool.hosts = previous
+
+
+def inflight(scheduler):
+    return sum(scheduler.host_counts.values())
+
+
+def test_close_while_queued(scheduler):
+    blocker = scheduler.submit("bob", "llama3")
+    generator = FakeModel().predict("你好", [])
+    for _ in generator:
+        if scheduler.queues:
+            break
+    generator.close()
+    assert not scheduler.queues
+    scheduler.release(blocker)
+    assert inflight(scheduler) == 0
+
+
+def test_close_while_generating(scheduler):
+    generator = FakeModel().predict("你好", [])
+    for _, status in generator:
+        if status == "生成中":
+            break
+    assert inflight(scheduler) == 1
+    generator.close()
+    assert inflight(scheduler) == 0
+
+
+def test_async_close_while_queued_and_generating(scheduler):
+    async def run():
+        blocker = scheduler.submit("bob", "llama3")
+        generator = FakeModel().predict_async("你好", [])
+        async for _ in generator:
+            if scheduler.queues:
+                break
+        await generator.aclose()
+        assert not scheduler.queues
+        scheduler.release(blocker)
+
+        generator = FakeModel().predict_async("你好", [])
+        async for _, status in generator:
+            if status == "生成中":
+                break
+        assert inflight(scheduler) == 1
+        await generator.aclose()
+
+    asyncio.run(run())
+    assert inflight(scheduler) == 0
@@ -0,0 +1,47 @@
+# -*- coding:utf-8 -*-
+import os
+
+import pytest
+
+from modules.models import response_cache as cache_module
+from modules.models.response_cache import ResponseCache
+
+
+@pytest.fixture
+def cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(cache_module, "ENABLED", True)
+    monkeypatch.setattr(cache_module, "DIRECTORY", str(tmp_path))
+    monkeypatch.setattr(cache_module, "TTL", 60)
+    return ResponseCache()
+
+
+def test_memory_and_disk_hits(cache):
+    key = ResponseCache.make_key("llama3", [{"role": "user", "content": " 你好 "}], {"temperature": 0.0})
+    assert key == ResponseCache.make_key("llama3", [{"role": "user", "content": "你好"}], {"temperature": 0.0})
+    assert cache.get(key) is None
+    cache.put(key, {"content": "标题"})
+    assert cache.get(key) == {"content": "标题"}
+    assert ResponseCache().get(key) == {"content": "标题"}
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_memory_entry_expires_with_ttl(cache, monkeypatch):
+    key = ResponseCache.make_key("llama3", [{"role": "user", "content": "你好"}], {})
+    cache.put(key, {"content": "标题"})
+    now = cache_module.time.time()
+    monkeypatch.setattr(cache_module.time, "time", lambda: now + 61)
+    assert cache.get(key) is None
+    assert key not in cache.entries
+    assert not os.path.exists(cache._path(key))
+
+
+def test_disk_hit_keeps_original_write_time(cache, monkeypatch):
+    key = ResponseCache.make_key("llama3", [{"role": "user", "content": "你好"}], {})
+    cache.put(key, {"content": "标题"})
+    now = cache_module.time.time()
+    reloaded = ResponseCache()
+    monkeypatch.setattr(cache_module.time, "time", lambda: now + 30)
+    assert reloaded.get(key) == {"content": "标题"}
+    # 从磁盘读入内存后仍按写入磁盘的时间过期
+    monkeypatch.setattr(cache_module.time, "time", lambda: now + 61)
+    assert reloaded.get(key) is None
@@ -0,0 +1,159 @@
+# -*- coding:utf-8 -*-
+import random
+import threading
+
+import pytest
+
+from modules.models import scheduler as scheduler_module
+from modules.models.host_pool import host_pool
+from modules.models.scheduler import BACKGROUND, Scheduler
+
+HOSTS = ["http://host-a:11434", "http://host-b:11434"]
+
+
+@pytest.fixture(autouse=True)
+def hosts(monkeypatch):
+    previous = host_pool.hosts
+    host_pool.set_hosts(HOSTS)
+    monkeypatch.setattr(scheduler_module, "MAX_INFLIGHT_PER_HOST", 1)
+    monkeypatch.setattr(scheduler_module, "MAX_INFLIGHT_PER_MODEL", 0)
+    monkeypatch.setattr(scheduler_module, "MAX_BACKGROUND_INFLIGHT", 1)
+    monkeypatch.setattr(scheduler_module, "POLICY", "fair")
+    yield
+    host_pool.hosts = previous
+
+
+def idle(scheduler):
+    return (
+        not any(scheduler.host_counts.values())
+        and not any(scheduler.model_counts.values())
+        and not any(scheduler.user_counts.values())
+        and not scheduler.group_host_counts
+        and not scheduler.queues
+        and not scheduler.background_queue
+        and scheduler.background_count == 0
+    )
+
+
+def test_admit_up_to_host_capacity():
+    scheduler = Scheduler()
+    tickets = [scheduler.submit("alice", "llama3") for _ in range(3)]
+    assert [ticket.admitted.is_set() for ticket in tickets] == [True, True, False]
+    assert {tickets[0].host, tickets[1].host} == set(host_pool.candidates()[i].base_url for i in range(2))
+    assert tickets[2].position == 1
+
+    scheduler.release(tickets[0])
+    assert tickets[2].admitted.is_set()
+    assert tickets[2].host == tickets[0].host
+    scheduler.release(tickets[1])
+    scheduler.release(tickets[2])
+    assert idle(scheduler)
+
+
+def test_cancel_queued_ticket():
+    scheduler = Scheduler()
+    running = [scheduler.submit("alice", "llama3") for _ in range(2)]
+    queued = scheduler.submit("bob", "llama3")
+    waiting = scheduler.submit("carol", "llama3")
+    scheduler.cancel(queued)
+    assert waiting.position == 1
+    scheduler.release(running[0])
+    assert waiting.admitted.is_set()
+    assert not queued.admitted.is_set()
+    scheduler.release(running[1])
+    scheduler.release(waiting)
+    assert idle(scheduler)
+
+
+def test_cancel_after_admission_releases_slot():
+    scheduler = Scheduler()
+    running = [scheduler.submit("alice", "llama3") for _ in range(2)]
+    queued = scheduler.submit("bob", "llama3")
+    # 排队的请求在调用方决定取消之前被放行
+    scheduler.release(running[0])
+    assert queued.admitted.is_set()
+    scheduler.cancel(queued)
+    scheduler.release(running[1])
+    assert idle(scheduler)
+
+
+def test_try_admit_respects_host_capacity():
+    scheduler = Scheduler()
+    primary = scheduler.submit("alice", "llama3")
+    other = next(url for url in HOSTS if url != primary.host)
+    # 对冲请求占用另一台主机的名额
+    hedge = scheduler.try_admit("alice", "llama3", other, group=primary.group)
+    assert hedge is not None and hedge.host == other
+    assert scheduler.try_admit("alice", "llama3", other) is None
+    queued = scheduler.submit("bob", "llama3")
+    assert not queued.admitted.is_set()
+    # 对冲的一路失败后释放名额，排队的请求随即放行
+    scheduler.release(hedge)
+    assert queued.admitted.is_set()
+    scheduler.release(queued)
+    scheduler.release(primary)
+    assert idle(scheduler)
+
+
+def test_try_admit_does_not_jump_queue(monkeypatch):
+    monkeypatch.setattr(scheduler_module, "MAX_INFLIGHT_PER_MODEL", 1)
+    scheduler = Scheduler()
+    running = scheduler.submit("alice", "llama3")
+    queued = scheduler.submit("bob", "llama3")
+    assert not queued.admitted.is_set()
+    idle_host = next(url for url in HOSTS if url != running.host)
+    # 另一台主机仍有空余，但有请求在排队时不放行对冲请求
+    assert scheduler.try_admit("alice", "mistral", idle_host) is None
+    scheduler.cancel(queued)
+    ticket = scheduler.try_admit("alice", "mistral", idle_host)
+    assert ticket is not None
+    scheduler.release(ticket)
+    scheduler.release(running)
+    assert idle(scheduler)
+
+
+def test_fair_policy_alternates_users():
+    scheduler = Scheduler()
+    running = [scheduler.submit("alice", "llama3") for _ in range(2)]
+    alice = [scheduler.submit("alice", "llama3") for _ in range(2)]
+    bob = scheduler.submit("bob", "llama3")
+    assert bob.position == 1
+    scheduler.release(running[0])
+    assert bob.admitted.is_set()
+    assert not any(ticket.admitted.is_set() for ticket in alice)
+
+
+def test_background_waits_for_interactive_queue():
+    scheduler = Scheduler()
+    running = [scheduler.submit("alice", "llama3") for _ in range(2)]
+    queued = scheduler.submit("bob", "llama3")
+    background = scheduler.submit("alice", "llama3", BACKGROUND)
+    scheduler.release(running[0])
+    assert queued.admitted.is_set()
+    assert not background.admitted.is_set()
+    scheduler.release(running[1])
+    assert background.admitted.is_set()
+    scheduler.release(queued)
+    scheduler.release(background)
+    assert idle(scheduler)
+
+
+def test_concurrent_cancel_and_release_do_not_leak():
+    scheduler = Scheduler()
+    rng = random.Random(0)
+
+    def worker(seed):
+        local = random.Random(seed)
+        for _ in range(200):
+            ticket = scheduler.submit(f"user{local.randrange(4)}", "llama3")
+            if ticket.wait(timeout=local.random() / 1000):
+                scheduler.release(ticket)
+            else:
+                scheduler.cancel(ticket)
+
+    threads = [threading.Thread(target=worker, args=(rng.random(),)) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert idle(scheduler)
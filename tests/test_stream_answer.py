@@ -0,0 +1,100 @@
+# -*- coding:utf-8 -*-
+import random
+import sys
+import threading
+
+from modules.models.stream_answer import StreamAnswer
+
+
+def test_render_matches_plain_string():
+    answer = StreamAnswer()
+    for text in ("先", "想", "一想"):
+        answer.add_reasoning(text)
+    assert str(answer).startswith("<details open>\n<summary>Thinking (")
+    assert str(answer).endswith("先想一想</details>\n\n")
+    for text in ("你好", "，", "世界"):
+        answer.add_content(text)
+    assert answer.content == "你好，世界"
+    assert answer.reasoning == "先想一想"
+    assert len(answer) == len("先想一想") + len("你好，世界")
+    assert str(answer) == (
+        f"<details>\n<summary>Thought for {answer.elapsed_seconds} s</summary>\n先想一想</details>\n\n你好，世界"
+    )
+
+
+def test_content_only():
+    answer = StreamAnswer()
+    answer.add_content("a")
+    answer.add_content("b")
+    assert str(answer) == "ab"
+
+
+def test_concurrent_append_and_render():
+    # 生成线程追加的同时界面线程不断读取，任何一段都不能丢
+    answer = StreamAnswer()
+    parts = [f"{index}," for index in range(20000)]
+    done = threading.Event()
+
+    def produce():
+        for part in parts:
+            answer.add_content(part)
+            answer.add_reasoning(part)
+        done.set()
+
+    def consume():
+        while not done.is_set():
+            str(answer)
+            answer.content
+            answer.reasoning
+
+    threads = [threading.Thread(target=produce)] + [threading.Thread(target=consume) for _ in range(3)]
+    # 频繁切换线程，让追加落在合并和写回之间
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    try:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        sys.setswitchinterval(interval)
+    assert answer.content == "".join(parts)
+    assert answer.reasoning == "".join(parts)
+
+
+def test_frame_is_a_snapshot():
+    answer = StreamAnswer()
+    answer.add_reasoning("先想")
+    frame = answer.frame("\n\n<hr />附加")
+    rendered = str(answer) + "\n\n<hr />附加"
+    answer.add_reasoning("一想")
+    answer.add_content("你好")
+    assert str(frame) == rendered
+    assert frame.summary.startswith("Thinking (")
+    assert frame.reasoning_since(0) == "先想"
+    assert frame.content_since(0) == ""
+    assert str(answer.frame()) == str(answer)
+
+
+def test_frame_slices_match_joined_text():
+    rng = random.Random(0)
+    answer = StreamAnswer()
+    reasoning = content = ""
+    sent_reasoning = sent_content = 0
+    for _ in range(2000):
+        text = "".join(rng.choice("ab思考\n") for _ in range(rng.randrange(0, 5)))
+        if rng.random() < 0.5:
+            answer.add_reasoning(text)
+            reasoning += text
+        else:
+            answer.add_content(text)
+            content += text
+        if rng.random() < 0.3:
+            frame = answer.frame()
+            assert frame.reasoning_since(sent_reasoning) == reasoning[sent_reasoning:]
+            assert frame.content_since(sent_content) == content[sent_content:]
+            sent_reasoning, sent_content = frame.reasoning_length, frame.content_length
+        if rng.random() < 0.01:
+            # 读取完整文本会合并片段，之后的切片仍然正确
+            assert answer.reasoning == reasoning
+    assert str(answer.frame()) == str(answer)
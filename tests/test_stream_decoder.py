@@ -0,0 +1,91 @@
+# -*- coding:utf-8 -*-
+import json
+
+import pytest
+
+from modules.models.stream_decoder import NDJSON, SSE, StreamDecoder
+
+SSE_STREAM = (
+    b": keep-alive\n\n"
+    + b"".join(
+        b"data: " + json.dumps({"choices": [{"delta": delta}]}, ensure_ascii=False).encode("utf-8") + b"\r\n\r\n"
+        for delta in (
+            {"role": "assistant", "content": ""},
+            {"reasoning_content": "想一想"},
+            {"content": "你好"},
+            {"content": "，世界"},
+        )
+    )
+    + b'data: {"choices": [{"delta": {}, "finish_reason": "stop"}]}\n\n'
+    + b'data: {"choices": [], "usage": {"prompt_tokens": 3, "completion_tokens": 4}}\n\n'
+    + b"data: [DONE]\n\n"
+)
+
+NDJSON_STREAM = b"".join(
+    json.dumps(chunk, ensure_ascii=False).encode("utf-8") + b"\n"
+    for chunk in (
+        {"message": {"role": "assistant", "content": "", "thinking": "嗯"}, "done": False},
+        {"message": {"role": "assistant", "content": "你好"}, "done": False},
+        {"message": {"role": "assistant", "content": "！"}, "done": False},
+        {
+            "message": {"role": "assistant", "content": ""},
+            "done": True,
+            "done_reason": "stop",
+            "prompt_eval_count": 7,
+            "eval_count": 3,
+            "eval_duration": 1000,
+        },
+    )
+)
+
+
+def decode(stream, mode, size):
+    """按 size 字节切分后逐段送入解码器，模拟网络上任意位置的分片"""
+    decoder = StreamDecoder(mode)
+    deltas = []
+    for start in range(0, len(stream), size):
+        deltas += decoder.feed(stream[start:start + size])
+    deltas += decoder.close()
+    return decoder, deltas
+
+
+@pytest.mark.parametrize("size", [1, 2, 3, 7, 64, 1 << 20])
+def test_sse_fragmented(size):
+    decoder, deltas = decode(SSE_STREAM, SSE, size)
+    assert "".join(delta.content or "" for delta in deltas) == "你好，世界"
+    assert "".join(delta.reasoning or "" for delta in deltas) == "想一想"
+    assert [delta.finish_reason for delta in deltas if delta.finish_reason] == ["stop"]
+    assert deltas[-1].usage == {"prompt_tokens": 3, "completion_tokens": 4}
+    assert decoder.done
+    assert decoder.error_text == ""
+
+
+@pytest.mark.parametrize("size", [1, 2, 5, 64, 1 << 20])
+def test_ndjson_fragmented(size):
+    decoder, deltas = decode(NDJSON_STREAM, NDJSON, size)
+    assert "".join(delta.content or "" for delta in deltas) == "你好！"
+    assert "".join(delta.reasoning or "" for delta in deltas) == "嗯"
+    assert deltas[-1].finish_reason == "stop"
+    assert deltas[-1].usage == {"prompt_eval_count": 7, "eval_count": 3, "eval_duration": 1000}
+    assert decoder.done
+
+
+def test_last_line_without_newline():
+    decoder = StreamDecoder(NDJSON)
+    assert decoder.feed(b'{"message": {"content": "a"}, "done": false}') == []
+    deltas = decoder.close()
+    assert [delta.content for delta in deltas] == ["a"]
+
+
+def test_error_text():
+    decoder, deltas = decode(b'{"error": "model not found"}\n', NDJSON, 4)
+    assert deltas == []
+    assert decoder.error_text == "model not found"
+
+    decoder, deltas = decode(b"Internal Server Error\n", SSE, 4)
+    assert deltas == []
+    assert decoder.error_text == "Internal Server Error"
+
+    decoder, deltas = decode(b'data: {"error": {"message": "bad"}}\n\n', SSE, 3)
+    assert deltas == []
+    assert json.loads(decoder.error_text) == {"message": "bad"}
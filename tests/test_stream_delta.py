@@ -0,0 +1,97 @@
+# -*- coding:utf-8 -*-
+from types import SimpleNamespace
+
+from modules.models import stream_answer
+from modules.models.stream_answer import StreamAnswer
+from modules.models.stream_delta import MessageDelta, common_prefix_length
+
+
+class Client:
+    """与 stream-delta.js 相同的拼接规则"""
+
+    def __init__(self):
+        self.text = ""
+        self.reasoning = ""
+        self.summary = None
+
+    def apply(self, delta):
+        assert delta["offset"] <= len(self.text)
+        self.text = self.text[:delta["offset"]] + delta["text"]
+        if "reasoning" in delta:
+            assert delta["reasoning_offset"] <= len(self.reasoning)
+            self.reasoning = self.reasoning[:delta["reasoning_offset"]] + delta["reasoning"]
+            self.summary = delta["summary"]
+        else:
+            self.reasoning, self.summary = "", None
+
+
+def test_common_prefix_length():
+    assert common_prefix_length("", "abc") == 0
+    assert common_prefix_length("ab", "abc") == 2
+    assert common_prefix_length("abx", "aby") == 2
+    assert common_prefix_length("abc", "") == 0
+
+
+def test_string_message():
+    message = MessageDelta("t-1")
+    client = Client()
+    for text in ("你", "你好", "你好，", "你好，世界", "你好，世界"):
+        delta = message.next(text)
+        if delta is not None:
+            client.apply(delta)
+    assert client.text == "你好，世界"
+    assert message.next("你好，世界") is None
+    assert message.next("你好啊") == {"id": "t-1", "offset": 2, "text": "啊"}
+
+
+def test_reasoning_stream_sends_each_character_once(monkeypatch):
+    # Thinking (Ns) 每秒都在变化，思考过程和正文仍然只发送新增的部分
+    clock = SimpleNamespace(now=1000.0)
+    monkeypatch.setattr(stream_answer, "time", SimpleNamespace(time=lambda: clock.now))
+    answer = StreamAnswer()
+    message = MessageDelta("t-1")
+    client = Client()
+    sent = 0
+    summaries = set()
+    for index in range(3000):
+        clock.now += 0.25
+        if index < 2500:
+            answer.add_reasoning(f"思考{index}")
+        else:
+            answer.add_content(f"正文{index}")
+        delta = message.next(answer.frame("\n\n<hr />附加"))
+        assert delta is not None
+        client.apply(delta)
+        sent += len(delta["text"]) + len(delta["reasoning"])
+        summaries.add(delta["summary"])
+    assert client.reasoning == answer.reasoning
+    assert client.text == answer.content
+    assert sent == len(answer)
+    assert len(summaries) > 100
+    assert client.summary == f"Thought for {answer.elapsed_seconds} s"
+    assert message.next(answer.frame()) is None
+
+
+def test_summary_change_alone_is_sent(monkeypatch):
+    clock = SimpleNamespace(now=0.0)
+    monkeypatch.setattr(stream_answer, "time", SimpleNamespace(time=lambda: clock.now))
+    answer = StreamAnswer()
+    message = MessageDelta("t-1")
+    answer.add_reasoning("想")
+    assert message.next(answer.frame())["summary"] == "Thinking (0s)"
+    clock.now = 3
+    answer.add_reasoning("")
+    delta = message.next(answer.frame())
+    assert (delta["summary"], delta["reasoning"], delta["text"]) == ("Thinking (3s)", "", "")
+
+
+def test_switching_between_string_and_frames_restarts():
+    answer = StreamAnswer()
+    answer.add_content("abc")
+    message = MessageDelta("t-1")
+    client = Client()
+    client.apply(message.next("xyz"))
+    client.apply(message.next(answer.frame()))
+    assert (client.text, client.reasoning) == ("abc", "")
+    client.apply(message.next("abcd"))
+    assert client.text == "abcd"
@@ -0,0 +1,62 @@
+# -*- coding:utf-8 -*-
+import random
+
+from modules.models.token_ledger import TokenLedger
+
+
+def expected(counts):
+    return sum(counts), sum(sum(counts[: i + 1]) for i in range(len(counts)))
+
+
+def assert_consistent(ledger, counts):
+    assert list(ledger) == counts
+    assert len(ledger) == len(counts)
+    assert (ledger.total, ledger.consumed) == expected(counts)
+    assert ledger.previous_total == (sum(counts[:-1]) if counts else 0)
+
+
+def test_empty():
+    ledger = TokenLedger()
+    assert_consistent(ledger, [])
+
+
+def test_append_pop_popleft():
+    ledger = TokenLedger([3, 5, 7])
+    assert (ledger.total, ledger.consumed) == (15, 3 + 8 + 15)
+    assert ledger.previous_total == 8
+    assert ledger.pop() == 7
+    assert_consistent(ledger, [3, 5])
+    assert ledger.popleft() == 3
+    assert_consistent(ledger, [5])
+    ledger.append(2)
+    assert_consistent(ledger, [5, 2])
+
+
+def test_setitem():
+    ledger = TokenLedger([3, 5, 7])
+    ledger[0] += 10
+    assert_consistent(ledger, [13, 5, 7])
+    ledger[-1] = 1
+    assert_consistent(ledger, [13, 5, 1])
+    assert ledger[1] == 5
+
+
+def test_random_operations():
+    rng = random.Random(0)
+    ledger, counts = TokenLedger(), []
+    for _ in range(2000):
+        operation = rng.choice(["append", "append", "pop", "popleft", "setitem"])
+        if operation == "append" or not counts:
+            count = rng.randrange(100)
+            ledger.append(count)
+            counts.append(count)
+        elif operation == "pop":
+            assert ledger.pop() == counts.pop()
+        elif operation == "popleft":
+            assert ledger.popleft() == counts.pop(0)
+        else:
+            index = rng.randrange(-len(counts), len(counts))
+            count = rng.randrange(100)
+            ledger[index] = count
+            counts[index] = count
+        assert_consistent(ledger, counts)
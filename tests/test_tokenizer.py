@@ -0,0 +1,10 @@
+# -*- coding:utf-8 -*-
+from modules.tokenizer import get_tokenizer
+
+
+def test_scaled_approximation_has_its_own_identity():
+    # Llama 2 与 GPT 都可能退回到 cl100k_base，计数乘以不同的系数，保存的计数不能混用
+    llama, gpt = get_tokenizer("llama2:7b"), get_tokenizer("gpt-3.5-turbo")
+    assert llama.name == gpt.name
+    assert llama.identity != gpt.identity
+    assert get_tokenizer("gemma:2b").identity not in (llama.identity, gpt.identity)
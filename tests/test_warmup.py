@@ -0,0 +1,39 @@
+# -*- coding:utf-8 -*-
+import pytest
+
+from modules.models import warmup
+from modules.models.host_pool import host_pool, model_key
+
+HOSTS = ["http://host-a:11434", "http://host-b:11434"]
+
+
+@pytest.fixture(autouse=True)
+def hosts():
+    previous = host_pool.hosts
+    host_pool.set_hosts(HOSTS)
+    yield
+    host_pool.hosts = previous
+
+
+def test_model_key_adds_default_tag():
+    assert model_key("qwen3") == "qwen3:latest"
+    assert model_key("qwen3:8b") == "qwen3:8b"
+    assert model_key("localhost:5000/qwen3") == "localhost:5000/qwen3:latest"
+
+
+def test_resident_matches_ps_names():
+    host = host_pool.hosts[0]
+    # /api/ps 返回带标签的名称
+    host.loaded_models = {model_key("qwen3:latest")}
+    assert host_pool.is_resident("qwen3")
+    assert not host_pool.is_resident("llama3")
+    host_pool.mark_loaded(host, "qwen3", loaded=False)
+    assert not host_pool.is_resident("qwen3")
+
+
+def test_skip_warm_up_when_resident(monkeypatch):
+    started = []
+    monkeypatch.setattr(warmup.threading, "Thread", lambda **kwargs: started.append(kwargs))
+    host_pool.mark_loaded(host_pool.hosts[1], "qwen3")
+    warmup.warm_up_in_background("qwen3", "30m")
+    assert started == []
@@ -124,6 +124,7 @@ function initialize() {
     setUpdater();
 
     setChatbotScroll();
+    setStreamDelta();
     setTimeout(showOrHideUserInfo(), 2000);
 
     // setHistroyPanel();
@@ -0,0 +1,61 @@
+
+// delta_streaming 模式：服务端只发送正在生成的回答新增的文本，在这里追加到最后一条 bot 消息中，
+// 每轮结束时 Gradio 会同步完整的对话并重新渲染
+
+var streamDeltaId = null;
+var streamDeltaText = "";
+var streamDeltaReasoning = "";
+
+var streamDeltaObserver = new MutationObserver(() => {
+    applyStreamDelta();
+});
+
+function setStreamDelta() {
+    var streamDeltaDiv = gradioApp().querySelector('#stream-delta');
+    if (!streamDeltaDiv) return;
+    streamDeltaObserver.observe(streamDeltaDiv, { childList: true, subtree: true, characterData: true });
+}
+
+function applyStreamDelta() {
+    var payload = gradioApp().querySelector('#stream-delta').textContent.trim();
+    if (!payload) return; // 完整同步时清空
+    var delta;
+    try {
+        delta = JSON.parse(payload);
+    } catch (e) {
+        return;
+    }
+    if (delta.id !== streamDeltaId) {
+        streamDeltaId = delta.id;
+        streamDeltaText = "";
+        streamDeltaReasoning = "";
+    }
+    // 错过了中间的更新，等待结束时的完整同步
+    if (delta.offset > streamDeltaText.length) return;
+    if ("reasoning" in delta && delta.reasoning_offset > streamDeltaReasoning.length) return;
+    streamDeltaText = streamDeltaText.slice(0, delta.offset) + delta.text;
+    // 思考过程与正文分开发送，字符串回答没有这一段
+    streamDeltaReasoning = "reasoning" in delta
+        ? streamDeltaReasoning.slice(0, delta.reasoning_offset) + delta.reasoning
+        : "";
+
+    // :last-of-type 按元素类型而不是类名匹配，取所有回答中的最后一个
+    var botMessages = gradioApp().querySelectorAll('#chuanhu-chatbot .message-wrap .message.bot');
+    var latestMessage = botMessages.length ? botMessages[botMessages.length - 1] : null;
+    var mdMessage = latestMessage && latestMessage.querySelector('.md-message');
+    if (!mdMessage) return;
+    mdMessage.classList.add('stream-delta-message');
+    mdMessage.textContent = "";
+    if (delta.summary) {
+        // 用 DOM 组装 <details>，不把原始标记当作文本显示
+        var details = document.createElement('details');
+        details.open = !!delta.open;
+        var summary = document.createElement('summary');
+        summary.textContent = delta.summary;
+        details.appendChild(summary);
+        details.appendChild(document.createTextNode(streamDeltaReasoning));
+        mdMessage.appendChild(details);
+    }
+    // 搜索结果等附加内容在生成结束后随完整同步显示
+    mdMessage.appendChild(document.createTextNode(streamDeltaText.split('\n\n<hr class="append-display no-in-raw" />')[0]));
+}